@@ -2,6 +2,7 @@ from flask.ext.script import Manager
 from flask.ext.migrate import Migrate, MigrateCommand
 from search_rex.core import db
 from search_rex.factory import create_app
+from search_rex import services
 
 app = create_app()
 migrate = Migrate(app, db, directory='migrations')
@@ -9,5 +10,30 @@ manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
+
+@manager.option('path', help='the CSV or NDJSON file to import')
+@manager.option(
+    '-f', '--format', dest='format', default=None,
+    help='csv or ndjson, by default derived from the file extension')
+@manager.option(
+    '-k', '--max-sims-per-record', dest='max_sims_per_record', type=int,
+    default=100, help='the maximum number of similarities per record')
+@manager.option(
+    '-c', '--chunk-size', dest='chunk_size', type=int, default=1000,
+    help='the number of records whose similarities are written at once')
+def import_similarities(path, format, max_sims_per_record, chunk_size):
+    """
+    Imports record similarities in bulk and replaces the similarities of the
+    records they originate from
+    """
+    if format is None:
+        format = 'ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv'
+    with open(path, 'rb') as lines:
+        num_records, num_sims = services.import_record_similarities_bulk(
+            services.parse_similarities(lines, format),
+            max_sims_per_record=max_sims_per_record, chunk_size=chunk_size)
+    print('Imported {} similarities of {} records'.format(
+        num_sims, num_records))
+
 if __name__ == '__main__':
     manager.run()
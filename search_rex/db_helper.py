@@ -4,6 +4,10 @@ database
 """
 
 from sqlalchemy.sql import ClauseElement
+from sqlalchemy.sql.expression import Insert
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.types import Integer
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.exc import IntegrityError
 
@@ -35,3 +39,104 @@ def get_one_or_create(
         except IntegrityError:
             session.rollback()
             return session.query(model).filter_by(**kwargs).one(), True
+
+
+class InsertOrIgnore(Insert):
+    """
+    An INSERT statement that skips the rows which would violate a unique
+    constraint instead of failing. It is compiled to INSERT ... ON CONFLICT
+    DO NOTHING on PostgreSQL (9.5 or newer), INSERT OR IGNORE on SQLite and
+    INSERT IGNORE on MySQL. Other dialects get a plain INSERT
+    """
+
+
+@compiles(InsertOrIgnore, 'postgresql')
+def compile_insert_or_ignore_postgresql(insert, compiler, **kwargs):
+    return compiler.visit_insert(insert, **kwargs) + ' ON CONFLICT DO NOTHING'
+
+
+@compiles(InsertOrIgnore, 'sqlite')
+def compile_insert_or_ignore_sqlite(insert, compiler, **kwargs):
+    return compiler.visit_insert(insert.prefix_with('OR IGNORE'), **kwargs)
+
+
+@compiles(InsertOrIgnore, 'mysql')
+def compile_insert_or_ignore_mysql(insert, compiler, **kwargs):
+    return compiler.visit_insert(insert.prefix_with('IGNORE'), **kwargs)
+
+
+# The maximum number of bound parameters of a statement, which is the
+# default limit of SQLite before version 3.32
+MAX_STATEMENT_PARAMETERS = 999
+
+
+def insert_rows(session, insert, rows):
+    """
+    Inserts the rows with multi-row INSERT statements. The rows are split
+    into chunks so that no statement exceeds MAX_STATEMENT_PARAMETERS
+
+    :param session: the database session
+    :param insert: the INSERT statement without values
+    :param rows: a list of dictionaries mapping the column names to values.
+    All rows must have the same columns
+    """
+    if not rows:
+        return
+    # SQLAlchemy only applies the Python-side defaults to the first row of a
+    # multi-row statement, so the scalar defaults are filled in beforehand
+    defaults = {
+        column.name: column.default.arg
+        for column in insert.table.columns
+        if column.name not in rows[0] and column.default is not None and
+        column.default.is_scalar
+    }
+    if defaults:
+        rows = [dict(defaults, **row) for row in rows]
+    chunk_size = max(1, MAX_STATEMENT_PARAMETERS // len(rows[0]))
+    for start in xrange(0, len(rows), chunk_size):
+        session.execute(insert.values(rows[start:start+chunk_size]))
+
+
+def insert_or_ignore(session, table, rows):
+    """
+    Inserts the rows into the table with multi-row statements and skips
+    those that are already present
+
+    :param session: the database session
+    :param table: the table into which the rows are inserted
+    :param rows: a list of dictionaries mapping the column names to values
+    """
+    insert_rows(session, InsertOrIgnore(table), rows)
+
+
+class age_in_intervals(FunctionElement):
+    """
+    The number of complete time intervals between a datetime expression and a
+    reference time, i.e., floor((reference_time - expression) / interval)
+
+    It takes the datetime expression, the reference time and the length of an
+    interval in seconds as arguments. On SQLite, the age is truncated, which
+    differs from floor only for datetimes after the reference time
+    """
+    type = Integer()
+    name = 'age_in_intervals'
+
+
+@compiles(age_in_intervals)
+def compile_age_in_intervals(element, compiler, **kwargs):
+    expression, reference_time, interval_seconds = [
+        compiler.process(clause, **kwargs)
+        for clause in element.clauses.clauses
+    ]
+    return 'CAST(FLOOR(EXTRACT(EPOCH FROM ({} - {})) / {}) AS INTEGER)'\
+        .format(reference_time, expression, interval_seconds)
+
+
+@compiles(age_in_intervals, 'sqlite')
+def compile_age_in_intervals_sqlite(element, compiler, **kwargs):
+    expression, reference_time, interval_seconds = [
+        compiler.process(clause, **kwargs)
+        for clause in element.clauses.clauses
+    ]
+    return 'CAST((julianday({}) - julianday({})) * 86400.0 / {} AS INTEGER)'\
+        .format(reference_time, expression, interval_seconds)
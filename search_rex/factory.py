@@ -27,6 +27,22 @@ def create_app(config_path=None):
 
     app.register_blueprint(rec_api)
 
+    if app.config.get('WRITE_BEHIND_ENABLED', False):
+        from .services import start_write_behind
+        start_write_behind(
+            app,
+            max_size=app.config.get('WRITE_BEHIND_QUEUE_SIZE', 10000),
+            batch_size=app.config.get('WRITE_BEHIND_BATCH_SIZE', 500),
+            flush_interval=app.config.get('WRITE_BEHIND_FLUSH_INTERVAL', 1.0),
+            max_retries=app.config.get('WRITE_BEHIND_MAX_RETRIES', 3))
+
+    if app.config.get('RESPONSE_CACHE_ENABLED', False):
+        from .recommendations.response_cache import enable_response_cache
+        enable_response_cache(
+            max_size=app.config.get('RESPONSE_CACHE_MAX_SIZE', 10000),
+            ttl=app.config.get('RESPONSE_CACHE_TTL'),
+            max_sizes=app.config.get('RESPONSE_CACHE_MAX_SIZES'))
+
     return app
 
 
@@ -4,9 +4,37 @@ It provides a factory method that is called for creating the two recommender
 instances. One of these instances is used for internal users who are allowed
 to see HSR-internal documents. The other instance is applied when HSR-internal
 documents should not be recommended. This is the case for external users.
-Further, this module also holds these recommender instances once they are
-created. For this reason, it is accessed by the search_rex.views module in
-order to generate recommendations for the users.
+Both instances share the same components, which include the internal records.
+The external instance asks the components to filter out the internal records
+at query time. Further, this module also holds these recommender instances
+once they are created. For this reason, it is accessed by the
+search_rex.views module in order to generate recommendations for the users.
+
+On refresh, a complete new set of recommender instances is built next to the
+current one and swapped in at once. Requests that are in progress keep using
+the instance they have retrieved, which is released as soon as they are
+finished. Each set of instances is tagged with a version number.
+
+If the app is configured with a RECOMMENDER_SNAPSHOT_PATH, every set of
+instances that is built or refreshed is stored in a snapshot file. A process
+that creates or rebuilds its recommenders loads the snapshot instead of
+building the instances from the database as long as the snapshot is not
+older than RECOMMENDER_SNAPSHOT_MAX_AGE seconds and was not created by the
+process itself. The large arrays of the snapshot are memory-mapped, so the
+processes that load the same snapshot share them.
+
+In between these rebuilds, the current instances can also be refreshed in
+place. This lets components that support it load only the changes since their
+last refresh instead of reloading all their data. Requests that run during an
+in-place refresh may see components that are already refreshed next to ones
+that are not yet, but they are reported under the previous version. The
+version is only increased once all components are refreshed. Either way, the
+response cache is cleared after a refresh.
+
+If the app is configured with a RECOMMENDER_REFRESH_INTERVAL, every process
+that serves requests refreshes its recommenders in a background thread. The
+thread is started with the first request, so a pre-forking master, the
+Celery workers and the manage.py commands do not run one.
 """
 
 from .refreshable import Refreshable
@@ -19,9 +47,24 @@ import similarity.item_based as item_based_sim
 import similarity.case_based as query_based_sim
 import neighbourhood.item_based as item_based_nhood
 import neighbourhood.case_based as query_based_nhood
+import snapshot
+from .response_cache import clear_response_cache
+from .record_filter import InternalRecordFilter
+from threading import Lock
+from threading import Thread
+from datetime import timedelta
+import logging
+import time
 
 
+logger = logging.getLogger(__name__)
+
 recommender_instances = {}
+refresh_lock = Lock()
+# The function that builds a new set of recommender instances for a version
+recommender_builder = None
+# The function that refreshes the current recommender instances in place
+recommender_updater = None
 
 
 def get_recommender(include_internal_records):
@@ -29,18 +72,86 @@ def get_recommender(include_internal_records):
     Returns either the internal or the external recommender instance
     """
     if len(recommender_instances) == 0:
-        print("Recommenders not created")
+        logger.warning("Recommenders not created")
 
     return recommender_instances[include_internal_records]
 
 
-def refresh_recommenders():
+def get_model_version():
     """
-    Refreshes the components of the recommenders
+    Returns the version of the current recommender instances
     """
     for recommender in recommender_instances.values():
-        refreshed_components = set()
-        recommender.refresh(refreshed_components)
+        return recommender.version
+    return 0
+
+
+def refresh_recommenders(rebuild=True):
+    """
+    Builds new recommender instances from the database and swaps them with
+    the current ones
+
+    :param rebuild: if False, the components of the current instances are
+    refreshed in place instead. Components that support it, e.g., an
+    InMemoryQueryDataModel with a full_refresh_interval, then only load the
+    changes since their last refresh. The version of the instances is only
+    increased once all their components are refreshed
+    """
+    global recommender_instances
+    with refresh_lock:
+        if recommender_builder is None:
+            logger.warning("Recommenders not created")
+            return
+        version = get_model_version() + 1
+        if rebuild:
+            new_instances = recommender_builder(version)
+            recommender_instances = new_instances
+            logger.info("Recommenders of version %d swapped in", version)
+        else:
+            recommender_updater(recommender_instances, version)
+            logger.info("Recommenders refreshed to version %d", version)
+        # The cached results belong to the previous version
+        clear_response_cache()
+
+
+def start_background_refresh(
+        interval=timedelta(minutes=30), rebuild_interval=None):
+    """
+    Starts a daemon thread that refreshes the recommenders of this process
+    periodically
+
+    :param interval: the time between the end of a refresh and the start of
+    the next one
+    :param rebuild_interval: if given, the recommenders are refreshed in place
+    and only rebuilt from scratch once this time has passed since the last
+    rebuild
+    """
+    def refresh_periodically():
+        last_rebuild = time.time()
+        while True:
+            time.sleep(interval.total_seconds())
+            rebuild = rebuild_interval is None or\
+                time.time() - last_rebuild >=\
+                rebuild_interval.total_seconds()
+            try:
+                refresh_recommenders(rebuild=rebuild)
+                if rebuild:
+                    last_rebuild = time.time()
+            except Exception:
+                logger.exception("Refreshing the recommenders failed")
+
+    thread = Thread(target=refresh_periodically, name='recommender-refresh')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def filters_internal_records(recsys):
+    """
+    Checks if the recommender filters out the internal records at query time
+    and can therefore serve both recommender instances
+    """
+    return getattr(recsys, 'record_filter', None) is not None
 
 
 def create_recommender_system(
@@ -50,47 +161,73 @@ def create_recommender_system(
     """
     The factory method for creating the recommender instances
 
+    The factory methods are called with include_internal_records set to True
+    first. If the recommender they create has a record_filter, it serves both
+    instances and filters out the internal records for the external one.
+    Otherwise, the factory method is called again with
+    include_internal_records set to False for creating the external
+    recommender
+
     :param app: the flask app
     :param record_based_recsys_factory: optional factory method for creating
     the record-based recommender
     :param query_based_recsys_factory: optional factory method for creating
-    the query-based recommender
+    the query-based recommender, e.g., one that forms the neighbourhoods with
+    a MinHashQueryNeighbourhood when the query log is too large for an exact
+    index
     """
-    print("Creating Recommender")
+    logger.info("Creating Recommender")
+
+    # The components that the default factories share within a build
+    shared_components = {}
+
+    def get_record_filter():
+        if 'record_filter' not in shared_components:
+            shared_components['record_filter'] = InternalRecordFilter()
+        return shared_components['record_filter']
 
     def r_based_recsys_factory(include_internal_records):
+        record_filter = get_record_filter()
         data_model = item_based_dm.PersistentRecordDataModel(
             include_internal_records)
 
-        in_mem_dm = item_based_dm.InMemoryRecordDataModel(data_model)
+        time_partitioning = item_based_dm.TimePartitioning()
+        in_mem_dm = item_based_dm.InMemoryRecordDataModel(
+            data_model, time_partitioning=time_partitioning,
+            full_refresh_interval=timedelta(days=1))
         content_sim = item_based_sim.InMemoryRecordSimilarity(
-            include_internal_records)
-        sim_metric = item_based_sim.CosineSimilarity()
-        sim_metric = item_based_sim.TimeDecaySimilarity(sim_metric)
+            include_internal_records, record_filter=record_filter)
+        sim_metric = item_based_sim.TimeDecayCosineSimilarity(
+            time_partitioning)
         collaborative_sim = item_based_sim.RecordSimilarity(
             in_mem_dm, sim_metric)
         combined_sim = item_based_sim.CombinedRecordSimilarity(
             collaborative_sim, content_sim, weight=0.75)
 
         nhood = item_based_nhood.KNearestRecordNeighbourhood(
-            10, in_mem_dm, combined_sim)
+            10, in_mem_dm, combined_sim, record_filter=record_filter)
 
         return item_based_rec.RecordBasedRecommender(
-            data_model, record_nhood=nhood, record_sim=combined_sim)
+            data_model, record_nhood=nhood, record_sim=combined_sim,
+            record_filter=record_filter)
 
     def q_based_recsys_factory(include_internal_records):
+        record_filter = get_record_filter()
         data_model = case_based_dm.PersistentQueryDataModel(
             include_internal_records)
 
-        in_mem_dm = case_based_dm.InMemoryQueryDataModel(data_model)
+        in_mem_dm = case_based_dm.InMemoryQueryDataModel(
+            data_model, full_refresh_interval=timedelta(days=1))
+        # The neighbourhood provides the similarities of the neighbours, so
+        # the shingles of the past queries are not cached a second time
         sim = query_based_sim.StringJaccardSimilarity(k_shingles=3)
-        nhood = query_based_nhood.ThresholdQueryNeighbourhood(
-            in_mem_dm, sim, sim_threshold=0.25)
+        nhood = query_based_nhood.ShingleIndexQueryNeighbourhood(
+            in_mem_dm, k_shingles=3, sim_threshold=0.25, max_size=100)
         scorer = query_based_rec.WeightedSumScorer(
             query_based_rec.LogFrequency(base=2))
 
         return query_based_rec.QueryBasedRecommender(
-            in_mem_dm, nhood, sim, scorer)
+            in_mem_dm, nhood, sim, scorer, record_filter=record_filter)
 
     record_based_recsys_factory = record_based_recsys_factory\
         if record_based_recsys_factory else r_based_recsys_factory
@@ -98,23 +235,106 @@ def create_recommender_system(
     query_based_recsys_factory = query_based_recsys_factory\
         if query_based_recsys_factory else q_based_recsys_factory
 
-    with app.app_context():
-        rec_pms = [
-            True,
-            False,
-        ]
-        for include_internal_records in rec_pms:
-            q_based_recsys = query_based_recsys_factory(
-                include_internal_records)
-            r_based_recsys = record_based_recsys_factory(
-                include_internal_records)
-
-            rec_service = Recommender(
+    snapshot_path = app.config.get('RECOMMENDER_SNAPSHOT_PATH')
+    snapshot_max_age = app.config.get('RECOMMENDER_SNAPSHOT_MAX_AGE')
+    if snapshot_max_age is not None:
+        snapshot_max_age = timedelta(seconds=snapshot_max_age)
+    # The creation time of the snapshot that holds the current instances
+    snapshot_state = {'time_created': None}
+
+    def load_recommenders(version, min_time_created):
+        loaded = snapshot.load_snapshot(
+            snapshot_path, snapshot_max_age,
+            min_time_created=min_time_created)
+        if loaded is None:
+            return None
+        header, instances = loaded
+        for recommender in instances.values():
+            recommender.version = version
+        snapshot_state['time_created'] = header.time_created
+        return instances
+
+    def save_recommenders(instances, version):
+        try:
+            header = snapshot.save_snapshot(snapshot_path, instances, version)
+            snapshot_state['time_created'] = header.time_created
+            return True
+        except Exception:
+            logger.exception("Saving the snapshot of the recommenders failed")
+            return False
+
+    def build_recommenders(version):
+        if not snapshot_path:
+            return build_recommenders_from_db(version)
+        instances = load_recommenders(
+            version, min_time_created=snapshot_state['time_created'])
+        if instances is not None:
+            return instances
+        instances = build_recommenders_from_db(version)
+        if save_recommenders(instances, version):
+            # The instances are replaced by the ones of the snapshot so that
+            # their arrays are mapped and shared with the other processes,
+            # e.g., with the workers that are forked from this process
+            instances = load_recommenders(version, None) or instances
+        return instances
+
+    def build_recommenders_from_db(version):
+        instances = {}
+        # Every build loads its own record filter
+        shared_components.clear()
+        with app.app_context():
+            q_based_recsys = query_based_recsys_factory(True)
+            r_based_recsys = record_based_recsys_factory(True)
+            instances[True] = Recommender(
                 query_based_recsys=q_based_recsys,
-                record_based_recsys=r_based_recsys)
-
-            recommender_instances[include_internal_records] =\
-                rec_service
+                record_based_recsys=r_based_recsys,
+                version=version)
+
+            if not filters_internal_records(q_based_recsys):
+                q_based_recsys = query_based_recsys_factory(False)
+            if not filters_internal_records(r_based_recsys):
+                r_based_recsys = record_based_recsys_factory(False)
+            instances[False] = Recommender(
+                query_based_recsys=q_based_recsys,
+                record_based_recsys=r_based_recsys,
+                version=version,
+                include_internal_records=False)
+        shared_components.clear()
+        return instances
+
+    def update_recommenders(instances, version):
+        with app.app_context():
+            # The components are shared by the instances and must only be
+            # refreshed once
+            refreshed_components = set()
+            for recommender in instances.values():
+                recommender.refresh(refreshed_components)
+        # Results that are computed during the refresh are reported and
+        # cached under the previous version
+        for recommender in instances.values():
+            recommender.version = version
+        if snapshot_path:
+            save_recommenders(instances, version)
+
+    global recommender_instances, recommender_builder, recommender_updater
+    with refresh_lock:
+        recommender_builder = build_recommenders
+        recommender_updater = update_recommenders
+        recommender_instances = build_recommenders(
+            get_model_version() + 1)
+
+    refresh_interval = app.config.get('RECOMMENDER_REFRESH_INTERVAL')
+    if refresh_interval is not None:
+        rebuild_interval = app.config.get('RECOMMENDER_REBUILD_INTERVAL')
+        if rebuild_interval is not None:
+            rebuild_interval = timedelta(seconds=rebuild_interval)
+
+        # Threads do not survive a fork, so the refresh is started by the
+        # first request of each process
+        @app.before_first_request
+        def start_refresh():
+            start_background_refresh(
+                timedelta(seconds=refresh_interval), rebuild_interval)
 
 
 class Recommender(Refreshable):
@@ -124,9 +344,24 @@ class Recommender(Refreshable):
     """
 
     def __init__(
-            self, record_based_recsys, query_based_recsys):
+            self, record_based_recsys, query_based_recsys, version=0,
+            include_internal_records=True):
+        """
+        :param record_based_recsys: the record-based recommender
+        :param query_based_recsys: the query-based recommender
+        :param version: the version of the model the recommender is built of
+        :param include_internal_records: indicates if internal records may be
+        recommended. If False, the underlying recommenders are asked to
+        filter them out
+        """
         self.record_based_recsys = record_based_recsys
         self.query_based_recsys = query_based_recsys
+        self.version = version
+        self.include_internal_records = include_internal_records
+        # The internal instance calls the underlying recommenders without
+        # the filter argument
+        self.filter_kwargs = {} if include_internal_records else {
+            'include_internal_records': False}
         self.refresh_helper = RefreshHelper()
         self.refresh_helper.add_dependency(
             record_based_recsys)
@@ -138,9 +373,10 @@ class Recommender(Refreshable):
         Returns a list of queries which are similar to the target query
 
         :param query_string: the query that was entered by the user
+        :param max_num_recs: the maximum number of queries to return
         """
         return self.query_based_recsys.get_similar_queries(
-            query_string, max_num_recs)
+            query_string, max_num_recs, **self.filter_kwargs)
 
     def recommend_search_results(self, query_string, max_num_recs=10):
         """
@@ -150,7 +386,7 @@ class Recommender(Refreshable):
         :param max_num_recs: the maximum number of recommendations to return
         """
         return self.query_based_recsys.recommend_search_results(
-            query_string, max_num_recs)
+            query_string, max_num_recs, **self.filter_kwargs)
 
     def other_users_also_used(self, record_id, max_num_recs=10):
         """
@@ -160,7 +396,7 @@ class Recommender(Refreshable):
         :param max_num_recs: the maximum number of recommendations to return
         """
         return self.record_based_recsys.most_similar_records(
-            record_id, max_num_recs)
+            record_id, max_num_recs, **self.filter_kwargs)
 
     def influenced_by_your_history(self, session_id, max_num_recs=10):
         """
@@ -171,7 +407,7 @@ class Recommender(Refreshable):
         :param max_num_recs: the maximum number of recommendations to return
         """
         return self.record_based_recsys.recommend(
-            session_id, max_num_recs)
+            session_id, max_num_recs, **self.filter_kwargs)
 
     def refresh(self, refreshed_components):
         self.refresh_helper.refresh(refreshed_components)
@@ -16,9 +16,19 @@ from .. import queries
 from ..refreshable import Refreshable
 from ..refreshable import RefreshHelper
 from search_rex.models import ActionType
+from datetime import datetime
 from datetime import timedelta
 from search_rex.util.math_util import exp_decay
 from search_rex.util.date_util import utcnow
+from search_rex.util.date_util import total_microseconds
+from search_rex.util.packed_dict import PackedDict
+from search_rex.util.packed_dict import PackedRows
+from search_rex.util.packed_dict import copy_for_update
+import numpy as np
+
+
+# The time from which the time intervals of the reference times are counted
+EPOCH = datetime(1970, 1, 1)
 
 
 class Hit(object):
@@ -33,6 +43,44 @@ class Hit(object):
         self.num_copies = 0
         self.num_views = 0
 
+    def merge(self, other):
+        """
+        Returns a new hit that combines the values and the counts of this hit
+        and the other one
+        """
+        hit = Hit(
+            self.value + other.value,
+            max(self.last_interaction, other.last_interaction))
+        hit.num_copies = self.num_copies + other.num_copies
+        hit.num_views = self.num_views + other.num_views
+        return hit
+
+
+class HitCodec(object):
+    """
+    Converts the hits of a PackedRows to the value, the time of the last
+    interaction and the counts of copies and views
+    """
+    dtypes = (np.float64, 'datetime64[us]', np.int32, np.int32)
+
+    @staticmethod
+    def encode(hit):
+        return (hit.value, hit.last_interaction, hit.num_copies, hit.num_views)
+
+    @staticmethod
+    def decode(value, last_interaction, num_copies, num_views):
+        hit = Hit(value, last_interaction)
+        hit.num_copies = num_copies
+        hit.num_views = num_views
+        return hit
+
+
+def get_hit_total(hits):
+    """
+    Returns the sum of the hit values of a hit row
+    """
+    return sum(hit.value for hit in hits.itervalues())
+
 
 class AbstractQueryDataModel(Refreshable):
     """
@@ -53,6 +101,15 @@ class AbstractQueryDataModel(Refreshable):
         """
         raise NotImplementedError()
 
+    def get_hit_total(self, query_string):
+        """
+        Returns the sum of the hit values of the query's hit row or None if
+        it has not been computed in advance
+
+        :param query_string: the query of the hit row
+        """
+        return None
+
 
 class PersistentQueryDataModel(AbstractQueryDataModel):
     """
@@ -65,7 +122,8 @@ class PersistentQueryDataModel(AbstractQueryDataModel):
     def __init__(
             self, include_internal_records, copy_action_weight=2.0,
             view_action_weight=1.0, perform_time_decay=True,
-            time_interval=timedelta(days=1), half_life=50, max_age=300):
+            time_interval=timedelta(days=1), half_life=50, max_age=300,
+            aggregate_in_database=False):
         """
         :param include_internal_records: indicates if internal records should
         be included or not
@@ -73,6 +131,9 @@ class PersistentQueryDataModel(AbstractQueryDataModel):
         :param view_action_weight: the weight of a view action
         :param perform_time_decay: indicates if the weight of older actions
         should be decreased
+        :param aggregate_in_database: indicates if the actions should be
+        counted by the database per query, record and time interval instead of
+        being transferred one by one
         """
         self.include_internal_records = include_internal_records
         self.view_action_weight = view_action_weight
@@ -81,39 +142,101 @@ class PersistentQueryDataModel(AbstractQueryDataModel):
         self.time_interval = time_interval
         self.half_life = half_life
         self.max_age = max_age
+        self.aggregate_in_database = aggregate_in_database
 
-    def __get_hits_from_actions(self, actions):
-        hits = {}
-        for action in actions:
-            record = action.record_id
+    def get_hits_from_actions(self, actions, reference_time=None):
+        """
+        Computes the hit row of a query from its actions
 
+        :param actions: the tuples of (record_id, session_id, action_type,
+        time_created) of the query's actions
+        :param reference_time: the point in time relative to which the time
+        decay of the actions is computed
+        """
+        if reference_time is None:
+            reference_time = utcnow()
+        hits = {}
+        # The actions are tuples of (record_id, session_id, action_type,
+        # time_created)
+        for record, _, action_type, time_created in actions:
             hit_value = 0.0
-            if action.action_type == ActionType.view:
+            if action_type == ActionType.view:
                 hit_value = self.view_action_weight
-            elif action.action_type == ActionType.copy:
+            elif action_type == ActionType.copy:
                 hit_value = self.copy_action_weight
 
             if self.perform_time_decay:
                 hit_value = exp_decay(
-                    hit_value, utcnow(), action.time_created,
+                    hit_value, reference_time, time_created,
                     self.time_interval, self.half_life, self.max_age)
 
             if record not in hits:
-                hit = Hit(0.0, action.time_created)
+                hit = Hit(0.0, time_created)
                 hits[record] = hit
             else:
                 hit = hits[record]
 
             hit.value += hit_value
-            if action.time_created > hit.last_interaction:
-                hit.last_interaction = action.time_created
-            if action.action_type == ActionType.view:
+            if time_created > hit.last_interaction:
+                hit.last_interaction = time_created
+            if action_type == ActionType.view:
                 hit.num_views += 1
-            elif action.action_type == ActionType.copy:
+            elif action_type == ActionType.copy:
                 hit.num_copies += 1
 
         return hits
 
+    def __get_decay_factor(self, age):
+        if not self.perform_time_decay or age <= 0:
+            return 1.0
+        if age > self.max_age:
+            return 0.0
+        return 2**(-age/float(self.half_life))
+
+    def __get_hits_from_cells(self, cells):
+        hits = {}
+        # The cells are tuples of (record_id, age, num_views, num_copies,
+        # last_time_created) as returned by get_hit_cells_for_queries
+        for record, age, num_views, num_copies, time_created in cells:
+            hit_value = self.__get_decay_factor(age) * (
+                num_views * self.view_action_weight +
+                num_copies * self.copy_action_weight)
+
+            if record not in hits:
+                hit = Hit(0.0, time_created)
+                hits[record] = hit
+            else:
+                hit = hits[record]
+
+            hit.value += hit_value
+            if time_created > hit.last_interaction:
+                hit.last_interaction = time_created
+            hit.num_views += num_views
+            hit.num_copies += num_copies
+
+        return hits
+
+    def __get_hit_rows(
+            self, query_strings=None, min_time_created=None,
+            max_time_created=None, reference_time=None):
+        if reference_time is None:
+            reference_time = utcnow()
+        if self.aggregate_in_database:
+            for query, cells in queries.get_hit_cells_for_queries(
+                    self.include_internal_records, reference_time,
+                    self.time_interval, query_strings,
+                    min_time_created=min_time_created,
+                    max_time_created=max_time_created):
+                yield (query, self.__get_hits_from_cells(cells))
+        else:
+            for query, actions in queries.get_actions_for_queries(
+                    self.include_internal_records, query_strings,
+                    min_time_created=min_time_created,
+                    max_time_created=max_time_created):
+                yield (
+                    query,
+                    self.get_hits_from_actions(actions, reference_time))
+
     def get_queries(self):
         '''Gets an iterator over all the records'''
         return queries.get_queries()
@@ -125,20 +248,92 @@ class PersistentQueryDataModel(AbstractQueryDataModel):
         :param query_strings: the queries for which the hit rows should be
         returned
         """
-        for query, actions in queries.get_actions_for_queries(
-                self.include_internal_records, target_queries):
-            hits = self.__get_hits_from_actions(actions)
-            yield (query, hits)
+        return self.__get_hit_rows(query_strings=target_queries)
 
     def get_hit_rows(self):
         """
         Retrieves the complete hit matrix consisting of all hit rows
         """
-        for query, actions in queries.get_actions_for_queries(
-                self.include_internal_records):
-            hits = self.__get_hits_from_actions(actions)
+        return self.__get_hit_rows()
 
-            yield (query, hits)
+    def get_hit_rows_since(self, min_time_created, reference_time):
+        """
+        Retrieves the hit rows that consist only of the actions that were
+        created after min_time_created
+
+        :param min_time_created: the time after which the actions were created
+        :param reference_time: the point in time relative to which the time
+        decay of the actions is computed
+        """
+        return self.__get_hit_rows(
+            min_time_created=min_time_created, reference_time=reference_time)
+
+    def get_hit_rows_until(self, max_time_created, reference_time):
+        """
+        Retrieves the complete hit matrix that consists only of the actions
+        that were created at or before max_time_created
+
+        :param max_time_created: the time up to which the actions were created
+        :param reference_time: the point in time relative to which the time
+        decay of the actions is computed
+        """
+        return self.__get_hit_rows(
+            max_time_created=max_time_created, reference_time=reference_time)
+
+    def get_actions_since(self, min_time_created):
+        """
+        Retrieves the actions of each query that were created after
+        min_time_created as tuples of (record_id, session_id, action_type,
+        time_created). The first three fields identify an action
+
+        :param min_time_created: the time after which the actions were created
+        """
+        return queries.get_actions_for_queries(
+            self.include_internal_records, min_time_created=min_time_created)
+
+    def get_reference_time(self, time):
+        """
+        Returns the end of the time interval that contains the given time. The
+        intervals are counted from the EPOCH. All the actions up to the given
+        time are older than the reference time, so the age of an action
+        relative to a later reference time increases by exactly the number of
+        intervals between the two reference times
+        """
+        interval = total_microseconds(self.time_interval)
+        remainder = total_microseconds(time - EPOCH) % interval
+        if remainder == 0:
+            return time
+        return time + timedelta(microseconds=interval - remainder)
+
+    def get_elapsed_intervals(self, since, until):
+        """
+        Returns the number of complete time intervals between since and until
+        """
+        if until <= since:
+            return 0
+        return int(
+            (until - since).total_seconds() //
+            self.time_interval.total_seconds())
+
+    def age_hits(self, hits, num_intervals):
+        """
+        Returns a copy of the hit row whose values are decayed as if they had
+        aged by num_intervals more time intervals. In contrast to a reload,
+        hits are not dropped once they exceed the max_age
+
+        :param hits: a dictionary of record to Hit
+        :param num_intervals: the number of time intervals to age the hits by
+        """
+        if not self.perform_time_decay or num_intervals <= 0:
+            return hits
+        factor = 2**(-num_intervals/float(self.half_life))
+        aged_hits = {}
+        for record, hit in hits.iteritems():
+            aged_hit = Hit(hit.value * factor, hit.last_interaction)
+            aged_hit.num_copies = hit.num_copies
+            aged_hit.num_views = hit.num_views
+            aged_hits[record] = aged_hit
+        return aged_hits
 
     def refresh(self, refreshed_components):
         """
@@ -152,24 +347,174 @@ class InMemoryQueryDataModel(AbstractQueryDataModel):
     """
     This data model retrieves the data from an underlying data model and stores
     the data in a dictionary. Calling refresh, reloads the data
+
+    If a full_refresh_interval is given, a refresh only loads the actions that
+    were created within the overlap_window before the last refresh or later
+    and folds the ones that are not known yet into the affected hit rows. The
+    actions are recognised by their primary key, so actions that are written
+    late, e.g., by a write-behind buffer, are not lost as long as they are not
+    older than the overlap_window. The time decay of the existing hits is
+    applied in memory whenever a complete time interval has passed. The hits
+    are decayed relative to reference times at the end of a time interval,
+    so they have the same values as after a complete reload. As actions that
+    are older than the overlap_window as well as records that were
+    deactivated in the meantime are only taken into account by a complete
+    reload, the whole hit matrix is reloaded once the full_refresh_interval
+    has passed. The incremental refresh requires a PersistentQueryDataModel
+    as underlying data model
     """
 
-    def __init__(self, data_model):
+    def __init__(
+            self, data_model, full_refresh_interval=None,
+            overlap_window=timedelta(minutes=10)):
+        """
+        :param data_model: the underlying data model
+        :param full_refresh_interval: the time after which the complete hit
+        matrix is reloaded. If None, every refresh reloads the complete hit
+        matrix
+        :param overlap_window: the time by which the actions are loaded again
+        on an incremental refresh in order to catch the actions that are
+        written late
+        """
         self.data_model = data_model
+        self.full_refresh_interval = full_refresh_interval
+        self.overlap_window = overlap_window
         self.hit_mat = {}
+        # The sum of the hit values of each hit row
+        self.hit_totals = {}
+        self.watermark = None
+        self.decay_time = None
+        self.last_full_refresh = None
+        # The actions created after window_start are loaded on every
+        # incremental refresh. The ones that are folded in already are stored
+        # in recent_actions by their primary key along with their time
+        self.window_start = None
+        self.recent_actions = {}
         self.refresh_helper = RefreshHelper(
-            target_refresh_function=self.init_model)
+            target_refresh_function=self.update_model)
         self.refresh_helper.add_dependency(data_model)
         self.init_model()
 
     def init_model(self):
+        """
+        Reloads the complete hit matrix
+        """
+        load_time = utcnow()
         hit_mat = {}
-
-        for query, hits in\
-                self.data_model.get_hit_rows():
+        hit_totals = {}
+        watermark = None
+        recent_actions = {}
+
+        if self.full_refresh_interval is None:
+            decay_time = load_time
+            window_start = None
+            hit_rows = self.data_model.get_hit_rows()
+        else:
+            decay_time = self.data_model.get_reference_time(load_time)
+            # The actions of the overlap window are loaded one by one so that
+            # they are known by the incremental refreshes
+            window_start = load_time - self.overlap_window
+            hit_rows = self.data_model.get_hit_rows_until(
+                window_start, decay_time)
+
+        for query, hits in hit_rows:
             hit_mat[query] = hits
+            hit_totals[query] = get_hit_total(hits)
+            for hit in hits.itervalues():
+                if watermark is None or hit.last_interaction > watermark:
+                    watermark = hit.last_interaction
+
+        if window_start is not None:
+            watermark = self.__fold_actions_since(
+                window_start, hit_mat, hit_totals, recent_actions, watermark,
+                decay_time)
+
+        self.hit_mat, self.hit_totals = hit_mat, hit_totals
+        self.watermark = watermark
+        self.decay_time = decay_time
+        self.last_full_refresh = load_time
+        self.window_start = window_start
+        self.recent_actions = recent_actions
+
+    def __fold_actions_since(
+            self, window_start, hit_mat, hit_totals, recent_actions,
+            watermark, reference_time):
+        # Folds the actions created after window_start that are not among the
+        # recent_actions into the hit matrix and returns the new watermark
+        for query, actions in self.data_model.get_actions_since(
+                window_start):
+            new_actions = []
+            for action in actions:
+                key = tuple(action[:3])
+                if key in recent_actions:
+                    continue
+                time_created = action[3]
+                recent_actions[key] = time_created
+                new_actions.append(action)
+                if watermark is None or time_created > watermark:
+                    watermark = time_created
+            if not new_actions:
+                continue
+
+            new_hits = self.data_model.get_hits_from_actions(
+                new_actions, reference_time)
+            hits = dict(hit_mat.get(query, {}))
+            for record, new_hit in new_hits.iteritems():
+                if record in hits:
+                    hits[record] = hits[record].merge(new_hit)
+                else:
+                    hits[record] = new_hit
+            hit_mat[query] = hits
+            hit_totals[query] = get_hit_total(hits)
+        return watermark
 
-        self.hit_mat = hit_mat
+    def update_model(self):
+        """
+        Folds the actions that were created since the last refresh into the
+        hit matrix or reloads the complete hit matrix if the
+        full_refresh_interval has passed
+        """
+        current_time = utcnow()
+        if self.full_refresh_interval is None or\
+                current_time - self.last_full_refresh >=\
+                self.full_refresh_interval:
+            self.init_model()
+            return
+
+        # The rows are replaced instead of modified so that readers never see
+        # a partially updated row
+        hit_mat = copy_for_update(self.hit_mat)
+        hit_totals = copy_for_update(self.hit_totals)
+        recent_actions = dict(self.recent_actions)
+        window_start = self.window_start
+
+        decay_time = self.data_model.get_reference_time(current_time)
+        num_intervals = self.data_model.get_elapsed_intervals(
+            self.decay_time, decay_time)
+        if num_intervals > 0:
+            for query, hits in hit_mat.items():
+                hit_mat[query] = self.data_model.age_hits(hits, num_intervals)
+                hit_totals[query] = get_hit_total(hit_mat[query])
+
+        watermark = self.__fold_actions_since(
+            window_start, hit_mat, hit_totals, recent_actions,
+            self.watermark, decay_time)
+
+        # The actions that are older than the overlap window are not loaded
+        # again, so they need not be known any longer
+        if current_time - self.overlap_window > window_start:
+            window_start = current_time - self.overlap_window
+            recent_actions = {
+                key: time_created
+                for key, time_created in recent_actions.iteritems()
+                if time_created > window_start
+            }
+
+        self.hit_mat, self.hit_totals = hit_mat, hit_totals
+        self.watermark = watermark
+        self.decay_time = decay_time
+        self.window_start = window_start
+        self.recent_actions = recent_actions
 
     def get_queries(self):
         """
@@ -182,8 +527,9 @@ class InMemoryQueryDataModel(AbstractQueryDataModel):
         Retrieves the hit rows of the given queries
         """
         for query in queries:
-            if query in self.hit_mat:
-                yield(query, self.hit_mat[query])
+            hits = self.hit_mat.get(query)
+            if hits is not None:
+                yield(query, hits)
 
     def get_hit_rows(self):
         """
@@ -192,6 +538,26 @@ class InMemoryQueryDataModel(AbstractQueryDataModel):
         for query, hits in self.hit_mat.iteritems():
             yield(query, hits)
 
+    def get_hit_total(self, query_string):
+        """
+        Returns the sum of the hit values of the query's hit row, which is
+        computed whenever the row is loaded
+        """
+        return self.hit_totals.get(query_string)
+
+    def __getstate__(self):
+        """
+        Stores the hit matrix and the hit totals in arrays so that the
+        processes that load a snapshot share their memory. An incremental
+        refresh only keeps the replaced rows in dictionaries
+        """
+        state = dict(self.__dict__)
+        if not isinstance(self.hit_mat, PackedRows):
+            state['hit_mat'] = PackedRows(self.hit_mat.iteritems(), HitCodec)
+        if not isinstance(self.hit_totals, PackedDict):
+            state['hit_totals'] = PackedDict(self.hit_totals.iteritems())
+        return state
+
     def refresh(self, refreshed_components):
         """
         Reloads the data from the data model after its refreshment
@@ -13,6 +13,17 @@ from .. import queries
 from search_rex.models import ActionType
 from ..refreshable import Refreshable
 from ..refreshable import RefreshHelper
+from search_rex.util.date_util import total_microseconds
+from search_rex.util.date_util import utcnow
+from search_rex.util.packed_dict import PackedDict
+from search_rex.util.packed_dict import PackedRows
+from search_rex.util.packed_dict import StringTable
+from search_rex.util.packed_dict import copy_for_update
+from array import array
+from datetime import datetime
+from datetime import timedelta
+import numpy as np
+import math
 
 
 class Preference(object):
@@ -27,6 +38,93 @@ class Preference(object):
         """
         self.value = value
         self.preference_time = preference_time
+        # The index of the time partition if it has been assigned in advance
+        self.time_partition = None
+
+
+class PreferenceCodec(object):
+    """
+    Converts the preferences of a PackedRows to the value, the preference time
+    and the time partition, which is -1 if it has not been assigned
+    """
+    dtypes = (np.float64, 'datetime64[us]', np.int32)
+
+    @staticmethod
+    def encode(preference):
+        time_partition = preference.time_partition
+        return (
+            preference.value, preference.preference_time,
+            -1 if time_partition is None else time_partition)
+
+    @staticmethod
+    def decode(value, preference_time, time_partition):
+        preference = Preference(value, preference_time)
+        if time_partition >= 0:
+            preference.time_partition = time_partition
+        return preference
+
+
+class TimePartitioning(object):
+    """
+    Partitions the preferences by their age into max_age intervals of equal
+    length. Preferences that are older are assigned to the partition max_age
+    """
+
+    def __init__(self, time_interval=timedelta(weeks=8), max_age=12):
+        """
+        :param time_interval: the length of a partition
+        :param max_age: the number of partitions
+        """
+        self.time_interval = time_interval
+        self.max_age = max_age
+        self.interval_microseconds = total_microseconds(time_interval)
+
+    def get_partition(self, preference_time, reference_time):
+        """
+        Returns the index of the partition of the preference time, i.e., the
+        number of full intervals between the preference time and the
+        reference time
+        """
+        age = total_microseconds(reference_time - preference_time)
+        partition = max(age // self.interval_microseconds, 0)
+        return min(partition, self.max_age)
+
+    def get_preference_partition(self, preference, reference_time):
+        """
+        Returns the partition that has been assigned to the preference or
+        else computes it by the reference time
+        """
+        if preference.time_partition is not None:
+            return preference.time_partition
+        return self.get_partition(preference.preference_time, reference_time)
+
+    def assign_partitions(self, preferences, reference_time):
+        """
+        Assigns the partitions to all preferences of the dictionary
+        """
+        for preference in preferences.itervalues():
+            preference.time_partition = self.get_partition(
+                preference.preference_time, reference_time)
+
+
+def get_preference_norm(preferences):
+    """
+    Returns the euclidean norm of the values of a preference vector
+    """
+    return math.sqrt(sum(pref.value**2 for pref in preferences.itervalues()))
+
+
+def get_partition_squares(preferences, num_partitions):
+    """
+    Returns the sums of the squared preference values of each of the first
+    num_partitions time partitions. The partitions must have been assigned to
+    the preferences
+    """
+    squares = [0.0] * num_partitions
+    for pref in preferences.itervalues():
+        if pref.time_partition < num_partitions:
+            squares[pref.time_partition] += pref.value**2
+    return squares
 
 
 class AbstractRecordDataModel(Refreshable):
@@ -58,6 +156,28 @@ class AbstractRecordDataModel(Refreshable):
         """
         raise NotImplementedError()
 
+    def get_touched_records(self):
+        """
+        Returns the records whose preferences have changed with the last
+        refresh or None if any of the records might have changed
+        """
+        return None
+
+    def get_record_norm(self, record_id):
+        """
+        Returns the norm of the record's preference vector or None if it has
+        not been computed in advance
+        """
+        return None
+
+    def get_partition_squares(self, record_id, time_partitioning):
+        """
+        Returns the sums of the squared preference values of the record per
+        time partition or None if they have not been computed in advance by
+        the given time_partitioning
+        """
+        return None
+
 
 class PersistentRecordDataModel(AbstractRecordDataModel):
     """
@@ -85,23 +205,26 @@ class PersistentRecordDataModel(AbstractRecordDataModel):
         """
         return queries.get_records(self.include_internal_records)
 
-    def __get_preferences_from_actions(self, actions, key_func):
+    def __get_preferences_from_actions(self, actions, by_session):
+        # The actions are tuples of (record_id, session_id, action_type,
+        # time_created). The preferences are keyed by the session id if
+        # by_session is set or else by the record id
         preferences = {}
-        for action in actions:
-            key = key_func(action)
+        for record_id, session_id, action_type, time_created in actions:
+            key = session_id if by_session else record_id
             if key not in preferences:
                 pref_value = 0.0
-                if action.action_type == ActionType.view:
+                if action_type == ActionType.view:
                     pref_value = self.view_action_weight
-                elif action.action_type == ActionType.copy:
+                elif action_type == ActionType.copy:
                     pref_value = self.copy_action_weight
 
                 preferences[key] = Preference(
-                    value=pref_value, preference_time=action.time_created)
+                    value=pref_value, preference_time=time_created)
 
-            elif action.action_type == ActionType.copy:
+            elif action_type == ActionType.copy:
                 preferences[key].value = self.copy_action_weight
-                preferences[key].preference_time = action.time_created
+                preferences[key].preference_time = time_created
 
         return preferences
 
@@ -111,7 +234,7 @@ class PersistentRecordDataModel(AbstractRecordDataModel):
         """
         actions = queries.get_actions_of_session(session_id)
         preferences = self.__get_preferences_from_actions(
-            actions, lambda action: action.record_id)
+            actions, by_session=False)
 
         return preferences
 
@@ -121,7 +244,7 @@ class PersistentRecordDataModel(AbstractRecordDataModel):
         """
         actions = queries.get_actions_on_record(record_id)
         preferences = self.__get_preferences_from_actions(
-            actions, lambda action: action.session_id)
+            actions, by_session=True)
 
         return preferences
 
@@ -132,10 +255,62 @@ class PersistentRecordDataModel(AbstractRecordDataModel):
         for record_id, actions in queries.get_actions_on_records(
                 self.include_internal_records):
             preferences = self.__get_preferences_from_actions(
-                actions, lambda action: action.session_id)
+                actions, by_session=True)
+
+            yield (record_id, preferences)
+
+    def get_preferences_for_records_until(self, max_time_created):
+        """
+        Retrieves the preference columns that consist only of the actions
+        that were created at or before max_time_created
+
+        :param max_time_created: the time up to which the actions were created
+        """
+        for record_id, actions in queries.get_actions_on_records(
+                self.include_internal_records,
+                max_time_created=max_time_created):
+            preferences = self.__get_preferences_from_actions(
+                actions, by_session=True)
 
             yield (record_id, preferences)
 
+    def get_actions_since(self, min_time_created):
+        """
+        Retrieves the actions on each record that were created after
+        min_time_created as tuples of (record_id, session_id, action_type,
+        time_created). The first three fields identify an action
+
+        :param min_time_created: the time after which the actions were created
+        """
+        return queries.get_actions_on_records(
+            self.include_internal_records, min_time_created=min_time_created)
+
+    def get_preferences_from_actions(self, actions):
+        """
+        Computes the preference column of a record from its actions
+
+        :param actions: the tuples of (record_id, session_id, action_type,
+        time_created) of the record's actions
+        """
+        return self.__get_preferences_from_actions(actions, by_session=True)
+
+    def merge_preferences(self, preference, new_preference):
+        """
+        Returns the preference that results from the actions of both
+        preferences, where new_preference stems from the newer actions. As
+        with the actions of a single preference, a copy outweighs a view
+
+        :param preference: the existing preference
+        :param new_preference: the preference of the newer actions
+        """
+        if new_preference.value > preference.value:
+            return new_preference
+        if new_preference.value == self.copy_action_weight and\
+                preference.value == self.copy_action_weight and\
+                new_preference.preference_time > preference.preference_time:
+            return new_preference
+        return preference
+
     def refresh(self, refreshed_components):
         """
         No refresh needed as the class works directly on the database
@@ -147,24 +322,230 @@ class InMemoryRecordDataModel(AbstractRecordDataModel):
     """
     This data model retrieves the data from an underlying data model and stores
     the data in a dictionary. Calling refresh, reloads the data
+
+    Besides the record-major matrix, a session-major index referring to the
+    same preference objects is kept so that the preferences of a session can
+    be looked up directly
+
+    If a full_refresh_interval is given, a refresh only loads the actions that
+    were created within the overlap_window before the last refresh or later
+    and merges the ones that are not known yet into the affected rows. The
+    actions are recognised by their primary key, so actions that are written
+    late, e.g., by a write-behind buffer, are not lost as long as they are not
+    older than the overlap_window. The records whose preferences changed are
+    published by get_touched_records. Once the full_refresh_interval has
+    passed, the whole matrix is reloaded so that older late actions and
+    deactivated records are taken into account. The incremental refresh
+    requires a PersistentRecordDataModel as underlying data model
     """
 
-    def __init__(self, data_model):
+    def __init__(
+            self, data_model, fall_back_on_unknown_sessions=False,
+            time_partitioning=None, full_refresh_interval=None,
+            overlap_window=timedelta(minutes=10)):
+        """
+        :param data_model: the data model from which the data is loaded
+        :param fall_back_on_unknown_sessions: indicates if the preferences of
+        sessions that were not present at the last refresh are retrieved from
+        the underlying data model
+        :param time_partitioning: optional TimePartitioning by which the time
+        partitions of the preferences are assigned on every refresh
+        :param full_refresh_interval: the time after which the complete matrix
+        is reloaded. If None, every refresh reloads the complete matrix
+        :param overlap_window: the time by which the actions are loaded again
+        on an incremental refresh in order to catch the actions that are
+        written late
+        """
         self.data_model = data_model
+        self.fall_back_on_unknown_sessions = fall_back_on_unknown_sessions
+        self.time_partitioning = time_partitioning
+        self.full_refresh_interval = full_refresh_interval
+        self.overlap_window = overlap_window
         self.record_session_mat = {}
+        self.session_record_mat = {}
+        # The norms of the records' preference vectors
+        self.record_norms = {}
+        # The squared sums of the records' time partitions
+        self.partition_squares = {}
+        self.watermark = None
+        self.reference_time = None
+        self.touched_records = None
+        # The actions created after window_start are loaded on every
+        # incremental refresh. The ones that are merged already are stored
+        # in recent_actions by their primary key along with their time
+        self.window_start = None
+        self.recent_actions = {}
         self.refresh_helper = RefreshHelper(
-            target_refresh_function=self.init_model)
+            target_refresh_function=self.update_model)
         self.refresh_helper.add_dependency(data_model)
         self.init_model()
 
     def init_model(self):
+        """
+        Reloads the complete session-record matrix
+        """
         record_session_mat = {}
-
-        for record_id, preferences in\
-                self.data_model.get_preferences_for_records():
+        session_record_mat = {}
+        record_norms = {}
+        partition_squares = {}
+        reference_time = utcnow()
+        watermark = None
+        recent_actions = {}
+
+        if self.full_refresh_interval is None:
+            window_start = None
+            record_preferences = self.data_model.get_preferences_for_records()
+        else:
+            # The actions of the overlap window are loaded one by one so that
+            # they are known by the incremental refreshes
+            window_start = reference_time - self.overlap_window
+            record_preferences =\
+                self.data_model.get_preferences_for_records_until(
+                    window_start)
+
+        for record_id, preferences in record_preferences:
+            if self.time_partitioning is not None:
+                self.time_partitioning.assign_partitions(
+                    preferences, reference_time)
             record_session_mat[record_id] = preferences
-
-        self.record_session_mat = record_session_mat
+            self.__compute_norms(
+                record_id, preferences, record_norms, partition_squares)
+            for session_id, preference in preferences.iteritems():
+                if session_id not in session_record_mat:
+                    session_record_mat[session_id] = {}
+                session_record_mat[session_id][record_id] = preference
+                if watermark is None or\
+                        preference.preference_time > watermark:
+                    watermark = preference.preference_time
+
+        if window_start is not None:
+            watermark, _ = self.__merge_actions_since(
+                window_start, record_session_mat, session_record_mat,
+                record_norms, partition_squares, recent_actions, watermark,
+                reference_time)
+
+        self.record_session_mat, self.session_record_mat =\
+            record_session_mat, session_record_mat
+        self.record_norms, self.partition_squares =\
+            record_norms, partition_squares
+        self.watermark = watermark
+        self.reference_time = reference_time
+        self.touched_records = None
+        self.window_start = window_start
+        self.recent_actions = recent_actions
+
+    def __compute_norms(
+            self, record_id, preferences, record_norms, partition_squares):
+        record_norms[record_id] = get_preference_norm(preferences)
+        if self.time_partitioning is not None:
+            partition_squares[record_id] = get_partition_squares(
+                preferences, self.time_partitioning.max_age)
+
+    def __merge_actions_since(
+            self, window_start, record_session_mat, session_record_mat,
+            record_norms, partition_squares, recent_actions, watermark,
+            reference_time):
+        # Merges the actions created after window_start that are not among
+        # the recent_actions into the matrices and returns the new watermark
+        # along with the records whose preferences changed
+        copied_sessions = set()
+        touched_records = set()
+        for record_id, actions in self.data_model.get_actions_since(
+                window_start):
+            new_actions = []
+            for action in actions:
+                key = tuple(action[:3])
+                if key in recent_actions:
+                    continue
+                recent_actions[key] = action[3]
+                new_actions.append(action)
+            if not new_actions:
+                continue
+
+            new_preferences = self.data_model.get_preferences_from_actions(
+                new_actions)
+            if self.time_partitioning is not None:
+                self.time_partitioning.assign_partitions(
+                    new_preferences, reference_time)
+            preferences = dict(record_session_mat.get(record_id, {}))
+            for session_id, new_preference in new_preferences.iteritems():
+                if watermark is None or\
+                        new_preference.preference_time > watermark:
+                    watermark = new_preference.preference_time
+                if session_id in preferences:
+                    preference = self.data_model.merge_preferences(
+                        preferences[session_id], new_preference)
+                    if preference is preferences[session_id]:
+                        continue
+                else:
+                    preference = new_preference
+
+                preferences[session_id] = preference
+                if session_id not in copied_sessions:
+                    session_record_mat[session_id] = dict(
+                        session_record_mat.get(session_id, {}))
+                    copied_sessions.add(session_id)
+                session_record_mat[session_id][record_id] = preference
+                touched_records.add(record_id)
+
+            if record_id in touched_records:
+                record_session_mat[record_id] = preferences
+                self.__compute_norms(
+                    record_id, preferences, record_norms, partition_squares)
+        return watermark, touched_records
+
+    def update_model(self):
+        """
+        Merges the actions that were created since the last refresh into the
+        matrix or reloads the complete matrix if the full_refresh_interval has
+        passed
+        """
+        current_time = utcnow()
+        if self.full_refresh_interval is None or\
+                current_time - self.reference_time >=\
+                self.full_refresh_interval:
+            self.init_model()
+            return
+
+        # The rows are replaced instead of modified so that readers never see
+        # a partially updated row
+        record_session_mat = copy_for_update(self.record_session_mat)
+        session_record_mat = copy_for_update(self.session_record_mat)
+        record_norms = copy_for_update(self.record_norms)
+        partition_squares = copy_for_update(self.partition_squares)
+        recent_actions = dict(self.recent_actions)
+        window_start = self.window_start
+
+        watermark, touched_records = self.__merge_actions_since(
+            window_start, record_session_mat, session_record_mat,
+            record_norms, partition_squares, recent_actions, self.watermark,
+            self.reference_time)
+
+        # The actions that are older than the overlap window are not loaded
+        # again, so they need not be known any longer
+        if current_time - self.overlap_window > window_start:
+            window_start = current_time - self.overlap_window
+            recent_actions = {
+                key: time_created
+                for key, time_created in recent_actions.iteritems()
+                if time_created > window_start
+            }
+
+        self.record_session_mat, self.session_record_mat =\
+            record_session_mat, session_record_mat
+        self.record_norms, self.partition_squares =\
+            record_norms, partition_squares
+        self.watermark = watermark
+        self.touched_records = touched_records
+        self.window_start = window_start
+        self.recent_actions = recent_actions
+
+    def get_touched_records(self):
+        """
+        Returns the records whose preferences have changed with the last
+        refresh or None if the complete matrix has been reloaded
+        """
+        return self.touched_records
 
     def get_records(self):
         """
@@ -176,19 +557,18 @@ class InMemoryRecordDataModel(AbstractRecordDataModel):
         """
         Retrieves the preferences of the session
         """
-        preferences = {}
-        for record_id, rec_prefs in self.record_session_mat.iteritems():
-            if session_id in rec_prefs:
-                preferences[record_id] = rec_prefs[session_id]
-        return preferences
+        preferences = self.session_record_mat.get(session_id)
+        if preferences is not None:
+            return preferences
+        if self.fall_back_on_unknown_sessions:
+            return self.data_model.get_preferences_of_session(session_id)
+        return {}
 
     def get_preferences_for_record(self, record_id):
         """
         Retrieves the preferences for the record
         """
-        if record_id not in self.record_session_mat:
-            return {}
-        return self.record_session_mat[record_id]
+        return self.record_session_mat.get(record_id, {})
 
     def get_preferences_for_records(self):
         """
@@ -197,9 +577,218 @@ class InMemoryRecordDataModel(AbstractRecordDataModel):
         for record_id, preferences in self.record_session_mat.iteritems():
             yield record_id, preferences
 
+    def get_record_norm(self, record_id):
+        """
+        Returns the norm of the record's preference vector, which is computed
+        whenever the preferences of the record are loaded
+        """
+        return self.record_norms.get(record_id)
+
+    def get_partition_squares(self, record_id, time_partitioning):
+        """
+        Returns the sums of the squared preference values of the record per
+        time partition if the partitions are assigned by the given
+        time_partitioning
+        """
+        if time_partitioning is not self.time_partitioning:
+            return None
+        return self.partition_squares.get(record_id)
+
+    def __getstate__(self):
+        """
+        Stores the matrices, the norms and the partition squares in arrays so
+        that the processes that load a snapshot share their memory. An
+        incremental refresh only keeps the replaced rows in dictionaries
+        """
+        state = dict(self.__dict__)
+        for name in ['record_session_mat', 'session_record_mat']:
+            if not isinstance(state[name], PackedRows):
+                state[name] = PackedRows(
+                    state[name].iteritems(), PreferenceCodec)
+        for name in ['record_norms', 'partition_squares']:
+            if not isinstance(state[name], PackedDict):
+                state[name] = PackedDict(state[name].iteritems())
+        return state
+
     def refresh(self, refreshed_components):
         """
         No refresh needed as the class works directly on the database
         """
         self.refresh_helper.refresh(refreshed_components)
         refreshed_components.add(self)
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_microseconds(preference_time):
+    """
+    Converts the preference time to the number of microseconds since the epoch
+    """
+    return total_microseconds(preference_time - EPOCH)
+
+
+class RecordSessionMatrix(object):
+    """
+    The session-record matrix in a compressed sparse form. The record and the
+    session ids are stored in StringTables, which map them to consecutive
+    integers. The preferences of the records are stored record by record
+    (CSR) in the arrays indptr, indices, values and times. The session-major
+    form (CSC) consists of the arrays session_indptr and session_records as
+    well as session_order which points to the entries of values and times.
+    """
+
+    def __init__(
+            self, record_ids, session_ids, indptr, indices, values, times):
+        """
+        :param record_ids: the list of the record ids by their index
+        :param session_ids: the list of the session ids by their index
+        :param indptr: the preferences of record i are stored in the range
+        indptr[i] to indptr[i+1]
+        :param indices: the session index of each preference
+        :param values: the value of each preference
+        :param times: the preference time of each preference
+        """
+        self.record_ids = StringTable(record_ids)
+        self.session_ids = StringTable(session_ids)
+        self.indptr = indptr
+        self.indices = indices
+        self.values = values
+        self.times = times
+
+        num_sessions = len(session_ids)
+        self.session_order = np.argsort(indices, kind='mergesort')
+        self.session_records = np.repeat(
+            np.arange(len(record_ids), dtype=np.int32),
+            np.diff(indptr))[self.session_order]
+        self.session_indptr = np.zeros(num_sessions+1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(indices, minlength=num_sessions),
+            out=self.session_indptr[1:])
+
+    @classmethod
+    def from_preferences(cls, record_preferences):
+        """
+        Builds the matrix from an iterator over the records and their
+        preference dictionaries
+
+        The entries are collected in compact arrays so that no intermediate
+        object per preference needs to be kept
+        """
+        record_ids = []
+        session_ids = []
+        session_index = {}
+        indptr = array('l', [0])
+        indices = array('i')
+        values = array('d')
+        times = array('d')
+        for record_id, preferences in record_preferences:
+            record_ids.append(record_id)
+            for session_id, pref in preferences.iteritems():
+                s_idx = session_index.get(session_id)
+                if s_idx is None:
+                    s_idx = len(session_ids)
+                    session_index[session_id] = s_idx
+                    session_ids.append(session_id)
+                indices.append(s_idx)
+                values.append(pref.value)
+                times.append(to_microseconds(pref.preference_time))
+            indptr.append(len(indices))
+
+        return cls(
+            record_ids, session_ids,
+            np.frombuffer(indptr, dtype=np.int_).astype(np.int64),
+            np.frombuffer(indices, dtype=np.intc).astype(np.int32),
+            np.frombuffer(values, dtype=np.float64).copy(),
+            np.frombuffer(times, dtype=np.float64).astype(
+                np.int64).view('datetime64[us]'))
+
+    def __get_preferences(self, keys, positions):
+        values = self.values[positions].tolist()
+        times = self.times[positions].astype(object).tolist()
+        return {
+            key: Preference(value, preference_time)
+            for key, value, preference_time in zip(keys, values, times)
+        }
+
+    def get_preferences_for_record(self, record_id):
+        """
+        Retrieves the preferences for the record
+        """
+        r_idx = self.record_ids.get_index(record_id)
+        if r_idx is None:
+            return {}
+        start, end = self.indptr[r_idx], self.indptr[r_idx+1]
+        session_ids = self.session_ids
+        return self.__get_preferences(
+            [session_ids[s_idx]
+             for s_idx in self.indices[start:end].tolist()],
+            slice(start, end))
+
+    def get_preferences_of_session(self, session_id):
+        """
+        Retrieves the preferences of the session
+        """
+        s_idx = self.session_ids.get_index(session_id)
+        if s_idx is None:
+            return {}
+        start, end = self.session_indptr[s_idx], self.session_indptr[s_idx+1]
+        record_ids = self.record_ids
+        return self.__get_preferences(
+            [record_ids[r_idx]
+             for r_idx in self.session_records[start:end].tolist()],
+            self.session_order[start:end])
+
+
+class SparseRecordDataModel(AbstractRecordDataModel):
+    """
+    This data model retrieves the data from an underlying data model and stores
+    it in a RecordSessionMatrix. It needs far less memory than the
+    InMemoryRecordDataModel, but creates the preference dictionaries on
+    access. Calling refresh, reloads the data
+    """
+
+    def __init__(self, data_model):
+        self.data_model = data_model
+        self.matrix = RecordSessionMatrix.from_preferences([])
+        self.refresh_helper = RefreshHelper(
+            target_refresh_function=self.init_model)
+        self.refresh_helper.add_dependency(data_model)
+        self.init_model()
+
+    def init_model(self):
+        self.matrix = RecordSessionMatrix.from_preferences(
+            self.data_model.get_preferences_for_records())
+
+    def get_records(self):
+        """
+        Gets an iterator over all the records
+        """
+        return self.matrix.record_ids
+
+    def get_preferences_of_session(self, session_id):
+        """
+        Retrieves the preferences of the session
+        """
+        return self.matrix.get_preferences_of_session(session_id)
+
+    def get_preferences_for_record(self, record_id):
+        """
+        Retrieves the preferences for the record
+        """
+        return self.matrix.get_preferences_for_record(record_id)
+
+    def get_preferences_for_records(self):
+        """
+        Retrieves the preference columns of all records
+        """
+        matrix = self.matrix
+        for record_id in matrix.record_ids:
+            yield record_id, matrix.get_preferences_for_record(record_id)
+
+    def refresh(self, refreshed_components):
+        """
+        Reloads the data from the data model after its refreshment
+        """
+        self.refresh_helper.refresh(refreshed_components)
+        refreshed_components.add(self)
@@ -3,22 +3,84 @@ In this module, the classes for forming the queries' neighbourhoods are
 implemented. The main class in this module is the QueryNeighbourhood. For a
 target query, this class searches for past queries that are similar to the
 target one. This is achieved by using a class for calculating the similarity of
-two queries.
+two queries. The ShingleIndexQueryNeighbourhood forms the same neighbourhood
+for the jaccard similarity of the queries' shingles, but looks up the
+candidates in an inverted index instead of scanning all past queries. Finally,
+the MinHashQueryNeighbourhood approximates this neighbourhood by locality
+sensitive hashing for query logs that are too large for an exact index.
+
+All neighbourhoods return the neighbours together with their similarity to
+the target query so that the similarities need not be computed again. The
+size of a neighbourhood can be limited, in which case only the most similar
+neighbours are kept.
 """
 
 from ..refreshable import Refreshable
 from ..refreshable import RefreshHelper
+from ..similarity.case_based import shingle
+from search_rex.util.sort_util import top_k
+from search_rex.util.packed_dict import StringTable
+from collections import defaultdict
+from binascii import crc32
+import numpy as np
+import random
+
+
+def get_max_size(max_size, other_max_size):
+    """
+    Returns the smaller one of two maximum sizes, where None means unlimited
+    """
+    if max_size is None:
+        return other_max_size
+    if other_max_size is None:
+        return max_size
+    return min(max_size, other_max_size)
 
 
 class AbstractQueryNeighbourhood(Refreshable):
     """
     Retrieves the neighbours of a particular query
     """
+    # The maximum number of neighbours, None if the size is unlimited
+    max_size = None
+
+    def iter_scored_neighbours(self, query_string):
+        """
+        Iterates over the tuples of query and similarity of the neighbours of
+        the given query in an arbitrary order
+        """
+        raise NotImplementedError()
+
+    def get_scored_neighbours(
+            self, query_string, max_size=None, query_filter=None):
+        """
+        Retrieves a list of tuples of query and similarity of the neighbours
+        of the given query in the descending order of their similarity
+
+        :param query_string: the target query
+        :param max_size: the maximum number of neighbours to return. The
+        neighbourhood's own maximum size applies in any case
+        :param query_filter: optional function that tells if a query may be
+        a neighbour. The queries are filtered before the size is limited, so
+        the rejected queries do not take the places of other neighbours
+        """
+        scored_nbours = self.iter_scored_neighbours(query_string)
+        if query_filter is not None:
+            scored_nbours = (
+                (nbour, sim) for nbour, sim in scored_nbours
+                if query_filter(nbour)
+            )
+        return top_k(
+            scored_nbours, get_max_size(self.max_size, max_size),
+            key=lambda (_, sim): sim)
 
-    def get_neighbours(self, query_string):
+    def get_neighbours(self, query_string, max_size=None, query_filter=None):
         '''Retrieves a list of queries that belong to the neighbourhood of
         the given query'''
-        raise NotImplementedError()
+        return [
+            nbour for nbour, _ in self.get_scored_neighbours(
+                query_string, max_size, query_filter)
+        ]
 
 
 class ThresholdQueryNeighbourhood(AbstractQueryNeighbourhood):
@@ -28,25 +90,384 @@ class ThresholdQueryNeighbourhood(AbstractQueryNeighbourhood):
     a given query similarity metric
     """
 
-    def __init__(self, data_model, query_sim, sim_threshold):
+    def __init__(self, data_model, query_sim, sim_threshold, max_size=None):
         self.data_model = data_model
         self.query_sim = query_sim
         self.sim_threshold = sim_threshold
+        self.max_size = max_size
         self.refresh_helper = RefreshHelper()
         self.refresh_helper.add_dependency(data_model)
         self.refresh_helper.add_dependency(query_sim)
 
-    def get_neighbours(self, query_string):
+    def iter_scored_neighbours(self, query_string):
         """
-        Returns the queries whose similarity to the target query is higher than
-        the specified threshold
+        Iterates over the queries whose similarity to the target query is
+        higher than the specified threshold
         """
         for other_q_string in self.data_model.get_queries():
             similarity = self.query_sim.get_similarity(
                 query_string, other_q_string)
 
             if similarity >= self.sim_threshold:
-                yield other_q_string
+                yield other_q_string, similarity
+
+    def refresh(self, refreshed_components):
+        self.refresh_helper.refresh(refreshed_components)
+        refreshed_components.add(self)
+
+
+class ShingleIndex(object):
+    """
+    An inverted index that maps each shingle to the queries containing it.
+    The postings of all shingles are concatenated in the array posting_ids,
+    such that the postings of shingle i occupy the range indptr[i] to
+    indptr[i+1]. The postings of a shingle are sorted by the number of
+    shingles of the queries so that queries of a specific size range can be
+    looked up by bisection. As the index consists of arrays only, the
+    processes that load it from a snapshot share its memory
+    """
+
+    def __init__(self, query_strings, k_shingles):
+        """
+        :param query_strings: the queries to be indexed
+        :param k_shingles: the size of the shingles
+        """
+        self.k_shingles = k_shingles
+        indexed_queries = []
+        query_sizes = []
+        postings = defaultdict(list)
+        for query_id, query_string in enumerate(query_strings):
+            shingles = shingle(query_string, k_shingles)
+            indexed_queries.append(query_string)
+            query_sizes.append(len(shingles))
+            for q_shingle in shingles:
+                postings[q_shingle].append(query_id)
+        self.query_strings = StringTable(indexed_queries)
+        self.query_sizes = np.array(query_sizes, dtype=np.int32)
+
+        shingles = list(postings)
+        self.shingles = StringTable(shingles)
+        self.indptr = np.zeros(len(shingles)+1, dtype=np.int64)
+        np.cumsum(
+            [len(postings[q_shingle]) for q_shingle in shingles],
+            out=self.indptr[1:])
+        self.posting_ids = np.empty(self.indptr[-1], dtype=np.int32)
+        for i, q_shingle in enumerate(shingles):
+            query_ids = np.array(postings[q_shingle], dtype=np.int32)
+            order = np.argsort(self.query_sizes[query_ids], kind='mergesort')
+            self.posting_ids[self.indptr[i]:self.indptr[i+1]] =\
+                query_ids[order]
+        self.posting_sizes = self.query_sizes[self.posting_ids]
+
+    def get_overlaps(self, shingles, min_size, max_size):
+        """
+        Counts the number of shingles that each indexed query has in common
+        with the given shingles. Only queries whose number of shingles lies in
+        the range of min_size and max_size are considered. Returns the array
+        of the ids of the queries sharing at least one shingle and the array
+        of their overlaps
+
+        :param shingles: the shingles of the target query
+        :param min_size: the minimum number of shingles of a candidate
+        :param max_size: the maximum number of shingles of a candidate
+        """
+        postings = []
+        for q_shingle in shingles:
+            i = self.shingles.get_index(q_shingle)
+            if i is None:
+                continue
+            start, end = self.indptr[i], self.indptr[i+1]
+            sizes = self.posting_sizes[start:end]
+            first = start + sizes.searchsorted(min_size, side='left')
+            last = start + sizes.searchsorted(max_size, side='right')
+            postings.append(self.posting_ids[first:last])
+        if not postings:
+            return (
+                np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64))
+        # A query occurs at most once in the postings of a shingle, so the
+        # number of its occurrences is its overlap
+        return np.unique(np.concatenate(postings), return_counts=True)
+
+
+class ShingleIndexQueryNeighbourhood(AbstractQueryNeighbourhood):
+    """
+    Forms the same neighbourhood as the ThresholdQueryNeighbourhood with a
+    StringJaccardSimilarity. Instead of comparing the target query with every
+    past query, only the queries sharing at least one shingle with the target
+    are scored. Further, queries whose number of shingles cannot reach the
+    threshold are pruned by the length bound of the Jaccard coefficient:
+
+    |Y| * t <= |X| <= |Y| / t
+    """
+
+    def __init__(self, data_model, k_shingles, sim_threshold, max_size=None):
+        """
+        :param data_model: the data model from which the queries are retrieved
+        :param k_shingles: the size of the shingles
+        :param sim_threshold: the minimum jaccard similarity of a neighbour
+        :param max_size: the maximum number of neighbours. If given, only the
+        most similar queries are kept
+        """
+        self.data_model = data_model
+        self.k_shingles = k_shingles
+        self.sim_threshold = sim_threshold
+        self.max_size = max_size
+        self.index = ShingleIndex([], k_shingles)
+        self.refresh_helper = RefreshHelper(
+            target_refresh_function=self.init_index)
+        self.refresh_helper.add_dependency(data_model)
+        self.init_index()
+
+    def init_index(self):
+        self.index = ShingleIndex(
+            self.data_model.get_queries(), self.k_shingles)
+
+    def iter_scored_neighbours(self, query_string):
+        """
+        Iterates over the queries whose jaccard similarity to the target query
+        is higher than the specified threshold
+        """
+        index = self.index
+        shingles = shingle(query_string, self.k_shingles)
+        num_shingles = len(shingles)
+        if self.sim_threshold <= 0.0:
+            min_size, max_size = 0, float('inf')
+        else:
+            # A small tolerance prevents rounding errors from pruning queries
+            # that lie exactly on the bound
+            min_size = num_shingles * self.sim_threshold - 1e-9
+            max_size = num_shingles / self.sim_threshold + 1e-9
+
+        query_ids, overlaps = index.get_overlaps(
+            shingles, min_size, max_size)
+        unions = num_shingles + index.query_sizes[query_ids] - overlaps
+        similarities = overlaps / unions.astype(np.float64)
+        matches = similarities >= self.sim_threshold
+        for query_id, similarity in zip(
+                query_ids[matches].tolist(), similarities[matches].tolist()):
+            yield index.query_strings[query_id], similarity
+
+        if self.sim_threshold <= 0.0:
+            # The queries without a shared shingle are neighbours as well
+            overlapping = np.zeros(len(index.query_strings), dtype=bool)
+            overlapping[query_ids] = True
+            for query_id, other_q_string in enumerate(index.query_strings):
+                if not overlapping[query_id]:
+                    yield other_q_string, 0.0
+
+    def refresh(self, refreshed_components):
+        self.refresh_helper.refresh(refreshed_components)
+        refreshed_components.add(self)
+
+
+def hash_shingle(q_shingle):
+    """
+    Maps a shingle to a 32 bit integer that, unlike the built-in hash, is the
+    same in every process
+    """
+    if isinstance(q_shingle, unicode):
+        q_shingle = q_shingle.encode('utf-8')
+    return crc32(q_shingle) & 0xffffffff
+
+
+class MinHasher(object):
+    """
+    Computes the MinHash signature of a set of shingles. The probability that
+    two signatures agree in a component equals the jaccard similarity of the
+    two sets
+
+    The hash functions (a*x + b) mod p are evaluated by numpy for all the
+    shingles of many queries at once. As the prime is smaller than 2**31,
+    the products fit into unsigned 64 bit integers
+    """
+    # A Mersenne prime whose products with the reduced shingle hashes do not
+    # overflow 64 bits
+    prime = (1 << 31) - 1
+    # The maximum number of shingles whose hashes are evaluated at once
+    chunk_size = 20000
+
+    def __init__(self, num_hashes, seed=1):
+        """
+        :param num_hashes: the number of hash functions, i.e., the length of
+        the signature
+        :param seed: the seed of the random hash function parameters
+        """
+        rand = random.Random(seed)
+        self.num_hashes = num_hashes
+        self.a = np.array(
+            [rand.randint(1, self.prime-1) for _ in xrange(num_hashes)],
+            dtype=np.uint64)
+        self.b = np.array(
+            [rand.randint(0, self.prime-1) for _ in xrange(num_hashes)],
+            dtype=np.uint64)
+
+    def get_signature(self, shingles):
+        """
+        Computes the MinHash signature of the shingles
+        """
+        return self.get_signatures([shingles])[0]
+
+    def get_signatures(self, shingle_sets):
+        """
+        Computes the MinHash signatures of a list of shingle sets. Returns an
+        array with one row per set. The signature of an empty set consists of
+        the prime only
+        """
+        signatures = np.full(
+            (len(shingle_sets), self.num_hashes), self.prime, dtype=np.uint64)
+        start = 0
+        while start < len(shingle_sets):
+            hashes = []
+            offsets = []
+            rows = []
+            end = start
+            while end < len(shingle_sets) and\
+                    (end == start or len(hashes) < self.chunk_size):
+                if shingle_sets[end]:
+                    offsets.append(len(hashes))
+                    rows.append(end)
+                    hashes.extend(
+                        hash_shingle(q_shingle)
+                        for q_shingle in shingle_sets[end])
+                end += 1
+            if rows:
+                hashes = np.array(hashes, dtype=np.uint64) %\
+                    np.uint64(self.prime)
+                values = (
+                    self.a[:, np.newaxis] * hashes[np.newaxis, :] +
+                    self.b[:, np.newaxis]) % np.uint64(self.prime)
+                signatures[rows] = np.minimum.reduceat(
+                    values, offsets, axis=1).T
+            start = end
+        return signatures
+
+
+class MinHashQueryNeighbourhood(AbstractQueryNeighbourhood):
+    """
+    Approximates the neighbourhood of the ShingleIndexQueryNeighbourhood by
+    locality sensitive hashing. The MinHash signature of every past query is
+    split into num_bands bands of rows_per_band rows and each band is hashed
+    into a bucket. Queries that share a bucket with the target in at least one
+    band are verified by their exact jaccard similarity. Hence, no query below
+    the threshold is returned, but a query of similarity s is missed with the
+    probability 1 - get_detection_probability(s)
+
+    The buckets of a band are stored as the sorted array of the band keys of
+    all queries along with the ids of the queries, so the queries of a bucket
+    are looked up by bisection. On refresh, only the queries that are new to
+    the data model are hashed, whereas the signatures of the known queries
+    are reused
+    """
+
+    def __init__(
+            self, data_model, k_shingles, sim_threshold,
+            num_bands=20, rows_per_band=5, seed=1, max_size=None):
+        """
+        :param data_model: the data model from which the queries are retrieved
+        :param k_shingles: the size of the shingles
+        :param sim_threshold: the minimum jaccard similarity of a neighbour
+        :param num_bands: the number of bands the signatures are split into
+        :param rows_per_band: the number of signature components per band
+        :param seed: the seed of the MinHash functions
+        :param max_size: the maximum number of neighbours. If given, only the
+        most similar queries are kept
+        """
+        self.data_model = data_model
+        self.k_shingles = k_shingles
+        self.sim_threshold = sim_threshold
+        self.num_bands = num_bands
+        self.rows_per_band = rows_per_band
+        self.max_size = max_size
+        self.min_hasher = MinHasher(num_bands * rows_per_band, seed)
+        # The multipliers that combine the rows of a band into its key
+        rand = random.Random(seed)
+        self.band_multipliers = np.array(
+            [rand.getrandbits(63) | 1 for _ in xrange(rows_per_band)],
+            dtype=np.uint64)
+        self.query_strings = StringTable([])
+        self.signatures = np.zeros(
+            (0, num_bands * rows_per_band), dtype=np.uint64)
+        self.band_buckets = []
+        self.refresh_helper = RefreshHelper(
+            target_refresh_function=self.init_buckets)
+        self.refresh_helper.add_dependency(data_model)
+        self.init_buckets()
+
+    def get_detection_probability(self, similarity):
+        """
+        Returns the probability that a query of the given jaccard similarity
+        to the target shares at least one bucket with the target
+        """
+        return 1.0 - (
+            1.0 - similarity**self.rows_per_band)**self.num_bands
+
+    def __get_band_keys(self, signatures):
+        bands = signatures.reshape(
+            (len(signatures), self.num_bands, self.rows_per_band))
+        # The products wrap around modulo 2**64
+        return (bands * self.band_multipliers).sum(axis=2, dtype=np.uint64)
+
+    def init_buckets(self):
+        query_strings = list(self.data_model.get_queries())
+        old_query_strings, old_signatures =\
+            self.query_strings, self.signatures
+
+        known_rows = []
+        old_rows = []
+        new_rows = []
+        for query_id, query_string in enumerate(query_strings):
+            old_query_id = old_query_strings.get_index(query_string)
+            if old_query_id is None:
+                new_rows.append(query_id)
+            else:
+                known_rows.append(query_id)
+                old_rows.append(old_query_id)
+
+        signatures = np.empty(
+            (len(query_strings), self.min_hasher.num_hashes),
+            dtype=np.uint64)
+        if known_rows:
+            signatures[known_rows] = old_signatures[old_rows]
+        if new_rows:
+            signatures[new_rows] = self.min_hasher.get_signatures([
+                shingle(query_strings[query_id], self.k_shingles)
+                for query_id in new_rows
+            ])
+
+        band_keys = self.__get_band_keys(signatures)
+        band_buckets = []
+        for band in xrange(self.num_bands):
+            order = np.argsort(band_keys[:, band], kind='mergesort')
+            band_buckets.append((band_keys[order, band], order))
+
+        self.query_strings, self.signatures, self.band_buckets = (
+            StringTable(query_strings), signatures, band_buckets)
+
+    def iter_scored_neighbours(self, query_string):
+        """
+        Iterates over the queries that share a bucket with the target query
+        and whose jaccard similarity to it is higher than the specified
+        threshold
+        """
+        query_strings, band_buckets = self.query_strings, self.band_buckets
+        shingles = shingle(query_string, self.k_shingles)
+        band_keys = self.__get_band_keys(
+            self.min_hasher.get_signatures([shingles]))[0]
+
+        candidates = set()
+        for (keys, query_ids), band_key in zip(band_buckets, band_keys):
+            start = np.searchsorted(keys, band_key, side='left')
+            end = np.searchsorted(keys, band_key, side='right')
+            candidates.update(query_ids[start:end].tolist())
+
+        for query_id in candidates:
+            other_q_string = query_strings[query_id]
+            other_shingles = shingle(other_q_string, self.k_shingles)
+            overlap = len(shingles & other_shingles)
+            union = len(shingles) + len(other_shingles) - overlap
+            similarity = float(overlap) / union
+            if similarity >= self.sim_threshold:
+                yield other_q_string, similarity
 
     def refresh(self, refreshed_components):
         self.refresh_helper.refresh(refreshed_components)
@@ -2,13 +2,30 @@
 In this module, the classes for forming the records' neighbourhoods are
 implemented. The main class in this module is the InMemoryRecordNeighbourhood.
 This class calculates the neighbourhood of each record and stores it in the
-local memory.
+local memory. If the record similarity supports it, the similarities of all
+record pairs are computed as sparse matrix products, one block of rows at a
+time, and the neighbours of a block are selected before the next block is
+computed. If the data model publishes the records that were touched by its
+last refresh, only the neighbourhoods that are affected by these records are
+recomputed.
+
+The neighbourhoods return the neighbours together with the similarities they
+have been selected by so that the recommenders need not compute them again.
 """
 
 from ..similarity.item_based import AbstractRecordSimilarity
 from ..refreshable import Refreshable
 from ..refreshable import RefreshHelper
+from search_rex.util.sort_util import top_k
+from search_rex.util.packed_dict import PackedRows
+from search_rex.util.packed_dict import copy_for_update
+from search_rex.util.packed_dict import get_row_value
 import math
+import logging
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
 
 
 class AbstractRecordNeighbourhood(Refreshable):
@@ -16,35 +33,65 @@ class AbstractRecordNeighbourhood(Refreshable):
     Retrieves the neighbours of a record
     """
 
-    def get_neighbours(self, record_id):
+    def get_scored_neighbours(self, record_id, include_internal_records=True):
+        """
+        Retrieves the tuples of neighbour and similarity of the record in the
+        descending order of the similarity
+
+        :param record_id: the id of the record
+        :param include_internal_records: indicates if internal records may be
+        returned as neighbours
+        """
         raise NotImplementedError()
 
+    def get_neighbours(self, record_id, include_internal_records=True):
+        """
+        Retrieves the neighbours of the record
+
+        :param record_id: the id of the record
+        :param include_internal_records: indicates if internal records may be
+        returned as neighbours
+        """
+        return [
+            nbour for nbour, _ in self.get_scored_neighbours(
+                record_id, include_internal_records)
+        ]
+
 
 class KNearestRecordNeighbourhood(AbstractRecordNeighbourhood):
     """
     Retrieves k records that are most similar to the given record
     """
 
-    def __init__(self, k, data_model, record_sim):
+    def __init__(self, k, data_model, record_sim, record_filter=None):
         """
         :param k: the number of records that belong to the neighbourhood of a
         target record
         :param data_model: the data model from which the records are retrieved
         :param record_sim: the object for calculating the record similarities
+        :param record_filter: the InternalRecordFilter that is used for
+        filtering out the internal records if the data model includes them
         """
         self.k = k
         self.data_model = data_model
         self.record_sim = record_sim
+        self.record_filter = record_filter
         self.refresh_helper = RefreshHelper()
         self.refresh_helper.add_dependency(data_model)
         self.refresh_helper.add_dependency(record_sim)
+        if record_filter is not None:
+            self.refresh_helper.add_dependency(record_filter)
 
-    def get_neighbours(self, record_id):
+    def get_scored_neighbours(self, record_id, include_internal_records=True):
         """
-        Retrieves k records that are most similar to the given record
+        Retrieves k records that are most similar to the given record along
+        with their similarity
         """
+        records = self.data_model.get_records()
+        if not include_internal_records and self.record_filter is not None:
+            records = self.record_filter.filter_records(records, False)
         candidates = {}
-        for other_record in self.data_model.get_records():
+        for other_record in records:
             similarity = self.record_sim.get_similarity(
                 record_id, other_record)
             if math.isnan(similarity):
@@ -55,73 +102,247 @@ class KNearestRecordNeighbourhood(AbstractRecordNeighbourhood):
                 continue
             candidates[other_record] = similarity
 
-        candidates_by_score = sorted(
-            candidates.iteritems(), key=lambda (r_id, sim): sim,
-            reverse=True)[:self.k]
-
-        return [r_id for r_id, sim in candidates_by_score]
+        return top_k(
+            candidates.iteritems(), self.k, key=lambda (r_id, sim): sim)
 
     def refresh(self, refreshed_components):
         self.refresh_helper.refresh(refreshed_components)
         refreshed_components.add(self)
 
 
+def get_reverse_nbours(nbours_dict):
+    """
+    Maps each record to the records having it among their neighbours
+    """
+    reverse_nbours = {}
+    for record, nbours in nbours_dict.iteritems():
+        for nbour in nbours:
+            reverse_nbours.setdefault(nbour, set()).add(record)
+    return reverse_nbours
+
+
 class InMemoryRecordNeighbourhood(
         AbstractRecordNeighbourhood, AbstractRecordSimilarity):
     """
     Stores for each record the a maximum number of nearest neighbours
+
+    If the data model reports the records that have been touched by its last
+    refresh, only the neighbours of the touched records and of the records
+    having a touched record among their neighbours are recomputed. The
+    records that share a session with a touched record are offered the new
+    similarities to the touched records. This assumes that the similarities
+    of the other record pairs did not change in between, which holds for
+    similarities computed on the preferences of the data model
     """
 
     def __init__(
             self, data_model, record_sim, max_num_nbours=100,
-            nhood_factory=lambda dm, sim, num_nh:
-            KNearestRecordNeighbourhood(num_nh, dm, sim)):
+            nhood_factory=None, record_filter=None, block_size=1000):
         """
         :param data_model: the data model from which the records are retrieved
         :param record_sim: the object for calculating the record similarities
-        :param max_sims_per_record: the maximum numbers of similarities to be
+        :param max_num_nbours: the maximum numbers of neighbours to be
         stored per record
-        :param nhood_factory: factory method for creating the neighbourhood
-        object
+        :param nhood_factory: optional factory method for creating the
+        neighbourhood object. If it is not given, the neighbours are taken
+        from the similarity matrix of the records, or else from a
+        KNearestRecordNeighbourhood if the record similarity cannot be
+        computed in batch
+        :param block_size: the number of rows of the similarity matrix that
+        are computed at once. The neighbours of a block are selected before
+        the next block is computed, so the whole matrix is never held in
+        memory
+        :param record_filter: the InternalRecordFilter that is used for
+        filtering out the internal records if the data model includes them.
+        The internal records are removed from the stored neighbours, so an
+        external record may have less than max_num_nbours neighbours
         """
         self.data_model = data_model
         self.record_sim = record_sim
         self.nhood_factory = nhood_factory
         self.max_num_nbours = max_num_nbours
+        self.record_filter = record_filter
+        self.block_size = block_size
 
         self.nbours_dict = {}
+        # Maps each record to the records having it among their neighbours.
+        # It is None if the neighbourhood was loaded from a snapshot
+        self.reverse_nbours = {}
 
         self.refresh_helper = RefreshHelper(
-            target_refresh_function=self.init_similarities)
+            target_refresh_function=self.update_similarities)
         self.refresh_helper.add_dependency(data_model)
         self.refresh_helper.add_dependency(record_sim)
+        if record_filter is not None:
+            self.refresh_helper.add_dependency(record_filter)
 
         self.init_similarities()
 
     def init_similarities(self):
-        record_nhood = self.nhood_factory(
+        nbours_dict = None
+        if self.nhood_factory is None:
+            nbours_dict = self.__get_nbours_from_similarity_matrix()
+
+        if nbours_dict is None:
+            nbours_dict = self.__get_nbours_from_nhood()
+
+        self.nbours_dict = nbours_dict
+        self.reverse_nbours = get_reverse_nbours(nbours_dict)
+
+    def update_similarities(self):
+        """
+        Recomputes the neighbourhoods that are affected by the records the
+        data model has touched or all of them if it does not know them
+        """
+        touched_records = self.data_model.get_touched_records()
+        if touched_records is None:
+            self.init_similarities()
+            return
+
+        nbours_dict = copy_for_update(self.nbours_dict)
+        reverse_nbours = self.reverse_nbours
+        if reverse_nbours is None:
+            reverse_nbours = get_reverse_nbours(nbours_dict)
+            self.reverse_nbours = reverse_nbours
+
+        recomputed_records = set(touched_records)
+        for record in touched_records:
+            recomputed_records.update(reverse_nbours.get(record, ()))
+
+        co_occurring_records = set()
+        for record in touched_records:
+            for session_id in self.data_model.get_preferences_for_record(
+                    record):
+                co_occurring_records.update(
+                    self.data_model.get_preferences_of_session(session_id))
+        co_occurring_records -= recomputed_records
+
+        record_nhood = self.__create_nhood()
+        new_nbours = {}
+        for record in recomputed_records:
+            new_nbours[record] = self.__get_nbours_of_record(
+                record_nhood, record)
+
+        for record in co_occurring_records:
+            candidates = dict(nbours_dict.get(record, {}))
+            for other_record in touched_records:
+                if other_record == record:
+                    continue
+                similarity = self.record_sim.get_similarity(
+                    record, other_record)
+                if math.isnan(similarity) or similarity == 0.0:
+                    continue
+                candidates[other_record] = similarity
+            new_nbours[record] = dict(top_k(
+                candidates.iteritems(), self.max_num_nbours,
+                key=lambda (r_id, sim): sim))
+
+        for record, nbours in new_nbours.iteritems():
+            old_nbours = nbours_dict.get(record, {})
+            for nbour in old_nbours:
+                if nbour not in nbours:
+                    reverse_nbours[nbour].discard(record)
+            for nbour in nbours:
+                if nbour not in old_nbours:
+                    reverse_nbours.setdefault(nbour, set()).add(record)
+            nbours_dict[record] = nbours
+
+        self.nbours_dict = nbours_dict
+        logger.info(
+            'Updated the neighbours of %d records', len(new_nbours))
+
+    def __get_nbours_from_similarity_matrix(self):
+        record_ids = list(self.data_model.get_records())
+        nbours_dict = {}
+        try:
+            sim_blocks = self.record_sim.get_similarity_blocks(
+                record_ids, self.block_size)
+            for block_start, sim_block in sim_blocks:
+                self.__add_nbours_of_block(
+                    nbours_dict, record_ids, block_start, sim_block.tocsr())
+        except NotImplementedError:
+            return None
+        logger.info(
+            'Computed the similarity matrix of %d records', len(record_ids))
+        return nbours_dict
+
+    def __add_nbours_of_block(
+            self, nbours_dict, record_ids, block_start, sim_block):
+        for row in xrange(sim_block.shape[0]):
+            i = block_start + row
+            start, end = sim_block.indptr[row], sim_block.indptr[row+1]
+            nbour_idxs = sim_block.indices[start:end]
+            sims = sim_block.data[start:end]
+            valid = (nbour_idxs != i) & (sims != 0.0) & ~np.isnan(sims)
+            nbour_idxs, sims = nbour_idxs[valid], sims[valid]
+            if len(sims) > self.max_num_nbours:
+                top = np.argpartition(
+                    -sims, self.max_num_nbours-1)[:self.max_num_nbours]
+                nbour_idxs, sims = nbour_idxs[top], sims[top]
+            nbours_dict[record_ids[i]] = {
+                record_ids[j]: sim
+                for j, sim in zip(nbour_idxs.tolist(), sims.tolist())
+            }
+
+    def __create_nhood(self):
+        if self.nhood_factory is None:
+            return KNearestRecordNeighbourhood(
+                self.max_num_nbours, self.data_model, self.record_sim)
+        return self.nhood_factory(
             self.data_model, self.record_sim, self.max_num_nbours)
+
+    def __get_nbours_of_record(self, record_nhood, record):
+        try:
+            return dict(record_nhood.get_scored_neighbours(record))
+        except NotImplementedError:
+            pass
+        return {
+            nbour: self.record_sim.get_similarity(record, nbour)
+            for nbour in record_nhood.get_neighbours(record)
+        }
+
+    def __get_nbours_from_nhood(self):
+        record_nhood = self.__create_nhood()
         nbours_dict = {}
         for i, record in enumerate(self.data_model.get_records()):
-            nbours = record_nhood.get_neighbours(record)
-            nbours_dict[record] = {
-                nbour: self.record_sim.get_similarity(record, nbour)
-                for nbour in nbours
-            }
-            if i % 100 == 0:
-                print(i)
-        self.nbours_dict = nbours_dict
+            nbours_dict[record] = self.__get_nbours_of_record(
+                record_nhood, record)
+            if i % 1000 == 0:
+                logger.info('Computed the neighbours of %d records', i)
+        return nbours_dict
 
-    def get_neighbours(self, record_id):
-        if record_id in self.nbours_dict:
-            return self.nbours_dict[record_id].keys()
-        return []
+    def get_scored_neighbours(self, record_id, include_internal_records=True):
+        """
+        Returns the stored neighbours of the record along with their
+        similarity
+        """
+        nbours = self.nbours_dict.get(record_id)
+        if nbours is None:
+            return []
+        nbours = nbours.iteritems()
+        if not include_internal_records and self.record_filter is not None:
+            external_records = self.record_filter.external_records
+            nbours = (
+                (nbour, sim) for nbour, sim in nbours
+                if nbour in external_records
+            )
+        return top_k(nbours, None, key=lambda (r_id, sim): sim)
 
     def get_similarity(self, from_record_id, to_record_id):
-        if from_record_id in self.nbours_dict:
-            if to_record_id in self.nbours_dict[from_record_id]:
-                return self.nbours_dict[from_record_id][to_record_id]
-        return float('nan')
+        return get_row_value(
+            self.nbours_dict, from_record_id, to_record_id, float('nan'))
+
+    def __getstate__(self):
+        """
+        Stores the neighbours in arrays so that the processes that load a
+        snapshot share their memory. The reverse neighbours are only needed
+        for an incremental refresh, which recomputes them
+        """
+        state = dict(self.__dict__)
+        if not isinstance(self.nbours_dict, PackedRows):
+            state['nbours_dict'] = PackedRows(self.nbours_dict.iteritems())
+        state['reverse_nbours'] = None
+        return state
 
     def refresh(self, refreshed_components):
         self.refresh_helper.refresh(refreshed_components)
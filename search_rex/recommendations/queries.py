@@ -2,67 +2,187 @@
 In this module, functions that execute rather complex database queries are
 provided. These queries are mainly called by the data models of the two
 recommendation algorithms in order to access the data that they require, e.g.,
-the session-record matrix as well as the hit-matrix.
+the session-record matrix as well as the hit-matrix. The loaders select plain
+column tuples instead of mapped objects and fetch them in chunks so that large
+results are streamed from the database by a server-side cursor where the
+database driver supports it. The actions are returned as tuples of
+(record_id, session_id, action_type, time_created).
 """
 
 from ..models import Record
 from ..models import Action
 from ..models import SearchQuery
 from ..models import ImportedRecordSimilarity
+from ..models import ActionType
 from ..core import db
+from ..db_helper import age_in_intervals
 from ..util.date_util import utcnow
 
+from flask import current_app
 from sqlalchemy.orm import aliased
+from sqlalchemy.sql import select
+from sqlalchemy.sql import bindparam
+from sqlalchemy.sql import literal
+from sqlalchemy.sql import literal_column
+from sqlalchemy.sql import case
+from sqlalchemy.sql import func
+from sqlalchemy.types import DateTime
 import logging
 from itertools import groupby
+from operator import itemgetter
 
 
 logger = logging.getLogger(__name__)
 
 
-def get_actions_for_queries(
-        include_internal_records, query_strings=None,
-        max_age=None):
+def get_chunk_size():
     """
-    Retrieves the actions of all queries
-
-    :param include_internal_records: indicates if actions on internal records
-    should be omitted
-    :param query_strings: restricts the query to return only the actions of
-    the provided queries
-    :param max_age: the maximum age of the actions
+    Returns the number of rows that the loaders fetch from the database at
+    once. It is configured by QUERY_CHUNK_SIZE
     """
-    session = db.session
+    return current_app.config.get('QUERY_CHUNK_SIZE', 10000)
 
-    query = session.query(
-        Action.query_string, Action.time_created,
-        Action.record_id, Action.action_type)
-    query = query.join(Action.record)
-    query = query.filter(
+
+# The columns of the action tuples
+action_columns = [
+    Action.record_id, Action.session_id, Action.action_type,
+    Action.time_created,
+]
+
+
+def stream_rows(statement):
+    """
+    Executes the Core statement and yields its rows, which are fetched in
+    chunks of get_chunk_size() rows
+    """
+    result = db.session.execute(
+        statement.execution_options(stream_results=True))
+    chunk_size = get_chunk_size()
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        result.close()
+
+
+def filter_actions_for_queries(
+        statement, include_internal_records, query_strings=None,
+        max_age=None, min_time_created=None, max_time_created=None):
+    """
+    Restricts the statement to the actions that are selected by the parameters
+    of get_actions_for_queries
+    """
+    statement = statement.select_from(Action.__table__.join(Record.__table__))
+    statement = statement.where(
         Record.active == True)
     if query_strings is not None:
-        if query_strings == []:
-            return
-        query = query.filter(
+        statement = statement.where(
             Action.query_string.in_(query_strings)
         )
     else:
-        query = query.filter(
+        statement = statement.where(
             Action.query_string != None
         )
     if max_age:
         current_time = utcnow()
-        min_time_created = current_time - max_age
-        query = query.filter(Action.time_created >= min_time_created)
+        oldest_time_created = current_time - max_age
+        statement = statement.where(
+            Action.time_created >= oldest_time_created)
+    if min_time_created is not None:
+        statement = statement.where(Action.time_created > min_time_created)
+    if max_time_created is not None:
+        statement = statement.where(Action.time_created <= max_time_created)
     if not include_internal_records:
-        query = query.filter(Record.is_internal == False)
-    query = query.order_by(Action.query_string)
+        statement = statement.where(Record.is_internal == False)
+    return statement
+
+
+def get_actions_for_queries(
+        include_internal_records, query_strings=None,
+        max_age=None, min_time_created=None, max_time_created=None):
+    """
+    Retrieves the actions of all queries
+
+    :param include_internal_records: indicates if actions on internal records
+    should be omitted
+    :param query_strings: restricts the query to return only the actions of
+    the provided queries
+    :param max_age: the maximum age of the actions
+    :param min_time_created: if given, only the actions that were created
+    after this point in time are returned
+    :param max_time_created: if given, only the actions that were created
+    at or before this point in time are returned
+    """
+    if query_strings == []:
+        return
+    statement = filter_actions_for_queries(
+        select([Action.query_string] + action_columns),
+        include_internal_records, query_strings, max_age, min_time_created,
+        max_time_created)
+    statement = statement.order_by(Action.query_string)
+
+    for query_string, rows in groupby(
+            stream_rows(statement), key=itemgetter(0)):
+        yield (
+            query_string, [
+                row[1:] for row in rows
+            ]
+        )
 
-    for query_string, actions in groupby(
-            query, key=lambda action: action.query_string):
+
+def get_hit_cells_for_queries(
+        include_internal_records, reference_time, time_interval,
+        query_strings=None, max_age=None, min_time_created=None,
+        max_time_created=None):
+    """
+    Retrieves the actions of all queries aggregated by the database. The
+    actions of a query on a record are grouped by their age, i.e., the number
+    of complete time intervals between their creation and the reference time.
+    Each group is returned as tuple of (record_id, age, num_views, num_copies,
+    last_time_created)
+
+    :param include_internal_records: indicates if actions on internal records
+    should be omitted
+    :param reference_time: the time relative to which the age is computed
+    :param time_interval: the length of an age group
+    :param query_strings: restricts the query to return only the actions of
+    the provided queries
+    :param max_age: the maximum age of the actions
+    :param min_time_created: if given, only the actions that were created
+    after this point in time are returned
+    :param max_time_created: if given, only the actions that were created
+    at or before this point in time are returned
+    """
+    if query_strings == []:
+        return
+    age = age_in_intervals(
+        Action.time_created,
+        bindparam('reference_time', reference_time, type_=DateTime()),
+        literal(time_interval.total_seconds()))
+    statement = select([
+        Action.query_string,
+        Action.record_id,
+        age.label('age'),
+        func.sum(case([(Action.action_type == ActionType.view, 1)], else_=0)),
+        func.sum(case([(Action.action_type == ActionType.copy, 1)], else_=0)),
+        func.max(Action.time_created),
+    ])
+    statement = filter_actions_for_queries(
+        statement, include_internal_records, query_strings, max_age,
+        min_time_created, max_time_created)
+    statement = statement.group_by(
+        Action.query_string, Action.record_id, literal_column('age'))
+    statement = statement.order_by(Action.query_string)
+
+    for query_string, rows in groupby(
+            stream_rows(statement), key=itemgetter(0)):
         yield (
             query_string, [
-                action for action in actions
+                row[1:] for row in rows
             ]
         )
 
@@ -76,6 +196,7 @@ def get_queries():
     query = (
         session.query(SearchQuery.query_string).filter()
     )
+    query = query.yield_per(get_chunk_size())
 
     for query_string, in query:
         yield query_string
@@ -90,6 +211,7 @@ def get_records(include_internal_records):
     query = session.query(Record.record_id).filter(Record.active == True)
     if not include_internal_records:
         query = query.filter(Record.is_internal == False)
+    query = query.yield_per(get_chunk_size())
 
     for record_id, in query:
         yield record_id
@@ -102,16 +224,13 @@ def get_actions_of_session(session_id):
     :param session_id: the id of the session from which the actions are to be
     retrieved
     """
-    session = db.session
-
-    query = session.query(Action)
-    query = query.join(Action.record)
-    query = query.filter(
-        Action.session_id == session_id,
-        Record.active == True).all()
+    statement = select(action_columns)
+    statement = statement.select_from(Action.__table__.join(Record.__table__))
+    statement = statement.where(
+        (Action.session_id == session_id) &
+        (Record.active == True))
 
-    for action in query:
-        yield action
+    return stream_rows(statement)
 
 
 def get_actions_on_record(record_id, max_age=None):
@@ -122,19 +241,19 @@ def get_actions_on_record(record_id, max_age=None):
     retrieved
     :param max_age: the maximum age of the action
     """
-    session = db.session
-
-    query = session.query(Action).filter(Action.record_id == record_id)
+    statement = select(action_columns)
+    statement = statement.where(Action.record_id == record_id)
     if max_age:
         current_time = utcnow()
         min_time_created = current_time - max_age
-        query = query.filter(Action.time_created >= min_time_created)
+        statement = statement.where(Action.time_created >= min_time_created)
 
-    for action in query:
-        yield action
+    return stream_rows(statement)
 
 
-def get_actions_on_records(include_internal_records, max_age=None):
+def get_actions_on_records(
+        include_internal_records, max_age=None, min_time_created=None,
+        max_time_created=None):
     """
     Retrieves the Records and the list of actions that have been performed
     on them
@@ -142,23 +261,30 @@ def get_actions_on_records(include_internal_records, max_age=None):
     :param include_internal_records: indicates if actions on internal records
     should be omitted
     :param max_age: the maximum age of the actions
+    :param min_time_created: if given, only the actions that were created
+    after this point in time are returned
+    :param max_time_created: if given, only the actions that were created
+    at or before this point in time are returned
     """
-    session = db.session
-
-    query = session.query(Action)
-    query = query.join(Action.record)
-    query = query.filter(
+    statement = select(action_columns)
+    statement = statement.select_from(Action.__table__.join(Record.__table__))
+    statement = statement.where(
         Record.active == True)
     if not include_internal_records:
-        query = query.filter(Record.is_internal == False)
+        statement = statement.where(Record.is_internal == False)
     if max_age:
         current_time = utcnow()
-        min_time_created = current_time - max_age
-        query = query.filter(Action.time_created >= min_time_created)
-    query = query.order_by(Action.record_id)
+        oldest_time_created = current_time - max_age
+        statement = statement.where(
+            Action.time_created >= oldest_time_created)
+    if min_time_created is not None:
+        statement = statement.where(Action.time_created > min_time_created)
+    if max_time_created is not None:
+        statement = statement.where(Action.time_created <= max_time_created)
+    statement = statement.order_by(Action.record_id)
 
     for record_id, actions in groupby(
-            query, key=lambda action: action.record_id):
+            stream_rows(statement), key=itemgetter(0)):
         yield (
             record_id, [
                 action for action in actions
@@ -178,7 +304,10 @@ def get_similarities(include_internal_records):
     from_alias = aliased(Record)
     to_alias = aliased(Record)
 
-    query = session.query(ImportedRecordSimilarity)
+    query = session.query(
+        ImportedRecordSimilarity.from_record_id,
+        ImportedRecordSimilarity.to_record_id,
+        ImportedRecordSimilarity.similarity_value)
     query = query.join(
         from_alias,
         ImportedRecordSimilarity.from_record_id==from_alias.record_id)
@@ -193,6 +322,7 @@ def get_similarities(include_internal_records):
         query = query.filter(to_alias.is_internal == False)
 
     query = query.order_by(ImportedRecordSimilarity.from_record_id)
+    query = query.yield_per(get_chunk_size())
 
     for record_id, sims in groupby(
             query, key=lambda sim: sim.from_record_id):
@@ -8,6 +8,7 @@ particular query.
 import math
 from ..refreshable import Refreshable
 from ..refreshable import RefreshHelper
+from search_rex.util.sort_util import top_k
 
 
 class SearchResultRecommendation(object):
@@ -31,16 +32,26 @@ class SearchResultRecommendation(object):
         }
 
 
-def relevance(record_id, query_hits):
+def relative_hit_value(hit_value, total_hits):
+    """
+    Calculates the share of a hit value in the total of its hit row
+    """
+    if total_hits == 0.0:
+        return 0.0
+    return float(hit_value) / total_hits
+
+
+def relevance(record_id, query_hits, total_hits=None):
     """
     Calculates the relative number of hits on the record
+
+    :param total_hits: the sum of the query's hits if it is known in advance
     """
     if record_id not in query_hits:
         return 0.0
-    total_hits = sum(hit for hit in query_hits.values())
-    if total_hits == 0.0:
-        return 0.0
-    return float(query_hits[record_id]) / total_hits
+    if total_hits is None:
+        total_hits = sum(hit for hit in query_hits.values())
+    return relative_hit_value(query_hits[record_id], total_hits)
 
 
 class LogFrequency:
@@ -53,10 +64,13 @@ class LogFrequency:
         self.base = base
         self.scale = scale
 
-    def __call__(self, record_id, query_hits):
+    def __call__(self, record_id, query_hits, total_hits=None):
         if record_id not in query_hits:
             return 0.0
-        weight = 1 + self.scale * query_hits[record_id]
+        return self.score_hit(query_hits[record_id], total_hits)
+
+    def score_hit(self, hit_value, total_hits):
+        weight = 1 + self.scale * hit_value
         return math.log(weight, self.base) if weight > 0.0 else 0.0
 
 
@@ -64,10 +78,38 @@ class Frequency:
     """
     Returns the number of hits
     """
-    def __call__(self, record_id, query_hits):
+    def __call__(self, record_id, query_hits, total_hits=None):
         if record_id not in query_hits:
             return 0.0
-        return query_hits[record_id]
+        return self.score_hit(query_hits[record_id], total_hits)
+
+    def score_hit(self, hit_value, total_hits):
+        return hit_value
+
+
+def get_hit_score_function(score_function):
+    """
+    Returns the function that computes the score of a single hit value from
+    the value and the total of its hit row. Returns None if the score function
+    only works on whole hit rows
+    """
+    if score_function is relevance:
+        return relative_hit_value
+    return getattr(score_function, 'score_hit', None)
+
+
+def apply_score_function(score_function, record_id, hit_row, hit_total=None):
+    """
+    Computes the score of a record on a hit row of values
+
+    :param hit_total: the sum of the hit row if it is known in advance
+    """
+    hit_score_function = get_hit_score_function(score_function)
+    if hit_score_function is None:
+        return score_function(record_id, hit_row)
+    if hit_total is None:
+        hit_total = sum(hit_row.values())
+    return hit_score_function(hit_row[record_id], hit_total)
 
 
 class Scorer(object):
@@ -75,43 +117,91 @@ class Scorer(object):
     A mathematical function that is applied on the hit-matrix entries
     """
 
-    def compute_score(self, record_id, hit_rows, query_sims):
+    def compute_score(self, record_id, hit_rows, query_sims, hit_totals=None):
+        """
+        Computes the score of a record
+
+        :param record_id: the record to score
+        :param hit_rows: the hit rows of values of the neighbouring queries
+        :param query_sims: the similarities of the neighbouring queries
+        :param hit_totals: the sums of the hit rows if they are known in
+        advance
+        """
         raise NotImplementedError()
 
+    def compute_scores(self, hit_rows, query_sims, hit_totals=None):
+        """
+        Computes the recommendations of all the records on the hit rows, i.e.,
+        their scores, total views and last interactions. Returns a dictionary
+        of record to SearchResultRecommendation
+
+        :param hit_rows: the hit rows of the neighbouring queries
+        :param query_sims: the similarities of the neighbouring queries
+        :param hit_totals: the sums of the hit rows if they are known in
+        advance
+        """
+        recs = accumulate_hits(hit_rows)
+        value_rows = {
+            query_string: {
+                record: hit.value for record, hit in hit_row.iteritems()}
+            for query_string, hit_row in hit_rows.iteritems()
+            if query_string in query_sims
+        }
+        for record, rec in recs.iteritems():
+            rec.score = self.compute_score(
+                record, value_rows, query_sims, hit_totals)
+        return recs
+
 
-class WeightedSumScorer(Scorer):
+def accumulate_hit(rec, hit):
     """
-    Sums the scores weighted by the query similarities
+    Adds the views and the last interaction of a hit to the recommendation
     """
+    rec.total_hits += hit.num_views
+    if rec.last_interaction is None\
+            or hit.last_interaction > rec.last_interaction:
+        rec.last_interaction = hit.last_interaction
 
-    def __init__(self, score_function=relevance):
-        self.score_function = score_function
 
-    def compute_score(self, record_id, hit_rows, query_sims):
-        """
-        Computes the score of a record including the similarities of queries to
-        the target query and their hit-rows
-        """
-        assert len(hit_rows) == len(query_sims)
-        total_score = 0.0
-        for query_string, nbor_hit_row in hit_rows.iteritems():
-            if record_id not in nbor_hit_row:
-                continue
-            sim = query_sims[query_string]
-            score = self.score_function(record_id, nbor_hit_row)
-            total_score += sim * score
-        return total_score
+def create_recommendation(record_id):
+    rec = SearchResultRecommendation(record_id)
+    rec.score = 0.0
+    rec.total_hits = 0
+    return rec
 
 
-class WeightedAverageScorer(Scorer):
+def accumulate_hits(hit_rows):
     """
-    Computes the weighted average score using the query similarities
+    Returns a dictionary of record to SearchResultRecommendation holding the
+    total views and the last interaction of the record on the hit rows
+    """
+    recs = {}
+    for hit_row in hit_rows.itervalues():
+        for record, hit in hit_row.iteritems():
+            rec = recs.get(record)
+            if rec is None:
+                rec = recs[record] = create_recommendation(record)
+            accumulate_hit(rec, hit)
+    return recs
+
+
+class WeightedScorer(Scorer):
+    """
+    Base class of the scorers that combine the scores of a record on the
+    neighbouring hit rows weighted by the query similarities
     """
 
     def __init__(self, score_function=relevance):
         self.score_function = score_function
 
-    def compute_score(self, record_id, hit_rows, query_sims):
+    def combine(self, total_score, total_sim):
+        """
+        Combines the sum of the weighted scores and the sum of the
+        similarities of the queries whose hit rows include the record
+        """
+        raise NotImplementedError()
+
+    def compute_score(self, record_id, hit_rows, query_sims, hit_totals=None):
         """
         Computes the score of a record including the similarities of queries to
         the target query and their hit-rows
@@ -123,9 +213,70 @@ class WeightedAverageScorer(Scorer):
             if record_id not in nbor_hit_row:
                 continue
             sim = query_sims[query_string]
-            score = self.score_function(record_id, nbor_hit_row)
+            hit_total = hit_totals.get(query_string) if hit_totals else None
+            score = apply_score_function(
+                self.score_function, record_id, nbor_hit_row, hit_total)
             total_score += sim * score
             total_sim += sim
+        return self.combine(total_score, total_sim)
+
+    def compute_scores(self, hit_rows, query_sims, hit_totals=None):
+        """
+        Computes the recommendations of all the records on the hit rows in a
+        single pass over the hits. Hit rows of queries without a similarity
+        count towards the views but not towards the scores
+        """
+        hit_score_function = get_hit_score_function(self.score_function)
+        recs = {}
+        total_sims = {}
+        for query_string, hit_row in hit_rows.iteritems():
+            sim = query_sims.get(query_string)
+            if sim is None:
+                hit_total = value_row = None
+            elif hit_score_function is not None:
+                hit_total = hit_totals.get(query_string)\
+                    if hit_totals else None
+                if hit_total is None:
+                    hit_total = sum(hit.value for hit in hit_row.itervalues())
+            else:
+                value_row = {
+                    record: hit.value for record, hit in hit_row.iteritems()}
+
+            for record, hit in hit_row.iteritems():
+                rec = recs.get(record)
+                if rec is None:
+                    rec = recs[record] = create_recommendation(record)
+                    total_sims[record] = 0.0
+                accumulate_hit(rec, hit)
+                if sim is None:
+                    continue
+                if hit_score_function is not None:
+                    score = hit_score_function(hit.value, hit_total)
+                else:
+                    score = self.score_function(record, value_row)
+                rec.score += sim * score
+                total_sims[record] += sim
+
+        for record, rec in recs.iteritems():
+            rec.score = self.combine(rec.score, total_sims[record])
+        return recs
+
+
+class WeightedSumScorer(WeightedScorer):
+    """
+    Sums the scores weighted by the query similarities
+    """
+
+    def combine(self, total_score, total_sim):
+        return total_score
+
+
+class WeightedAverageScorer(WeightedScorer):
+    """
+    Computes the weighted average score using the query similarities
+    """
+
+    def combine(self, total_score, total_sim):
         if total_sim == 0.0:
             return 0.0
         return total_score / total_sim
@@ -135,20 +286,28 @@ class AbstractQueryBasedRecommender(Refreshable):
     '''Recommender System for search results based on queries committed by
     members of a community'''
 
-    def recommend_search_results(self, query_string, max_num_recs=10):
+    def recommend_search_results(
+            self, query_string, max_num_recs=10,
+            include_internal_records=True):
         """
         Returns a list of records that were viewed after entering the query
 
         :param query_string: the query that was entered by the user
         :param max_num_recs: the maximum number of recommendations to return
+        :param include_internal_records: indicates if internal records may be
+        recommended
         """
         raise NotImplementedError()
 
-    def get_similar_queries(self, query_string, max_num_recs=10):
+    def get_similar_queries(
+            self, query_string, max_num_recs=10,
+            include_internal_records=True):
         """
         Returns a list of queries which are similar to the target query
 
         :param query_string: the query that was entered by the user
+        :param include_internal_records: indicates if queries whose hits are
+        only on internal records may be returned
         """
         raise NotImplementedError()
 
@@ -156,82 +315,112 @@ class AbstractQueryBasedRecommender(Refreshable):
 class QueryBasedRecommender(AbstractQueryBasedRecommender):
 
     def __init__(
-            self, data_model, query_nhood, query_sim, scorer):
+            self, data_model, query_nhood, query_sim, scorer,
+            record_filter=None):
+        """
+        :param data_model: the data model of the hit matrix
+        :param query_nhood: the neighbourhood of the queries, which also
+        provides the similarities of the neighbours to the target query
+        :param query_sim: the similarity of the queries
+        :param scorer: the scorer that computes the score of a record
+        :param record_filter: the InternalRecordFilter that is used for
+        filtering out the internal records if the data model includes them
+        """
         self.data_model = data_model
         self.query_nhood = query_nhood
         self.query_sim = query_sim
         self.scorer = scorer
+        self.record_filter = record_filter
         self.refresh_helper = RefreshHelper()
         self.refresh_helper.add_dependency(data_model)
         self.refresh_helper.add_dependency(query_sim)
         self.refresh_helper.add_dependency(query_nhood)
+        if record_filter is not None:
+            self.refresh_helper.add_dependency(record_filter)
+
+    def __filters_records(self, include_internal_records):
+        return not include_internal_records and self.record_filter is not None
+
+    def __filter_hit_row(self, hit_row):
+        external_records = self.record_filter.external_records
+        return {
+            record: hit for record, hit in hit_row.iteritems()
+            if record in external_records
+        }
 
-    def get_similar_queries(self, query_string, max_num_recs=10):
+    def __has_external_hits(self, query_string):
+        # A query whose hits are only on internal records is not known to a
+        # data model without the internal records
+        external_records = self.record_filter.external_records
+        for _, hit_row in self.data_model.get_hit_rows_for_queries(
+                [query_string]):
+            return any(record in external_records for record in hit_row)
+        return False
+
+    def __get_query_filter(self, include_internal_records):
+        # The hidden queries are filtered out before the neighbourhood is
+        # limited to its maximum size so that they do not take the places of
+        # visible neighbours
+        if not self.__filters_records(include_internal_records):
+            return None
+        return self.__has_external_hits
+
+    def get_similar_queries(
+            self, query_string, max_num_recs=10,
+            include_internal_records=True):
         """
-        Returns a list of queries which are similar to the target query
+        Returns a list of queries which are similar to the target query in
+        the descending order of their similarity
 
         :param query_string: the query that was entered by the user
+        :param max_num_recs: the maximum number of queries to return
+        :param include_internal_records: indicates if queries whose hits are
+        only on internal records may be returned
         """
-        return self.query_nhood.get_neighbours(query_string)
+        return self.query_nhood.get_neighbours(
+            query_string, max_num_recs,
+            self.__get_query_filter(include_internal_records))
 
-    def recommend_search_results(self, query_string, max_num_recs=10):
+    def recommend_search_results(
+            self, query_string, max_num_recs=10,
+            include_internal_records=True):
         """
         Returns a list of records that were viewed after entering the query
 
         :param query_string: the query that was entered by the user
         :param max_num_recs: the maximum number of recommendations to return
+        :param include_internal_records: indicates if internal records may be
+        recommended
         """
-        nbours = [
-            nbour for nbour
-            in self.query_nhood.get_neighbours(query_string)
-        ]
-
+        filters_records = self.__filters_records(include_internal_records)
+        nbours = []
         nbour_sims = {}
-        for nbour in nbours:
-            sim = self.query_sim.get_similarity(query_string, nbour)
+        for nbour, sim in self.query_nhood.get_scored_neighbours(
+                query_string,
+                query_filter=self.__get_query_filter(
+                    include_internal_records)):
+            nbours.append(nbour)
             if not math.isnan(sim):
                 nbour_sims[nbour] = sim
 
         hit_row_iter = self.data_model.get_hit_rows_for_queries(nbours)
 
-        records = set()
         hit_rows = {}
-        hit_value_rows = {}
+        # The precomputed totals do not apply to filtered hit rows
+        hit_totals = {}
         for nbour, hit_row in hit_row_iter:
-            records.update(hit_row.keys())
+            if filters_records:
+                hit_row = self.__filter_hit_row(hit_row)
+            else:
+                hit_total = self.data_model.get_hit_total(nbour)
+                if hit_total is not None:
+                    hit_totals[nbour] = hit_total
             hit_rows[nbour] = hit_row
-            hit_value_rows[nbour] =\
-                {record: hit.value for record, hit in hit_row.items()}
-
-        recs = {}
-        for record in records:
-            score = self.scorer.compute_score(
-                record, hit_value_rows, nbour_sims)
-
-            rec = SearchResultRecommendation(record)
-            rec.score = score
-
-            rec.related_queries = []
-            total_hits = 0
-            last_interaction = None
-            for _, hit_row in hit_rows.iteritems():
-                if record in hit_row:
-                    record_hit = hit_row[record]
-
-                    total_hits += record_hit.num_views
-                    if last_interaction is None\
-                            or record_hit.last_interaction > last_interaction:
-                        last_interaction = record_hit.last_interaction
-
-            rec.last_interaction = last_interaction
-            rec.total_hits = total_hits
-
-            recs[record] = rec
 
-        sorted_recs = sorted(
-            recs.values(), key=lambda rec: rec.score, reverse=True)
+        recs = self.scorer.compute_scores(hit_rows, nbour_sims, hit_totals)
 
-        recs_to_return = sorted_recs[:max_num_recs]
+        recs_to_return = top_k(
+            recs.itervalues(), max_num_recs, key=lambda rec: rec.score)
         for rec in recs_to_return:
             print('Record: {}, Score: {}'.format(
                 rec.record_id, rec.score))
@@ -7,6 +7,7 @@ recommend geodata records by learning the users' interests.
 from collections import defaultdict
 from ..refreshable import Refreshable
 from ..refreshable import RefreshHelper
+from search_rex.util.sort_util import top_k
 import math
 import logging
 
@@ -20,23 +21,29 @@ class AbstractRecordBasedRecommender(Refreshable):
     incorporating their history of views and copies
     """
 
-    def recommend(self, session_id, max_num_recs=10):
+    def recommend(
+            self, session_id, max_num_recs=10, include_internal_records=True):
         """
         Gets a list of recommended records based on a session's history
 
         :param session_id: the id of the session to which the records are
         recommended
         :param max_num_recs: the maximum number of recommendations to return
+        :param include_internal_records: indicates if internal records may be
+        recommended
         """
 
         raise NotImplementedError()
 
-    def most_similar_records(self, record_id, max_num_recs=10):
+    def most_similar_records(
+            self, record_id, max_num_recs=10, include_internal_records=True):
         """
         Returns a list of records that were used together with the given one
 
         :param session_id: the id of the record
         :param max_num_recs: the maximum number of recommendations to return
+        :param include_internal_records: indicates if internal records may be
+        recommended
         """
         raise NotImplementedError()
 
@@ -47,62 +54,95 @@ class RecordBasedRecommender(AbstractRecordBasedRecommender):
     incorporating their history of views and copies
     """
 
-    def __init__(self, data_model, record_nhood, record_sim):
+    def __init__(
+            self, data_model, record_nhood, record_sim, record_filter=None):
+        """
+        :param data_model: the data model of the preferences
+        :param record_nhood: the neighbourhood of the records, which also
+        provides the similarities of the neighbours
+        :param record_sim: the similarity of the records
+        :param record_filter: the InternalRecordFilter that is used for
+        filtering out the internal records if the data model includes them
+        """
         self.data_model = data_model
         self.record_nhood = record_nhood
         self.record_sim = record_sim
+        self.record_filter = record_filter
         self.refresh_helper = RefreshHelper()
         self.refresh_helper.add_dependency(data_model)
         self.refresh_helper.add_dependency(record_sim)
         self.refresh_helper.add_dependency(record_nhood)
-
-    def recommend(self, session_id, max_num_recs=10):
+        if record_filter is not None:
+            self.refresh_helper.add_dependency(record_filter)
+
+    def __filters_records(self, include_internal_records):
+        return not include_internal_records and self.record_filter is not None
+
+    def __get_scored_neighbours(self, record_id, include_internal_records):
+        if not self.__filters_records(include_internal_records):
+            return self.record_nhood.get_scored_neighbours(record_id)
+        external_records = self.record_filter.external_records
+        return [
+            (nbour, sim) for nbour, sim
+            in self.record_nhood.get_scored_neighbours(
+                record_id, include_internal_records=False)
+            if nbour in external_records
+        ]
+
+    def recommend(
+            self, session_id, max_num_recs=10, include_internal_records=True):
         """
         Gets a list of recommended records based on a session's history
 
         :param session_id: the id of the session to which the records are
         recommended
         :param max_num_recs: the maximum number of recommendations to return
+        :param include_internal_records: indicates if internal records may be
+        recommended
         """
         candidates = defaultdict(float)
         preferences = self.data_model.get_preferences_of_session(session_id)
+        if self.__filters_records(include_internal_records):
+            preferences = {
+                record: pref for record, pref in preferences.iteritems()
+                if self.record_filter.is_visible(record, False)
+            }
         print('Seen records by {}: {}'.format(session_id, preferences))
         for record, _ in preferences.iteritems():
-            for nbour in self.record_nhood.get_neighbours(record):
+            for nbour, similarity in self.__get_scored_neighbours(
+                    record, include_internal_records):
                 if nbour in preferences:
                     continue
 
-                similarity = self.record_sim.get_similarity(
-                    record, nbour)
                 if not math.isnan(similarity):
                     candidates[nbour] += similarity
 
-        candidates_by_score = sorted(
-            candidates.items(), key=lambda (p_id, sim): sim,
-            reverse=True)
+        return top_k(
+            candidates.iteritems(), max_num_recs,
+            key=lambda (p_id, sim): sim)
 
-        return candidates_by_score[:max_num_recs]\
-            if max_num_recs is not None else candidates_by_score
-
-    def most_similar_records(self, record_id, max_num_recs=10):
+    def most_similar_records(
+            self, record_id, max_num_recs=10, include_internal_records=True):
         """
         Returns a list of records that were used together with the given one
 
         :param session_id: the id of the record
         :param max_num_recs: the maximum number of recommendations to return
+        :param include_internal_records: indicates if internal records may be
+        recommended
         """
-        candidates = []
-        for nbour in self.record_nhood.get_neighbours(record_id):
-            similarity = self.record_sim.get_similarity(record_id, nbour)
-            if not math.isnan(similarity):
-                candidates.append((nbour, similarity))
-
-        candidates_by_score = sorted(
-            candidates, key=lambda (p_id, sim): sim,
-            reverse=True)
-
-        return candidates_by_score[:max_num_recs]\
-            if max_num_recs is not None else candidates_by_score
+        if self.__filters_records(include_internal_records) and\
+                not self.record_filter.is_visible(record_id, False):
+            return []
+        candidates = [
+            (nbour, similarity) for nbour, similarity
+            in self.__get_scored_neighbours(
+                record_id, include_internal_records)
+            if not math.isnan(similarity)
+        ]
+
+        return top_k(
+            candidates, max_num_recs, key=lambda (p_id, sim): sim)
 
     def refresh(self, refreshed_components):
         self.refresh_helper.refresh(refreshed_components)
@@ -0,0 +1,61 @@
+"""
+Both the internal and the external recommender instance are served by the
+same components. These components are built including the internal records.
+When recommendations are generated for external users, the internal records
+are filtered out at query time. For this purpose, the components are given an
+InternalRecordFilter that knows which records are external.
+"""
+
+from . import queries
+from .refreshable import Refreshable
+from .refreshable import RefreshHelper
+
+
+class InternalRecordFilter(Refreshable):
+    """
+    Holds the set of the external records in the local memory. A record that
+    is not known to be external, e.g., because it has been added after the
+    last refresh, is treated as internal so that it is never shown to
+    external users by mistake
+    """
+
+    def __init__(self):
+        self.external_records = frozenset()
+        self.refresh_helper = RefreshHelper(
+            target_refresh_function=self.init_records)
+        self.init_records()
+
+    def init_records(self):
+        self.external_records = frozenset(
+            queries.get_records(include_internal_records=False))
+
+    def is_visible(self, record_id, include_internal_records):
+        """
+        Checks if the record may be recommended
+
+        :param record_id: the id of the record
+        :param include_internal_records: indicates if internal records may be
+        recommended
+        """
+        return include_internal_records or\
+            record_id in self.external_records
+
+    def filter_records(self, record_ids, include_internal_records):
+        """
+        Returns the list of the records that may be recommended
+
+        :param record_ids: an iterable over record ids
+        :param include_internal_records: indicates if internal records may be
+        recommended
+        """
+        if include_internal_records:
+            return list(record_ids)
+        external_records = self.external_records
+        return [
+            record_id for record_id in record_ids
+            if record_id in external_records
+        ]
+
+    def refresh(self, refreshed_components):
+        self.refresh_helper.refresh(refreshed_components)
+        refreshed_components.add(self)
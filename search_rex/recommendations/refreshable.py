@@ -63,3 +63,25 @@ class RefreshHelper(object):
                     refreshed_components.add(dep)
             if self.target_refresh_function:
                 self.target_refresh_function()
+
+    def __getstate__(self):
+        """
+        Replaces the lock and the bound target function, which cannot be
+        pickled, so that the component graph can be stored in a snapshot
+        """
+        state = dict(self.__dict__)
+        del state['reentrant_lock']
+        function = self.target_refresh_function
+        if getattr(function, 'im_self', None) is not None:
+            state['target_refresh_function'] = (
+                function.im_self, function.__name__)
+        return state
+
+    def __setstate__(self, state):
+        function = state['target_refresh_function']
+        if isinstance(function, tuple):
+            component, function_name = function
+            state['target_refresh_function'] = getattr(
+                component, function_name)
+        self.__dict__.update(state)
+        self.reentrant_lock = RLock()
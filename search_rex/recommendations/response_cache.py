@@ -0,0 +1,244 @@
+"""
+The recommendations only change when the recommenders are refreshed, but
+many requests ask for the same popular queries and records. For this reason,
+the results of the recommendation endpoints can be cached in the local
+memory of the process. An entry is identified by the endpoint, the arguments
+of the request, the include_internal_records flag and the version of the
+model the results have been generated from. Hence, results of an older model
+are never returned, and the cache is cleared whenever the recommenders are
+refreshed so that their memory is released at once.
+
+Each endpoint has its own cache of a bounded size. If a cache is full, the
+least recently used entry is evicted. Optionally, entries expire after a
+time to live. The number of hits and misses of each cache are reported by
+get_response_cache_metrics.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# The cache of the endpoint results or None if caching is disabled
+response_cache = None
+
+
+class LRUCache(object):
+    """
+    A cache of a bounded size that evicts the least recently used entry and
+    optionally lets entries expire after a time to live
+    """
+
+    def __init__(self, max_size, ttl=None, clock=time.time):
+        """
+        :param max_size: the maximum number of entries
+        :param ttl: the number of seconds after which an entry expires. If
+        None, entries only leave the cache if they are evicted
+        :param clock: the function that returns the current time in seconds
+        """
+        assert max_size > 0
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+        self.num_expirations = 0
+
+    def get(self, key):
+        """
+        Returns a tuple of a flag indicating if the key was found and the
+        cached value
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                value, time_created = entry
+                if self.ttl is None or\
+                        self.clock() - time_created < self.ttl:
+                    # Reinserting the entry marks it as most recently used
+                    self.entries[key] = entry
+                    self.num_hits += 1
+                    return True, value
+                self.num_expirations += 1
+            self.num_misses += 1
+            return False, None
+
+    def put(self, key, value):
+        """
+        Stores the value and evicts the least recently used entry if the
+        cache is full
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            while len(self.entries) >= self.max_size:
+                self.entries.popitem(last=False)
+                self.num_evictions += 1
+            self.entries[key] = (value, self.clock())
+
+    def clear(self):
+        """
+        Removes all the entries, but keeps the counters
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def get_metrics(self):
+        """
+        Returns the counters of the cache
+        """
+        num_requests = self.num_hits + self.num_misses
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'num_hits': self.num_hits,
+            'num_misses': self.num_misses,
+            'num_evictions': self.num_evictions,
+            'num_expirations': self.num_expirations,
+            'hit_rate':
+                float(self.num_hits) / num_requests if num_requests else 0.0,
+        }
+
+
+class ResponseCache(object):
+    """
+    Holds a LRUCache for each endpoint
+    """
+
+    def __init__(self, max_size=10000, ttl=None, max_sizes=None):
+        """
+        :param max_size: the maximum number of entries of an endpoint
+        :param ttl: the number of seconds after which an entry expires
+        :param max_sizes: optional dictionary of endpoint to the maximum
+        number of entries of this endpoint. It overrides max_size
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_sizes = max_sizes or {}
+        self.caches = {}
+        self.lock = Lock()
+
+    def get_cache(self, endpoint):
+        """
+        Returns the cache of the endpoint
+        """
+        cache = self.caches.get(endpoint)
+        if cache is None:
+            with self.lock:
+                cache = self.caches.get(endpoint)
+                if cache is None:
+                    cache = LRUCache(
+                        self.max_sizes.get(endpoint, self.max_size),
+                        self.ttl)
+                    self.caches[endpoint] = cache
+        return cache
+
+    def get_or_compute(
+            self, endpoint, args, include_internal_records, model_version,
+            compute):
+        """
+        Returns the cached result of the request or computes and caches it
+
+        :param endpoint: the name of the endpoint
+        :param args: the tuple of the request's arguments
+        :param include_internal_records: indicates if the result may include
+        internal records
+        :param model_version: the version of the recommenders that generate
+        the result
+        :param compute: the function that computes the result
+        """
+        cache = self.get_cache(endpoint)
+        key = (args, include_internal_records, model_version)
+        found, result = cache.get(key)
+        if not found:
+            result = compute()
+            cache.put(key, result)
+        return result
+
+    def clear(self):
+        """
+        Removes the entries of all endpoints
+        """
+        for cache in self.caches.values():
+            cache.clear()
+
+    def get_metrics(self):
+        """
+        Returns the counters of each endpoint
+        """
+        return {
+            endpoint: cache.get_metrics()
+            for endpoint, cache in self.caches.items()
+        }
+
+
+def enable_response_cache(max_size=10000, ttl=None, max_sizes=None):
+    """
+    Enables the caching of the endpoint results
+
+    :param max_size: the maximum number of entries of an endpoint
+    :param ttl: the number of seconds after which an entry expires. If None,
+    entries stay until they are evicted or the recommenders are refreshed
+    :param max_sizes: optional dictionary of endpoint to the maximum number of
+    entries of this endpoint
+    """
+    global response_cache
+    response_cache = ResponseCache(max_size, ttl, max_sizes)
+    return response_cache
+
+
+def disable_response_cache():
+    """
+    Disables the caching of the endpoint results
+    """
+    global response_cache
+    response_cache = None
+
+
+def clear_response_cache():
+    """
+    Removes all the cached results. This is called whenever the recommenders
+    are refreshed
+    """
+    cache = response_cache
+    if cache is not None:
+        cache.clear()
+        logger.info("Response cache cleared")
+
+
+def get_cached_result(
+        endpoint, args, include_internal_records, model_version, compute):
+    """
+    Returns the cached result of the request if caching is enabled or else
+    computes it
+
+    :param endpoint: the name of the endpoint
+    :param args: the tuple of the request's arguments
+    :param include_internal_records: indicates if the result may include
+    internal records
+    :param model_version: the version of the recommenders that generate the
+    result
+    :param compute: the function that computes the result
+    """
+    cache = response_cache
+    if cache is None:
+        return compute()
+    return cache.get_or_compute(
+        endpoint, args, include_internal_records, model_version, compute)
+
+
+def get_response_cache_metrics():
+    """
+    Returns the counters of each endpoint's cache or None if caching is not
+    enabled
+    """
+    cache = response_cache
+    if cache is None:
+        return None
+    return cache.get_metrics()
@@ -5,8 +5,9 @@ which computes the Jaccard coefficient similarity over the N-grams of the
 queries.
 """
 
-from similarity_metrics import jaccard_sim
+from similarity_metrics import set_jaccard_sim
 from ..refreshable import Refreshable
+from ..refreshable import RefreshHelper
 
 
 def shingle(doc_string, k):
@@ -39,18 +40,61 @@ class AbstractQuerySimilarity(Refreshable):
 class StringJaccardSimilarity(AbstractQuerySimilarity):
     """
     Computes the jaccard similarity of the two queries' shingles
+
+    If a data model is given, the shingles of its queries are computed once
+    per refresh and stored as frozensets whose shingle strings are shared
+    among the queries. Further, the shingles of the last query that is not
+    in the data model, i.e., usually the target query of a request, are
+    retained so that it is shingled only once per request
     """
 
-    def __init__(self, k_shingles):
+    def __init__(self, k_shingles, data_model=None):
         """
         :param k_shingles: the size of the shingles
+        :param data_model: the optional query data model whose queries'
+        shingles are cached
         """
         self.k_shingles = k_shingles
+        self.data_model = data_model
+        self.shingle_cache = {}
+        self.last_shingled = (None, frozenset())
+        self.refresh_helper = RefreshHelper(
+            target_refresh_function=self.init_shingles)
+        if data_model is not None:
+            self.refresh_helper.add_dependency(data_model)
+            self.init_shingles()
+
+    def init_shingles(self):
+        if self.data_model is None:
+            return
+        interned_shingles = {}
+        shingle_cache = {}
+        for query_string in self.data_model.get_queries():
+            shingle_cache[query_string] = frozenset(
+                interned_shingles.setdefault(q_shingle, q_shingle)
+                for q_shingle in shingle(query_string, self.k_shingles))
+        self.shingle_cache = shingle_cache
+
+    def get_shingles(self, query_string):
+        """
+        Returns the shingles of the query either from the cache or by
+        computing them
+        """
+        shingles = self.shingle_cache.get(query_string)
+        if shingles is not None:
+            return shingles
+
+        last_query, shingles = self.last_shingled
+        if last_query != query_string:
+            shingles = frozenset(shingle(query_string, self.k_shingles))
+            self.last_shingled = (query_string, shingles)
+        return shingles
 
     def get_similarity(self, from_query_string, to_query_string):
-        X = shingle(from_query_string, self.k_shingles)
-        Y = shingle(to_query_string, self.k_shingles)
-        return jaccard_sim(X, Y)
+        X = self.get_shingles(from_query_string)
+        Y = self.get_shingles(to_query_string)
+        return set_jaccard_sim(X, Y)
 
     def refresh(self, refreshed_components):
+        self.refresh_helper.refresh(refreshed_components)
         refreshed_components.add(self)
@@ -10,14 +10,40 @@ similarity from the database and stores in the local memory.
 """
 
 from similarity_metrics import jaccard_sim
-from similarity_metrics import cosine_sim
 from .. import queries
 from ..refreshable import Refreshable
 from ..refreshable import RefreshHelper
+from ..data_model.item_based import to_microseconds
+from ..data_model.item_based import TimePartitioning
+from ..data_model.item_based import get_preference_norm
 from search_rex.util.date_util import utcnow
+from search_rex.util.date_util import total_microseconds
+from search_rex.util.sort_util import top_k
+from search_rex.util.packed_dict import PackedRows
+from search_rex.util.packed_dict import get_row_value
 import math
 from datetime import timedelta
 from collections import defaultdict
+import numpy as np
+import scipy.sparse as sp
+
+
+def iter_row_blocks(num_rows, block_size):
+    """
+    Yields the start and end index of each block of at most block_size rows
+    """
+    for start in xrange(0, num_rows, block_size):
+        yield start, min(start + block_size, num_rows)
+
+
+def stack_similarity_blocks(similarity_blocks, num_records):
+    """
+    Stacks the row blocks of a similarity matrix to the full matrix
+    """
+    blocks = [block for _, block in similarity_blocks]
+    if not blocks:
+        return sp.csr_matrix((num_records, num_records))
+    return sp.vstack(blocks).tocsr()
 
 
 class AbstractRecordSimilarity(Refreshable):
@@ -31,6 +57,98 @@ class AbstractRecordSimilarity(Refreshable):
         """
         raise NotImplementedError()
 
+    def get_similarity_matrix(self, record_ids):
+        """
+        Computes the similarities of all pairs of the given records at once
+
+        Returns a sparse matrix whose entry (i, j) is the similarity from
+        record_ids[i] to record_ids[j]. Missing entries are either 0 or NaN.
+        Raises NotImplementedError if the similarity cannot be computed in
+        batch
+
+        :param record_ids: the list of records
+        """
+        return stack_similarity_blocks(
+            self.get_similarity_blocks(record_ids, max(len(record_ids), 1)),
+            len(record_ids))
+
+    def get_similarity_blocks(self, record_ids, block_size):
+        """
+        Computes the similarity matrix of the given records in blocks of rows
+        so that only one block is held in memory at a time
+
+        Yields the index of the first row of each block and the sparse matrix
+        of the similarities from the records of the block to all records.
+        Raises NotImplementedError if the similarity cannot be computed in
+        batch
+
+        :param record_ids: the list of records
+        :param block_size: the maximum number of rows of a block
+        """
+        raise NotImplementedError()
+
+
+class PreferenceMatrix(object):
+    """
+    The preferences of a list of records in coordinate form. Every preference
+    is described by the index of its record, the index of its session, its
+    value and its preference time in microseconds since the epoch
+    """
+
+    def __init__(
+            self, num_records, num_sessions, rows, cols, values, times):
+        self.num_records = num_records
+        self.num_sessions = num_sessions
+        self.rows = rows
+        self.cols = cols
+        self.values = values
+        self.times = times
+
+    @classmethod
+    def from_data_model(cls, data_model, record_ids):
+        """
+        Collects the preferences of the given records from the data model
+        """
+        record_index = {
+            record_id: i for i, record_id in enumerate(record_ids)}
+        session_index = {}
+        rows, cols, values, times = [], [], [], []
+        for record_id, preferences in data_model.get_preferences_for_records():
+            r_idx = record_index.get(record_id)
+            if r_idx is None:
+                continue
+            for session_id, pref in preferences.iteritems():
+                rows.append(r_idx)
+                cols.append(
+                    session_index.setdefault(session_id, len(session_index)))
+                values.append(pref.value)
+                times.append(to_microseconds(pref.preference_time))
+
+        return cls(
+            len(record_ids), len(session_index),
+            np.array(rows, dtype=np.int32), np.array(cols, dtype=np.int32),
+            np.array(values, dtype=np.float64),
+            np.array(times, dtype=np.int64))
+
+    def select(self, mask):
+        """
+        Returns the matrix consisting only of the preferences in the mask
+        """
+        return PreferenceMatrix(
+            self.num_records, self.num_sessions, self.rows[mask],
+            self.cols[mask], self.values[mask], self.times[mask])
+
+    def to_csr(self, binary=False):
+        """
+        Returns the record-session matrix as scipy csr_matrix
+
+        :param binary: indicates if the values are replaced by 1
+        """
+        values = np.ones(len(self.values)) if binary else self.values
+        return sp.csr_matrix(
+            (values, (self.rows, self.cols)),
+            shape=(self.num_records, self.num_sessions))
+
 
 class RecordSimilarity(AbstractRecordSimilarity):
     """
@@ -59,12 +177,21 @@ class RecordSimilarity(AbstractRecordSimilarity):
         is directed
         """
 
-        from_preferences = self.data_model.get_preferences_for_record(
-            from_record_id)
-        to_preferences = self.data_model.get_preferences_for_record(
-            to_record_id)
-        return self.similarity_metric.get_similarity(
-            from_preferences, to_preferences)
+        return self.similarity_metric.get_record_similarity(
+            self.data_model, from_record_id, to_record_id)
+
+    def get_similarity_blocks(self, record_ids, block_size):
+        """
+        Computes the similarities of all pairs of the given records by
+        applying the similarity metric on their preference matrix
+
+        :param record_ids: the list of records
+        :param block_size: the maximum number of rows of a block
+        """
+        pref_matrix = PreferenceMatrix.from_data_model(
+            self.data_model, record_ids)
+        return self.similarity_metric.get_similarity_blocks(
+            pref_matrix, block_size)
 
     def refresh(self, refreshed_components):
         self.refresh_helper.refresh(refreshed_components)
@@ -114,6 +241,23 @@ class CombinedRecordSimilarity(AbstractRecordSimilarity):
             return sim1 * self.weight
         return sim1 * self.weight + sim2 * (1-self.weight)
 
+    def get_similarity_blocks(self, record_ids, block_size):
+        """
+        Combines the similarity blocks of the two similarity metrics. As in
+        get_similarity, a missing entry of one matrix only leaves the
+        weighted entry of the other
+
+        :param record_ids: the list of records
+        :param block_size: the maximum number of rows of a block
+        """
+        blocks1 = self.similarity_metric1.get_similarity_blocks(
+            record_ids, block_size)
+        blocks2 = self.similarity_metric2.get_similarity_blocks(
+            record_ids, block_size)
+        for (start, block1), (_, block2) in zip(blocks1, blocks2):
+            yield start, (
+                block1 * self.weight + block2 * (1-self.weight)).tocsr()
+
     def refresh(self, refreshed_components):
         self.refresh_helper.refresh(refreshed_components)
         refreshed_components.add(self)
@@ -122,26 +266,54 @@ class CombinedRecordSimilarity(AbstractRecordSimilarity):
 class InMemoryRecordSimilarity(AbstractRecordSimilarity):
     """
     Loads similarities from the database and stores them in the memory
+
+    If a record filter is given, the most similar external records are kept
+    in addition to the most similar records of all, so that the external
+    records get the same similarities as if the internal records had not
+    been loaded
     """
-    def __init__(self, include_internal_records, max_sims_per_record=100):
+    def __init__(
+            self, include_internal_records, max_sims_per_record=100,
+            record_filter=None):
+        """
+        :param include_internal_records: indicates if the similarities of the
+        internal records are loaded
+        :param max_sims_per_record: the maximum number of similarities that
+        are kept per record
+        :param record_filter: the InternalRecordFilter that tells the external
+        records if the internal records are included
+        """
         self.include_internal_records = include_internal_records
         self.max_sims_per_record = max_sims_per_record
+        self.record_filter = record_filter
         self.similarities = {}
         self.refresh_helper = RefreshHelper(
             target_refresh_function=self.init_similarities)
+        if record_filter is not None:
+            self.refresh_helper.add_dependency(record_filter)
         self.init_similarities()
 
     def init_similarities(self):
+        external_records = None
+        if self.include_internal_records and self.record_filter is not None:
+            external_records = self.record_filter.external_records
         similarities = defaultdict(dict)
         for from_record, rec_sims in queries.get_similarities(
                 self.include_internal_records):
-            sorted_sims = sorted(
-                rec_sims.iteritems(), key=lambda(_, s): s, reverse=True)
-            for i, (to_record, sim) in enumerate(sorted_sims):
-                if i >= self.max_sims_per_record:
-                    break
+            top_sims = top_k(
+                rec_sims.iteritems(), self.max_sims_per_record,
+                key=lambda(_, s): s)
+            if external_records is not None:
+                top_sims += top_k(
+                    (
+                        (to_record, sim)
+                        for to_record, sim in rec_sims.iteritems()
+                        if to_record in external_records
+                    ),
+                    self.max_sims_per_record, key=lambda(_, s): s)
+            for to_record, sim in top_sims:
                 similarities[from_record][to_record] = sim
-        self.similarities = similarities
+        self.similarities = dict(similarities)
 
     def get_similarity(self, from_record_id, to_record_id):
         """
@@ -153,10 +325,43 @@ class InMemoryRecordSimilarity(AbstractRecordSimilarity):
         :param from_record_id: the id of the record to which the similarity
         is directed
         """
-        if from_record_id in self.similarities:
-            if to_record_id in self.similarities[from_record_id]:
-                return self.similarities[from_record_id][to_record_id]
-        return float('nan')
+        return get_row_value(
+            self.similarities, from_record_id, to_record_id, float('nan'))
+
+    def get_similarity_blocks(self, record_ids, block_size):
+        """
+        Returns the imported similarities among the given records as blocks of
+        a sparse matrix. Since at most max_sims_per_record similarities are
+        stored per record, the whole matrix is built at once
+
+        :param record_ids: the list of records
+        :param block_size: the maximum number of rows of a block
+        """
+        record_index = {
+            record_id: i for i, record_id in enumerate(record_ids)}
+        rows, cols, sims = [], [], []
+        for from_record, rec_sims in self.similarities.iteritems():
+            if from_record not in record_index:
+                continue
+            for to_record, sim in rec_sims.iteritems():
+                if to_record in record_index:
+                    rows.append(record_index[from_record])
+                    cols.append(record_index[to_record])
+                    sims.append(sim)
+        sim_mat = sp.csr_matrix(
+            (sims, (rows, cols)), shape=(len(record_ids), len(record_ids)))
+        for start, end in iter_row_blocks(len(record_ids), block_size):
+            yield start, sim_mat[start:end]
+
+    def __getstate__(self):
+        """
+        Stores the similarities in arrays so that the processes that load a
+        snapshot share their memory
+        """
+        state = dict(self.__dict__)
+        if not isinstance(self.similarities, PackedRows):
+            state['similarities'] = PackedRows(self.similarities.iteritems())
+        return state
 
     def refresh(self, refreshed_components):
         self.refresh_helper.refresh(refreshed_components)
@@ -179,6 +384,50 @@ class AbstractPreferenceSimilarity(object):
         """
         raise NotImplementedError()
 
+    def get_record_similarity(self, data_model, from_record_id, to_record_id):
+        """
+        Computes the similarity of the preference vectors of two records.
+        Metrics can override this method in order to use the values that the
+        data model has computed in advance
+
+        :param data_model: the data model where the preferences are stored
+        :param from_record_id: the id of the record from which the similarity
+        is directed
+        :param to_record_id: the id of the record to which the similarity
+        is directed
+        """
+        return self.get_similarity(
+            data_model.get_preferences_for_record(from_record_id),
+            data_model.get_preferences_for_record(to_record_id))
+
+    def get_similarity_matrix(self, pref_matrix):
+        """
+        Computes the similarities of all pairs of preference vectors at once
+
+        Raises NotImplementedError if the similarity cannot be computed in
+        batch
+
+        :param pref_matrix: the PreferenceMatrix of the records
+        """
+        return stack_similarity_blocks(
+            self.get_similarity_blocks(
+                pref_matrix, max(pref_matrix.num_records, 1)),
+            pref_matrix.num_records)
+
+    def get_similarity_blocks(self, pref_matrix, block_size):
+        """
+        Computes the similarities of all pairs of preference vectors in blocks
+        of rows. Yields the index of the first row of each block and the
+        similarities from the preference vectors of the block to all vectors
+
+        Raises NotImplementedError if the similarity cannot be computed in
+        batch
+
+        :param pref_matrix: the PreferenceMatrix of the records
+        :param block_size: the maximum number of rows of a block
+        """
+        raise NotImplementedError()
+
 
 class JaccardSimilarity(AbstractPreferenceSimilarity):
     """
@@ -197,6 +446,60 @@ class JaccardSimilarity(AbstractPreferenceSimilarity):
         return jaccard_sim(
             from_preferences.keys(), to_preferences.keys())
 
+    def get_similarity_blocks(self, pref_matrix, block_size):
+        """
+        Computes the jaccard similarities of all pairs of preference vectors
+        from the number of their common sessions
+
+        :param pref_matrix: the PreferenceMatrix of the records
+        :param block_size: the maximum number of rows of a block
+        """
+        binary_mat = pref_matrix.to_csr(binary=True)
+        binary_mat_t = binary_mat.T.tocsr()
+        sizes = np.diff(binary_mat.indptr)
+        for start, end in iter_row_blocks(
+                pref_matrix.num_records, block_size):
+            overlaps = (binary_mat[start:end] * binary_mat_t).tocoo()
+            unions = sizes[overlaps.row + start] + sizes[overlaps.col] -\
+                overlaps.data
+            yield start, sp.csr_matrix(
+                (overlaps.data / unions, (overlaps.row, overlaps.col)),
+                shape=overlaps.shape)
+
+
+def preference_cosine_sim(
+        from_preferences, to_preferences, from_norm=None, to_norm=None):
+    """
+    Computes the cosine similarity between two preference vectors in the same
+    way as cosine_sim of the similarity_metrics, but without copying their
+    values. The norms are computed if they are not given
+
+    If the two vectors are empty NaN is returned
+    """
+    if len(from_preferences) == 0 and len(to_preferences) == 0:
+        return float('NaN')
+
+    if len(from_preferences) == 0 or len(to_preferences) == 0:
+        return 0.0
+
+    smaller, larger = from_preferences, to_preferences
+    if len(smaller) > len(larger):
+        smaller, larger = larger, smaller
+    dot_product = 0.0
+    for key, pref in smaller.iteritems():
+        other_pref = larger.get(key)
+        if other_pref is not None:
+            dot_product += pref.value * other_pref.value
+
+    if dot_product == 0.0:
+        return 0.0
+
+    if from_norm is None:
+        from_norm = get_preference_norm(from_preferences)
+    if to_norm is None:
+        to_norm = get_preference_norm(to_preferences)
+    return dot_product / (from_norm * to_norm)
+
 
 class CosineSimilarity(AbstractPreferenceSimilarity):
     """
@@ -212,10 +515,38 @@ class CosineSimilarity(AbstractPreferenceSimilarity):
         :param to_preferences: the preference vector of the record to which
         the similarity is directed
         """
-        return cosine_sim(
-            {key: pref.value for key, pref in from_preferences.iteritems()},
-            {key: pref.value for key, pref in to_preferences.iteritems()},
-        )
+        return preference_cosine_sim(from_preferences, to_preferences)
+
+    def get_record_similarity(self, data_model, from_record_id, to_record_id):
+        """
+        Computes the cosine similarity of the preference vectors of two
+        records using the norms that the data model has computed in advance
+        """
+        return preference_cosine_sim(
+            data_model.get_preferences_for_record(from_record_id),
+            data_model.get_preferences_for_record(to_record_id),
+            data_model.get_record_norm(from_record_id),
+            data_model.get_record_norm(to_record_id))
+
+    def get_similarity_blocks(self, pref_matrix, block_size):
+        """
+        Computes the cosine similarities of all pairs of preference vectors as
+        the product of the row-normalised preference matrix with its transpose
+
+        :param pref_matrix: the PreferenceMatrix of the records
+        :param block_size: the maximum number of rows of a block
+        """
+        value_mat = pref_matrix.to_csr()
+        norms = np.sqrt(np.bincount(
+            pref_matrix.rows, weights=pref_matrix.values**2,
+            minlength=pref_matrix.num_records))
+        inv_norms = np.zeros(len(norms))
+        inv_norms[norms > 0] = 1.0 / norms[norms > 0]
+        normalised = (sp.diags(inv_norms, 0) * value_mat).tocsr()
+        normalised_t = normalised.T.tocsr()
+        for start, end in iter_row_blocks(
+                pref_matrix.num_records, block_size):
+            yield start, (normalised[start:end] * normalised_t).tocsr()
 
 
 class SignificanceWeighting(AbstractPreferenceSimilarity):
@@ -244,6 +575,25 @@ class SignificanceWeighting(AbstractPreferenceSimilarity):
         weight = min(overlap, self.min_overlap) / float(self.min_overlap)
         return similarity * weight
 
+    def get_similarity_blocks(self, pref_matrix, block_size):
+        """
+        Penalises the similarity blocks of the underlying similarity_metric
+        by the number of common sessions of each pair
+
+        :param pref_matrix: the PreferenceMatrix of the records
+        :param block_size: the maximum number of rows of a block
+        """
+        sim_blocks = self.similarity_metric.get_similarity_blocks(
+            pref_matrix, block_size)
+        binary_mat = pref_matrix.to_csr(binary=True)
+        binary_mat_t = binary_mat.T.tocsr()
+        for start, sim_block in sim_blocks:
+            end = start + sim_block.shape[0]
+            weights = (binary_mat[start:end] * binary_mat_t).tocsr()
+            weights.data = np.minimum(
+                weights.data, self.min_overlap) / float(self.min_overlap)
+            yield start, sim_block.multiply(weights).tocsr()
+
 
 def partition_preferences_by_time(
         preferences, time_bounds):
@@ -315,3 +665,158 @@ class TimeDecaySimilarity(AbstractPreferenceSimilarity):
                 sim_sum += w*sim
 
         return sim_sum / weight_sum
+
+    def get_similarity_blocks(self, pref_matrix, block_size):
+        """
+        Computes the weighted sum of the underlying similarity blocks of each
+        time partition. The blocks of all partitions are advanced together,
+        so only one block per partition is held in memory at a time
+
+        :param pref_matrix: the PreferenceMatrix of the records
+        :param block_size: the maximum number of rows of a block
+        """
+        interval = total_microseconds(self.time_interval)
+        ages = to_microseconds(utcnow()) - pref_matrix.times
+        partitions = np.maximum(ages // interval, 0)
+
+        partition_blocks = []
+        weight_sum = 0.0
+        for t in xrange(self.max_age):
+            weight = 2**(-(t)/float(self.half_life))
+            weight_sum += weight
+            mask = partitions == t
+            if not mask.any():
+                continue
+            partition_blocks.append((
+                weight, self.similarity_metric.get_similarity_blocks(
+                    pref_matrix.select(mask), block_size)))
+
+        num_records = pref_matrix.num_records
+        for start, end in iter_row_blocks(num_records, block_size):
+            sim_sum = sp.csr_matrix((end - start, num_records))
+            for weight, sim_blocks in partition_blocks:
+                _, sim_block = next(sim_blocks)
+                sim_sum = sim_sum + sim_block * weight
+            yield start, (sim_sum / weight_sum).tocsr()
+
+
+class TimeDecayCosineSimilarity(AbstractPreferenceSimilarity):
+    """
+    Computes the same similarity as a TimeDecaySimilarity over a
+    CosineSimilarity, but evaluates the dot products and norms of all time
+    partitions in a single pass over the two preference vectors. The time
+    partitions that have been assigned to the preferences by the data model
+    are used if present
+    """
+    def __init__(self, time_partitioning=None, half_life=2):
+        """
+        :param time_partitioning: The TimePartitioning by which the
+        preferences are partitioned
+        :param half_life: The number of intervals until the weight is half of
+        its initial value
+        """
+        self.time_partitioning = time_partitioning or TimePartitioning()
+        self.half_life = half_life
+        self.time_weights = []
+        self.weight_sum = 0.0
+        for t in xrange(self.time_partitioning.max_age):
+            weight = 2**(-(t)/float(half_life))
+            self.weight_sum += weight
+            self.time_weights.append(weight)
+
+    def get_similarity(self, from_preferences, to_preferences):
+        """
+        Implements a decreasing weight that penalises older interactions
+
+        :param from_preferences: the preference vector of the record from which
+        the similarity is directed
+        :param to_preferences: the preference vector of the record to which
+        the similarity is directed
+        """
+        if len(from_preferences) == 0 and len(to_preferences) == 0:
+            return float('NaN')
+
+        max_age = self.time_partitioning.max_age
+        get_partition = self.time_partitioning.get_preference_partition
+        reference_time = utcnow()
+
+        dot_products = [0.0] * max_age
+        from_squares = [0.0] * max_age
+        to_squares = [0.0] * max_age
+        for key, pref in from_preferences.iteritems():
+            t = get_partition(pref, reference_time)
+            if t >= max_age:
+                continue
+            from_squares[t] += pref.value**2
+            to_pref = to_preferences.get(key)
+            if to_pref is not None and\
+                    get_partition(to_pref, reference_time) == t:
+                dot_products[t] += pref.value * to_pref.value
+        for pref in to_preferences.itervalues():
+            t = get_partition(pref, reference_time)
+            if t < max_age:
+                to_squares[t] += pref.value**2
+
+        return self.__combine_partitions(
+            dot_products, from_squares, to_squares)
+
+    def get_record_similarity(self, data_model, from_record_id, to_record_id):
+        """
+        Computes the similarity of the preference vectors of two records. If
+        the data model has computed the squared sums of the time partitions
+        in advance, only the dot products are computed
+        """
+        from_squares = data_model.get_partition_squares(
+            from_record_id, self.time_partitioning)
+        to_squares = data_model.get_partition_squares(
+            to_record_id, self.time_partitioning)
+        if from_squares is None or to_squares is None:
+            return super(
+                TimeDecayCosineSimilarity, self).get_record_similarity(
+                    data_model, from_record_id, to_record_id)
+
+        from_preferences = data_model.get_preferences_for_record(
+            from_record_id)
+        to_preferences = data_model.get_preferences_for_record(to_record_id)
+        if len(from_preferences) == 0 and len(to_preferences) == 0:
+            return float('NaN')
+
+        max_age = self.time_partitioning.max_age
+        smaller, larger = from_preferences, to_preferences
+        if len(smaller) > len(larger):
+            smaller, larger = larger, smaller
+        dot_products = [0.0] * max_age
+        for key, pref in smaller.iteritems():
+            other_pref = larger.get(key)
+            if other_pref is None:
+                continue
+            t = pref.time_partition
+            if t < max_age and other_pref.time_partition == t:
+                dot_products[t] += pref.value * other_pref.value
+
+        return self.__combine_partitions(
+            dot_products, from_squares, to_squares)
+
+    def __combine_partitions(self, dot_products, from_squares, to_squares):
+        sim_sum = 0.0
+        for t, w in enumerate(self.time_weights):
+            if dot_products[t] == 0.0:
+                continue
+            sim = dot_products[t] / (
+                math.sqrt(from_squares[t]) * math.sqrt(to_squares[t]))
+            sim_sum += w*sim
+
+        return sim_sum / self.weight_sum
+
+    def get_similarity_blocks(self, pref_matrix, block_size):
+        """
+        Computes the weighted sum of the cosine similarity blocks of each
+        time partition
+
+        :param pref_matrix: the PreferenceMatrix of the records
+        :param block_size: the maximum number of rows of a block
+        """
+        time_decay_sim = TimeDecaySimilarity(
+            CosineSimilarity(), self.time_partitioning.time_interval,
+            self.half_life, self.time_partitioning.max_age)
+        return time_decay_sim.get_similarity_blocks(pref_matrix, block_size)
@@ -19,6 +19,22 @@ def jaccard_sim(list_a, list_b):
     return float(len_intersection) / len_union
 
 
+def set_jaccard_sim(set_a, set_b):
+    """
+    Computes the Jaccard coefficient between two sets
+
+    In contrast to jaccard_sim, the sets are not copied. If the two sets are
+    empty NaN is returned
+    """
+    if len(set_a) == 0 and len(set_b) == 0:
+        return float('NaN')
+
+    len_intersection = len(set_a & set_b)
+    len_union = len(set_a) + len(set_b) - len_intersection
+
+    return float(len_intersection) / len_union
+
+
 def norm(vector):
     """
     Computes the norm of a vector
@@ -26,11 +42,12 @@ def norm(vector):
     return math.sqrt(sum([value**2 for value in vector.values()]))
 
 
-def cosine_sim(vector1, vector2):
+def cosine_sim(vector1, vector2, norm1=None, norm2=None):
     """
     Computes the cosine similarity between two vectors
 
-    If the two vectors are empty NaN is returned
+    If the two vectors are empty NaN is returned. The norms of the vectors
+    are computed if they are not given
     """
     if len(vector1) == 0 and len(vector2) == 0:
         return float('NaN')
@@ -46,4 +63,8 @@ def cosine_sim(vector1, vector2):
     if dot_product == 0.0:
         return 0.0
 
-    return dot_product / (norm(vector1) * norm(vector2))
+    if norm1 is None:
+        norm1 = norm(vector1)
+    if norm2 is None:
+        norm2 = norm(vector2)
+    return dot_product / (norm1 * norm2)
@@ -0,0 +1,256 @@
+"""
+Building the recommender instances from the database takes a long time as
+every component loads and processes its data. As each web worker and each
+Celery worker holds its own instances, this work would be repeated by every
+process that starts. For this reason, a built set of instances can be stored
+in a snapshot file. The snapshot contains the complete in-memory state of the
+components, i.e., the hit matrix, the record-session matrix, the content
+similarities and the neighbourhoods. A process that starts loads the snapshot
+instead of building the instances as long as the snapshot is not stale.
+
+A snapshot file starts with a header that holds the format version, the time
+the snapshot was created as well as the model version of the instances. The
+header is followed by the pickled recommender instances. As the header can be
+read on its own, the staleness of a snapshot is checked without loading it.
+
+The large numpy arrays of the components, e.g., the ones of a
+RecordSessionMatrix, are not pickled but written to an array file next to the
+snapshot. On loading, the array file is memory-mapped and the arrays are
+read-only views on it. Hence, all the processes that load the same snapshot
+share the memory of these arrays instead of holding a copy each. The
+dictionaries of the components, e.g., the session-record matrix, the hit
+matrix or the stored neighbours, are held by arrays in the snapshot as well.
+An incremental refresh overlays these arrays with the replaced rows instead
+of copying them. As a new snapshot comes with a new array file, processes
+that still use the arrays of an older snapshot are not affected when it is
+replaced.
+
+The processes coordinate by two lock files next to the snapshot. A process
+that saves a snapshot holds the save lock until it is done, so saves never
+run at the same time and no other save is in progress when the older array
+files are removed. A process that loads a snapshot holds the load lock in
+shared mode until it has mapped the array file. The older array files are
+only removed while the load lock is held exclusively, so they never
+disappear between reading the header and mapping the file.
+"""
+
+from ..util.date_util import utcnow
+from contextlib import contextmanager
+import numpy as np
+import cPickle
+import fcntl
+import glob
+import logging
+import os
+import tempfile
+
+
+logger = logging.getLogger(__name__)
+
+# Increased whenever the layout of the snapshot or of the components changes
+SNAPSHOT_FORMAT_VERSION = 9
+# Arrays that are smaller than this number of bytes are pickled as usual
+MIN_MAPPED_ARRAY_SIZE = 4096
+# The arrays in the array file start at multiples of this number of bytes
+ARRAY_ALIGNMENT = 64
+ARRAY_FILE_SUFFIX = '.arrays'
+SAVE_LOCK_SUFFIX = '.save.lock'
+LOAD_LOCK_SUFFIX = '.load.lock'
+
+
+class SnapshotHeader(object):
+    """
+    The header of a snapshot file
+    """
+
+    def __init__(
+            self, format_version, time_created, model_version, array_file):
+        """
+        :param format_version: the version of the snapshot format
+        :param time_created: the time the snapshot was created
+        :param model_version: the version of the stored recommender instances
+        :param array_file: the name of the file that holds the arrays of the
+        snapshot. It is located in the directory of the snapshot
+        """
+        self.format_version = format_version
+        self.time_created = time_created
+        self.model_version = model_version
+        self.array_file = array_file
+
+
+class ArrayWriter(object):
+    """
+    Writes the large arrays that are encountered while pickling to the array
+    file and replaces them by their position in this file
+    """
+
+    def __init__(self, array_file):
+        """
+        :param array_file: the file object the arrays are written to
+        """
+        self.array_file = array_file
+        self.offset = 0
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, np.ndarray) or obj.dtype.hasobject or\
+                obj.nbytes < MIN_MAPPED_ARRAY_SIZE:
+            return None
+        padding = -self.offset % ARRAY_ALIGNMENT
+        self.array_file.write('\0' * padding)
+        self.offset += padding
+        array = np.ascontiguousarray(obj)
+        array.tofile(self.array_file)
+        array_id = (array.dtype.str, array.shape, self.offset)
+        self.offset += array.nbytes
+        return array_id
+
+
+class ArrayReader(object):
+    """
+    Resolves the positions in the array file to read-only views on the
+    memory-mapped file
+    """
+
+    def __init__(self, path):
+        """
+        :param path: the path of the array file
+        """
+        self.path = path
+        self.mapped_file = None
+
+    def persistent_load(self, array_id):
+        if self.mapped_file is None:
+            self.mapped_file = np.memmap(self.path, dtype=np.uint8, mode='r')
+        dtype, shape, offset = array_id
+        return np.ndarray(
+            shape, dtype=np.dtype(dtype), buffer=self.mapped_file,
+            offset=offset)
+
+
+@contextmanager
+def lock_file(path, operation):
+    """
+    Holds a lock on the file at the path, which is created if it does not
+    exist
+
+    :param path: the path of the lock file
+    :param operation: fcntl.LOCK_SH or fcntl.LOCK_EX
+    """
+    with open(path, 'a') as locked_file:
+        fcntl.flock(locked_file.fileno(), operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(locked_file.fileno(), fcntl.LOCK_UN)
+
+
+def get_array_files(path):
+    """
+    Returns the paths of the array files that belong to the snapshot
+    """
+    return glob.glob(path + '.*' + ARRAY_FILE_SUFFIX)
+
+
+def save_snapshot(path, instances, model_version):
+    """
+    Stores the recommender instances in a snapshot file. The file is written
+    next to the target and renamed when it is complete so that readers never
+    see a partially written snapshot
+
+    :param path: the path of the snapshot file
+    :param instances: the dictionary of include_internal_records to
+    recommender instance
+    :param model_version: the version of the recommender instances
+    """
+    with lock_file(path + SAVE_LOCK_SUFFIX, fcntl.LOCK_EX):
+        directory = os.path.dirname(os.path.abspath(path))
+        array_fd, array_path = tempfile.mkstemp(
+            dir=directory, prefix=os.path.basename(path) + '.',
+            suffix=ARRAY_FILE_SUFFIX)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        header = SnapshotHeader(
+            SNAPSHOT_FORMAT_VERSION, utcnow(), model_version,
+            os.path.basename(array_path))
+        try:
+            with os.fdopen(array_fd, 'wb') as array_file:
+                with os.fdopen(fd, 'wb') as snapshot_file:
+                    pickler = cPickle.Pickler(
+                        snapshot_file, cPickle.HIGHEST_PROTOCOL)
+                    pickler.persistent_id =\
+                        ArrayWriter(array_file).persistent_id
+                    pickler.dump(header)
+                    pickler.dump(instances)
+        except Exception:
+            os.remove(tmp_path)
+            os.remove(array_path)
+            raise
+
+        with lock_file(path + LOAD_LOCK_SUFFIX, fcntl.LOCK_EX):
+            os.rename(tmp_path, path)
+            # As the saves are serialised, the only array file in use is the
+            # one of the new snapshot. Processes that have mapped one of the
+            # older array files keep their mapping after the file is removed
+            for old_array_path in get_array_files(path):
+                if old_array_path != array_path:
+                    os.remove(old_array_path)
+    logger.info(
+        "Snapshot of the recommenders of version %d saved to %s",
+        model_version, path)
+    return header
+
+
+def is_snapshot_fresh(header, max_age=None, min_time_created=None):
+    """
+    Checks if a snapshot can be used instead of building the recommenders
+
+    :param header: the header of the snapshot
+    :param max_age: the maximum age of a snapshot. If None, snapshots never
+    become stale
+    :param min_time_created: if given, only snapshots that were created after
+    this point in time are fresh
+    """
+    if header is None:
+        return False
+    if header.format_version != SNAPSHOT_FORMAT_VERSION:
+        return False
+    if max_age is not None and utcnow() - header.time_created > max_age:
+        return False
+    if min_time_created is not None and\
+            header.time_created <= min_time_created:
+        return False
+    return True
+
+
+def load_snapshot(path, max_age=None, min_time_created=None):
+    """
+    Loads the recommender instances from a snapshot file. Returns a tuple of
+    the header and the instances or None if there is no snapshot, if it is
+    stale or if it cannot be read
+
+    :param path: the path of the snapshot file
+    :param max_age: the maximum age of the snapshot
+    :param min_time_created: if given, the snapshot is only loaded if it was
+    created after this point in time
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with lock_file(path + LOAD_LOCK_SUFFIX, fcntl.LOCK_SH),\
+                open(path, 'rb') as snapshot_file:
+            unpickler = cPickle.Unpickler(snapshot_file)
+            header = unpickler.load()
+            if not is_snapshot_fresh(header, max_age, min_time_created):
+                logger.info("The snapshot %s is stale", path)
+                return None
+            array_path = os.path.join(
+                os.path.dirname(os.path.abspath(path)), header.array_file)
+            unpickler.persistent_load = ArrayReader(
+                array_path).persistent_load
+            instances = unpickler.load()
+    except Exception:
+        logger.exception("Loading the snapshot %s failed", path)
+        return None
+    logger.info(
+        "Recommenders of version %d loaded from the snapshot %s",
+        header.model_version, path)
+    return header, instances
@@ -2,7 +2,12 @@
 This module implements the services that are provided by the recommender
 system. These services consist of storing actions that have been recorded in
 the HSR-Geodatenkompass, the import of record similarities and the ability
-of enabling/disabling recommendations for particular records.
+of enabling/disabling recommendations for particular records. Actions can
+either be stored one by one or in batches that are written with a few bulk
+inserts. Optionally, view and copy actions are buffered in memory and written
+in batches by a background thread so that the caller does not have to wait
+for the database. Likewise, record similarities can be imported in bulk from
+CSV or NDJSON files.
 """
 
 from .models import Record
@@ -13,8 +18,26 @@ from .models import SearchSession
 from .models import ImportedRecordSimilarity
 
 import logging
+import atexit
+import csv
+import json
+import os
+import time
+from collections import OrderedDict
+from collections import deque
+from Queue import Queue
+from Queue import Full
+from Queue import Empty
+from threading import Event
+from threading import Lock
+from threading import Thread
+
+from sqlalchemy.sql import select
 
 from .db_helper import get_one_or_create
+from .db_helper import insert_or_ignore
+from .db_helper import insert_rows
+from .util.sort_util import top_k
 
 from .core import db
 
@@ -22,10 +45,25 @@ from .core import db
 logger = logging.getLogger(__name__)
 
 
+# The buffer of the write-behind mode or None if actions are written directly
+action_buffer = None
+
+
 class RecordNotPresentException(Exception):
     pass
 
 
+class MalformedSimilarityException(Exception):
+    """
+    Indicates that a similarity to be imported could not be parsed
+    """
+
+    def __init__(self, line_number, message):
+        Exception.__init__(
+            self, u'Line {}: {}'.format(line_number, message))
+        self.line_number = line_number
+
+
 def report_action(
         record_id, is_internal_record, session_id,
         timestamp, action_type, query_string=None):
@@ -84,6 +122,12 @@ def report_view_action(
     :param timestamp: the timestamp of the action
     :param query_string: the query that has led to the action
     """
+    buffer = action_buffer
+    if buffer is not None:
+        buffer.ensure_started()
+        return buffer.put(
+            record_id, is_internal_record, session_id, timestamp,
+            ActionType.view, query_string)
     return report_action(
         record_id, is_internal_record, session_id, timestamp,
         ActionType.view, query_string)
@@ -101,11 +145,360 @@ def report_copy_action(
     :param timestamp: the timestamp of the action
     :param query_string: the query that has led to the action
     """
+    buffer = action_buffer
+    if buffer is not None:
+        buffer.ensure_started()
+        return buffer.put(
+            record_id, is_internal_record, session_id, timestamp,
+            ActionType.copy, query_string)
     return report_action(
         record_id, is_internal_record, session_id, timestamp,
         ActionType.copy, query_string)
 
 
+def report_actions_bulk(actions):
+    """
+    Stores a batch of actions in a single transaction
+
+    As with report_action, an action is only registered once per session,
+    record and action type. Duplicates within the batch are dropped in memory,
+    while the actions, records, queries and sessions that are already present
+    are skipped by the database. A session that is created gets the earliest
+    timestamp of its actions in the batch.
+
+    :param actions: an iterable of dictionaries, each holding the record_id,
+    is_internal_record, session_id, timestamp, action_type and optionally the
+    query_string of an action
+    :returns: the number of distinct actions in the batch
+    """
+    unique_actions = OrderedDict()
+    for action in actions:
+        assert action['action_type'] in (ActionType.view, ActionType.copy)
+        key = (action['session_id'], action['record_id'],
+               action['action_type'])
+        if key not in unique_actions:
+            unique_actions[key] = action
+
+    if not unique_actions:
+        return 0
+
+    records = OrderedDict()
+    query_strings = OrderedDict()
+    sessions = OrderedDict()
+    for action in unique_actions.itervalues():
+        records.setdefault(action['record_id'], action['is_internal_record'])
+        query_string = action.get('query_string')
+        if query_string:
+            query_strings[query_string] = True
+        session_id = action['session_id']
+        if session_id not in sessions or\
+                action['timestamp'] < sessions[session_id]:
+            sessions[session_id] = action['timestamp']
+
+    session = db.session
+    try:
+        insert_or_ignore(session, Record.__table__, [
+            {'record_id': record_id, 'is_internal': is_internal}
+            for record_id, is_internal in records.iteritems()
+        ])
+        insert_or_ignore(session, SearchQuery.__table__, [
+            {'query_string': query_string} for query_string in query_strings
+        ])
+        insert_or_ignore(session, SearchSession.__table__, [
+            {'session_id': session_id, 'time_created': time_created}
+            for session_id, time_created in sessions.iteritems()
+        ])
+        insert_or_ignore(session, Action.__table__, [
+            {
+                'session_id': action['session_id'],
+                'record_id': action['record_id'],
+                'action_type': action['action_type'],
+                'query_string': action.get('query_string') or None,
+                'time_created': action['timestamp'],
+            }
+            for action in unique_actions.itervalues()
+        ])
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+    return len(unique_actions)
+
+
+class ActionBuffer(object):
+    """
+    A bounded in-memory queue of actions that are written to the database in
+    batches by a background thread
+
+    If the queue is full, the action is written directly by the caller. The
+    number of these overflows as well as the other counters returned by
+    get_metrics show whether the flusher keeps up with the incoming actions
+
+    A batch that cannot be written is retried after flush_interval seconds
+    for at most max_retries times before its actions are dropped
+    """
+
+    def __init__(
+            self, app, max_size=10000, batch_size=500, flush_interval=1.0,
+            max_retries=3):
+        """
+        :param app: the flask app whose database the actions are written to
+        :param max_size: the maximum number of actions in the queue
+        :param batch_size: the maximum number of actions written at once
+        :param flush_interval: the number of seconds the flusher collects
+        actions before it writes an incomplete batch
+        :param max_retries: the number of times a failed batch is retried
+        """
+        assert batch_size > 0
+        assert max_retries >= 0
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.queue = Queue(max_size)
+        # The failed batches along with their number of attempts
+        self.retry_batches = deque()
+        self.stop_event = Event()
+        self.flush_lock = Lock()
+        self.metrics_lock = Lock()
+        self.start_lock = Lock()
+        self.thread = None
+        # The id of the process that runs the background thread
+        self.pid = None
+
+        self.num_enqueued = 0
+        self.num_written = 0
+        self.num_overflows = 0
+        self.num_retried = 0
+        self.num_failed = 0
+        self.last_flush_duration = 0.0
+
+    def put(
+            self, record_id, is_internal_record, session_id,
+            timestamp, action_type, query_string=None):
+        """
+        Puts the action into the queue and returns immediately
+
+        If the queue is full, the action is stored synchronously
+        """
+        assert action_type in (ActionType.view, ActionType.copy)
+        action = {
+            'record_id': record_id,
+            'is_internal_record': is_internal_record,
+            'session_id': session_id,
+            'timestamp': timestamp,
+            'action_type': action_type,
+            'query_string': query_string,
+        }
+        try:
+            self.queue.put_nowait(action)
+            with self.metrics_lock:
+                self.num_enqueued += 1
+        except Full:
+            with self.metrics_lock:
+                self.num_overflows += 1
+            logger.warning('Action buffer is full, writing action directly')
+            report_action(
+                record_id, is_internal_record, session_id,
+                timestamp, action_type, query_string)
+        return True
+
+    def __take_batch(self, wait):
+        # If wait is set, the first action is awaited for at most
+        # flush_interval seconds. The batch is then filled with the actions
+        # that arrive within flush_interval seconds
+        batch = []
+        try:
+            if wait:
+                batch.append(self.queue.get(timeout=self.flush_interval))
+                deadline = time.time() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    batch.append(self.queue.get(timeout=remaining))
+            else:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+        except Empty:
+            pass
+        return batch
+
+    def __write_batch(self, batch, num_attempts=0):
+        start = time.time()
+        try:
+            with self.app.app_context():
+                report_actions_bulk(batch)
+            with self.metrics_lock:
+                self.num_written += len(batch)
+        except Exception:
+            num_attempts += 1
+            if num_attempts <= self.max_retries:
+                self.retry_batches.append((batch, num_attempts))
+                with self.metrics_lock:
+                    self.num_retried += len(batch)
+                logger.warning(
+                    'Writing %d buffered actions failed, retrying',
+                    len(batch), exc_info=True)
+            else:
+                with self.metrics_lock:
+                    self.num_failed += len(batch)
+                logger.exception(
+                    'Writing %d buffered actions failed, dropping them',
+                    len(batch))
+        self.last_flush_duration = time.time() - start
+
+    def __retry_batches(self):
+        # The batches that fail again are queued for the next call
+        for _ in xrange(len(self.retry_batches)):
+            batch, num_attempts = self.retry_batches.popleft()
+            self.__write_batch(batch, num_attempts)
+
+    def flush(self):
+        """
+        Writes all the actions that are currently in the queue and retries
+        the failed batches until they are written or dropped
+        """
+        with self.flush_lock:
+            while self.retry_batches:
+                self.__retry_batches()
+            batch = self.__take_batch(wait=False)
+            while batch:
+                self.__write_batch(batch)
+                batch = self.__take_batch(wait=False)
+            while self.retry_batches:
+                self.__retry_batches()
+
+    def run(self):
+        """
+        Writes the actions in batches until the buffer is stopped
+        """
+        while not self.stop_event.is_set():
+            if self.retry_batches:
+                # Gives the database some time before the retry
+                if self.stop_event.wait(self.flush_interval):
+                    break
+                with self.flush_lock:
+                    self.__retry_batches()
+            batch = self.__take_batch(wait=True)
+            if batch:
+                with self.flush_lock:
+                    self.__write_batch(batch)
+
+    def start(self):
+        """
+        Starts the background thread that writes the actions
+        """
+        self.pid = os.getpid()
+        self.thread = Thread(target=self.run, name='action-buffer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def ensure_started(self):
+        """
+        Starts the background thread unless it already runs in this process
+
+        Threads do not survive a fork, so a process that has been forked
+        from the one that started the buffer starts its own thread. It
+        starts with an empty queue since the actions in the queue are
+        written by the parent process
+        """
+        if self.pid == os.getpid():
+            return
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            if self.pid is not None:
+                self.queue = Queue(self.queue.maxsize)
+                self.retry_batches = deque()
+                self.stop_event = Event()
+                self.flush_lock = Lock()
+                self.metrics_lock = Lock()
+            self.start()
+
+    def stop(self):
+        """
+        Stops the background thread and writes the remaining actions
+        """
+        if self.pid is not None and self.pid != os.getpid():
+            # The actions belong to the parent process
+            return
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def get_metrics(self):
+        """
+        Returns the counters of the buffer
+        """
+        return {
+            'queue_size': self.queue.qsize(),
+            'max_size': self.queue.maxsize,
+            'num_enqueued': self.num_enqueued,
+            'num_written': self.num_written,
+            'num_overflows': self.num_overflows,
+            'num_retried': self.num_retried,
+            'num_failed': self.num_failed,
+            'last_flush_duration': self.last_flush_duration,
+        }
+
+
+def start_write_behind(
+        app, max_size=10000, batch_size=500, flush_interval=1.0,
+        max_retries=3):
+    """
+    Enables the write-behind mode in which view and copy actions are
+    acknowledged at once and written to the database by a background thread.
+    The remaining actions are written when the process exits
+
+    The background thread is only started when the process reports its first
+    action. Hence, processes that never report actions, e.g., a pre-forking
+    master or the Celery workers, do not run one, and every forked worker
+    runs its own
+
+    :param app: the flask app whose database the actions are written to
+    :param max_size: the maximum number of actions in the queue
+    :param batch_size: the maximum number of actions written at once
+    :param flush_interval: the number of seconds the flusher waits for new
+    actions before it writes an incomplete batch
+    :param max_retries: the number of times a failed batch is retried
+    """
+    global action_buffer
+    stop_write_behind()
+    buffer = ActionBuffer(
+        app, max_size, batch_size, flush_interval, max_retries)
+    action_buffer = buffer
+    return buffer
+
+
+def stop_write_behind():
+    """
+    Disables the write-behind mode after writing the buffered actions
+    """
+    global action_buffer
+    buffer = action_buffer
+    action_buffer = None
+    if buffer is not None:
+        buffer.stop()
+
+
+atexit.register(stop_write_behind)
+
+
+def get_write_behind_metrics():
+    """
+    Returns the counters of the write-behind buffer or None if the mode is
+    not enabled
+    """
+    buffer = action_buffer
+    if buffer is None:
+        return None
+    return buffer.get_metrics()
+
+
 def set_record_active(record_id, active):
     """
     Sets a record active or inactive
@@ -187,3 +580,210 @@ def import_record_similarity(
 
     session.commit()
     return created
+
+
+SIMILARITY_FIELDS = [
+    'from_record_id', 'from_record_is_internal',
+    'to_record_id', 'to_record_is_internal', 'similarity_value',
+]
+
+
+def _parse_similarity(row, line_number):
+    def parse_bool(value):
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, basestring) and\
+                value.lower() in ('true', 'false'):
+            return value.lower() == 'true'
+        raise ValueError()
+
+    def parse_id(value):
+        if isinstance(value, str):
+            value = value.decode('utf-8')
+        if not isinstance(value, unicode) or not value:
+            raise ValueError()
+        return value
+
+    parsers = {
+        'from_record_id': parse_id,
+        'from_record_is_internal': parse_bool,
+        'to_record_id': parse_id,
+        'to_record_is_internal': parse_bool,
+        'similarity_value': float,
+    }
+    if not isinstance(row, dict):
+        raise MalformedSimilarityException(line_number, u'Not an object')
+    similarity = {}
+    for field in SIMILARITY_FIELDS:
+        if row.get(field) is None:
+            raise MalformedSimilarityException(
+                line_number, u'Missing field {}'.format(field))
+        try:
+            similarity[field] = parsers[field](row[field])
+        except (ValueError, TypeError, UnicodeDecodeError):
+            raise MalformedSimilarityException(
+                line_number, u'Field {} could not be parsed'.format(field))
+    return similarity
+
+
+def parse_similarities(lines, format):
+    """
+    Parses the similarities to be imported from lines of CSV or NDJSON
+
+    A CSV file starts with a header naming the columns from_record_id,
+    from_record_is_internal, to_record_id, to_record_is_internal and
+    similarity_value. In an NDJSON file, each line holds an object with these
+    fields. Empty lines are skipped
+
+    :param lines: an iterable over the lines
+    :param format: either 'csv' or 'ndjson'
+    """
+    if format == 'csv':
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield _parse_similarity(row, reader.line_num)
+    elif format == 'ndjson':
+        for line_number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                raise MalformedSimilarityException(
+                    line_number, u'Invalid JSON')
+            yield _parse_similarity(row, line_number)
+    else:
+        raise ValueError('Unknown format {}'.format(format))
+
+
+def import_record_similarities_bulk(
+        similarities, max_sims_per_record=100, chunk_size=1000):
+    """
+    Imports similarities in bulk and replaces the similarities of every
+    record that occurs as from record
+
+    Only the max_sims_per_record most similar records are kept per from
+    record. If a pair occurs more than once, the last value counts. The
+    similarities are read in groups of consecutive lines with the same from
+    record. Whenever a group ends, the similarities of its from record are
+    queued, and once chunk_size from records are queued, they are written in
+    their own transaction by deleting the chunk's old similarities and
+    inserting the new ones with multi-row statements. Hence, if the input is
+    sorted or grouped by the from record, only one chunk is held in memory. A
+    from record whose similarities were written by an earlier chunk of the
+    same import is merged with them instead of replacing them
+
+    :param similarities: an iterable of dictionaries as returned by
+    parse_similarities
+    :param max_sims_per_record: max numbers of similarities per record
+    :param chunk_size: the number of from records written per transaction
+    :returns: the number of from records and the number of similarities that
+    have been stored
+    """
+    assert max_sims_per_record > 0
+    assert chunk_size > 0
+
+    def cut(rec_sims):
+        return dict(top_k(
+            rec_sims.iteritems(), max_sims_per_record,
+            key=lambda (_, sim): sim))
+
+    table = ImportedRecordSimilarity.__table__
+    session = db.session
+    imported_records = set()
+
+    def write_chunk(record_sims, records):
+        chunk = record_sims.keys()
+        # The similarities that this import has stored for a from record
+        # before are merged with the new ones, which take precedence
+        reimported = [
+            from_record_id for from_record_id in chunk
+            if from_record_id in imported_records
+        ]
+        num_replaced = 0
+        if reimported:
+            stored_sims = {}
+            for from_record_id, to_record_id, sim in session.execute(
+                    select([
+                        table.c.from_record_id, table.c.to_record_id,
+                        table.c.similarity_value,
+                    ]).where(table.c.from_record_id.in_(reimported))):
+                stored_sims.setdefault(from_record_id, {})[to_record_id] = sim
+                num_replaced += 1
+            for from_record_id, rec_sims in stored_sims.iteritems():
+                rec_sims.update(record_sims[from_record_id])
+                record_sims[from_record_id] = rec_sims
+
+        chunk_sims = [
+            (from_record_id, cut(record_sims[from_record_id]))
+            for from_record_id in chunk
+        ]
+        chunk_records = set(chunk)
+        for _, rec_sims in chunk_sims:
+            chunk_records.update(rec_sims)
+        rows = [
+            {
+                'from_record_id': from_record_id,
+                'to_record_id': to_record_id,
+                'similarity_value': sim,
+            }
+            for from_record_id, rec_sims in chunk_sims
+            for to_record_id, sim in rec_sims.iteritems()
+        ]
+
+        try:
+            # The records of the stored similarities exist already, so they
+            # need not be known here
+            insert_or_ignore(session, Record.__table__, [
+                {'record_id': record_id, 'is_internal': records[record_id]}
+                for record_id in chunk_records if record_id in records
+            ])
+            session.execute(
+                table.delete().where(table.c.from_record_id.in_(chunk)))
+            insert_rows(session, table.insert(), rows)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        imported_records.update(chunk)
+        logger.info(
+            'Imported the similarities of %d records', len(imported_records))
+        return len(rows) - num_replaced
+
+    # The similarities of the queued from records along with the records
+    # they refer to, which are created if they do not exist
+    record_sims = OrderedDict()
+    records = {}
+    num_sims = 0
+    from_record_id = None
+    rec_sims = None
+    for similarity in similarities:
+        if similarity['from_record_id'] != from_record_id:
+            if from_record_id is not None:
+                record_sims[from_record_id] = cut(rec_sims)
+                if len(record_sims) >= chunk_size:
+                    num_sims += write_chunk(record_sims, records)
+                    record_sims = OrderedDict()
+                    records = {}
+            from_record_id = similarity['from_record_id']
+            # A from record that is still queued continues its group
+            rec_sims = record_sims.pop(from_record_id, {})
+
+        to_record_id = similarity['to_record_id']
+        records.setdefault(
+            from_record_id, similarity['from_record_is_internal'])
+        records.setdefault(
+            to_record_id, similarity['to_record_is_internal'])
+
+        rec_sims.pop(to_record_id, None)
+        rec_sims[to_record_id] = similarity['similarity_value']
+        # Keeps the memory per record bounded while reading
+        if len(rec_sims) >= 2 * max_sims_per_record:
+            rec_sims = cut(rec_sims)
+
+    if from_record_id is not None:
+        record_sims[from_record_id] = cut(rec_sims)
+    if record_sims:
+        num_sims += write_chunk(record_sims, records)
+
+    return len(imported_records), num_sims
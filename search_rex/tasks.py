@@ -21,8 +21,19 @@ logger = get_task_logger(__name__)
 @periodic_task(run_every=timedelta(minutes=30))
 def refresh():
     """
-    Calls the recommender instances' refresh function every 30 minutes
+    Refreshes the recommender instances in place every 30 minutes so that
+    they pick up the latest actions
     """
     logger.info("Start refreshing")
-    refresh_recommenders()
+    refresh_recommenders(rebuild=False)
     logger.info("Refreshing finished")
+
+
+@periodic_task(run_every=timedelta(days=1))
+def rebuild():
+    """
+    Rebuilds the recommender instances from scratch once a day
+    """
+    logger.info("Start rebuilding")
+    refresh_recommenders()
+    logger.info("Rebuilding finished")
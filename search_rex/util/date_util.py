@@ -7,3 +7,10 @@ def _utcnow():
 
 def utcnow():
     return _utcnow()
+
+
+def total_microseconds(delta):
+    """
+    Returns the exact number of microseconds of the timedelta
+    """
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
@@ -0,0 +1,328 @@
+"""
+Read-only dictionaries whose content is held by a few numpy arrays instead of
+one Python object per entry. When such a dictionary is stored in a snapshot,
+its arrays are written to the array file, so the processes that load the
+snapshot map the same memory instead of unpickling a private copy of the
+dictionary. The entries are only turned into Python objects when they are
+looked up.
+"""
+
+from array import array
+from binascii import crc32
+from collections import Mapping
+from collections import MutableMapping
+from itertools import izip
+import numpy as np
+
+
+def encode_string(string):
+    """
+    Returns the UTF-8 encoding of a unicode string
+    """
+    if isinstance(string, unicode):
+        return string.encode('utf-8')
+    return string
+
+
+def hash_string(encoded_string):
+    """
+    Maps an encoded string to a 32 bit integer that, unlike the built-in hash,
+    is the same in every process
+    """
+    return crc32(encoded_string) & 0xffffffff
+
+
+class StringTable(object):
+    """
+    An immutable list of strings. The strings are encoded in UTF-8 and
+    concatenated in the array data, such that string i occupies the range
+    offsets[i] to offsets[i+1]. The position of a string is looked up by
+    bisection on the sorted hashes of the strings
+    """
+
+    def __init__(self, strings):
+        """
+        :param strings: the strings in the order of their positions
+        """
+        encoded_strings = [encode_string(string) for string in strings]
+        self.data = np.frombuffer(''.join(encoded_strings), dtype=np.uint8)
+        self.offsets = np.zeros(len(encoded_strings)+1, dtype=np.int64)
+        np.cumsum(
+            [len(encoded) for encoded in encoded_strings],
+            out=self.offsets[1:])
+        hashes = np.array(
+            [hash_string(encoded) for encoded in encoded_strings],
+            dtype=np.uint32)
+        self.order = np.argsort(hashes, kind='mergesort').astype(np.int32)
+        self.hashes = hashes[self.order]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.__get_encoded(i).decode('utf-8')
+
+    def __iter__(self):
+        data = self.data
+        offsets = self.offsets.tolist()
+        for i in xrange(len(offsets)-1):
+            yield data[offsets[i]:offsets[i+1]].tostring().decode('utf-8')
+
+    def __contains__(self, string):
+        return self.get_index(string) is not None
+
+    def __get_encoded(self, i):
+        return self.data[self.offsets[i]:self.offsets[i+1]].tostring()
+
+    def get_index(self, string):
+        """
+        Returns the position of the string or None if the table does not
+        contain it
+        """
+        encoded = encode_string(string)
+        string_hash = np.uint32(hash_string(encoded))
+        start = self.hashes.searchsorted(string_hash, side='left')
+        end = self.hashes.searchsorted(string_hash, side='right')
+        for i in self.order[start:end].tolist():
+            if self.__get_encoded(i) == encoded:
+                return i
+        return None
+
+
+class FloatCodec(object):
+    """
+    Converts the float values of a PackedRows to a single field
+    """
+    dtypes = (np.float64,)
+
+    @staticmethod
+    def encode(value):
+        return (value,)
+
+    @staticmethod
+    def decode(value):
+        return value
+
+
+class PackedDict(Mapping):
+    """
+    A read-only dictionary of strings to numbers or to lists of numbers of
+    the same length
+    """
+
+    def __init__(self, items, dtype=np.float64):
+        """
+        :param items: an iterator over the keys and their values
+        :param dtype: the type of the array that holds the values
+        """
+        keys = []
+        values = []
+        for key, value in items:
+            keys.append(key)
+            values.append(value)
+        self.key_table = StringTable(keys)
+        self.values = np.array(values, dtype=dtype)
+
+    def __len__(self):
+        return len(self.key_table)
+
+    def __iter__(self):
+        return iter(self.key_table)
+
+    def __contains__(self, key):
+        return self.key_table.get_index(key) is not None
+
+    def __getitem__(self, key):
+        i = self.key_table.get_index(key)
+        if i is None:
+            raise KeyError(key)
+        return self.values[i].tolist()
+
+    def iteritems(self):
+        return izip(self.key_table, self.values.tolist())
+
+
+class PackedRows(Mapping):
+    """
+    A read-only dictionary of strings to rows, i.e., to dictionaries of
+    strings to values. The rows are stored in the compressed sparse row form:
+    the entries of row i occupy the range indptr[i] to indptr[i+1] of the
+    column ids and of the field arrays. A codec converts each value to the
+    tuple of its fields, whose types are given by the codec's dtypes, and
+    back again. A row is turned into a dictionary when it is looked up. The
+    row that was looked up last is kept, so looking up many entries of the
+    same row is nearly as fast as with a dictionary. Like the rows of the
+    components' dictionaries, the rows must not be modified
+    """
+
+    def __init__(self, rows, codec=FloatCodec):
+        """
+        :param rows: an iterator over the keys and their rows
+        :param codec: the codec of the values
+        """
+        keys = []
+        columns = []
+        column_index = {}
+        indptr = array('l', [0])
+        column_ids = array('i')
+        fields = [[] for _ in codec.dtypes]
+        for key, row in rows:
+            keys.append(key)
+            for column, value in row.iteritems():
+                column_id = column_index.get(column)
+                if column_id is None:
+                    column_id = len(columns)
+                    column_index[column] = column_id
+                    columns.append(column)
+                column_ids.append(column_id)
+                for field, field_value in izip(fields, codec.encode(value)):
+                    field.append(field_value)
+            indptr.append(len(column_ids))
+
+        self.codec = codec
+        self.key_table = StringTable(keys)
+        self.column_table = StringTable(columns)
+        self.indptr = np.frombuffer(indptr, dtype=np.int_).astype(np.int64)
+        self.column_ids = np.frombuffer(
+            column_ids, dtype=np.intc).astype(np.int32)
+        self.fields = tuple(
+            np.array(field, dtype=dtype)
+            for field, dtype in izip(fields, codec.dtypes))
+        self.last_row = (None, {})
+
+    def __len__(self):
+        return len(self.key_table)
+
+    def __iter__(self):
+        return iter(self.key_table)
+
+    def __contains__(self, key):
+        return self.key_table.get_index(key) is not None
+
+    def __getitem__(self, key):
+        last_key, row = self.last_row
+        if last_key is None or last_key != key:
+            i = self.key_table.get_index(key)
+            row = self.get_row(i) if i is not None else None
+            self.last_row = (key, row)
+        if row is None:
+            raise KeyError(key)
+        return row
+
+    def get_row(self, i):
+        """
+        Returns the row at position i as a dictionary
+        """
+        start, end = self.indptr[i], self.indptr[i+1]
+        columns = self.column_table
+        decode = self.codec.decode
+        field_values = [
+            field[start:end].astype(object).tolist() for field in self.fields]
+        return {
+            columns[column_id]: decode(*values)
+            for column_id, values in izip(
+                self.column_ids[start:end].tolist(), izip(*field_values))
+        }
+
+    def get_value(self, key, column, default=None):
+        """
+        Returns the value of a single entry or the default if there is no
+        such entry
+        """
+        return self.get(key, {}).get(column, default)
+
+    def iteritems(self):
+        for i, key in enumerate(self.key_table):
+            yield key, self.get_row(i)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['last_row'] = (None, {})
+        return state
+
+
+class OverlayDict(MutableMapping):
+    """
+    A dictionary that consists of a read-only base dictionary, e.g., a
+    PackedRows, and the entries that were set since. The base dictionary is
+    never modified, so the memory it shares with other processes stays
+    shared when a few of its entries are replaced
+    """
+
+    def __init__(self, base, updates=None):
+        """
+        :param base: the read-only base dictionary
+        :param updates: the dictionary of the entries that replace or extend
+        the ones of the base dictionary
+        """
+        self.base = base
+        self.updates = dict(updates or {})
+
+    def __len__(self):
+        return len(self.base) + sum(
+            1 for key in self.updates if key not in self.base)
+
+    def __iter__(self):
+        updates = self.updates
+        for key in self.base:
+            if key not in updates:
+                yield key
+        for key in updates:
+            yield key
+
+    def __contains__(self, key):
+        return key in self.updates or key in self.base
+
+    def __getitem__(self, key):
+        if key in self.updates:
+            return self.updates[key]
+        return self.base[key]
+
+    def __setitem__(self, key, value):
+        self.updates[key] = value
+
+    def __delitem__(self, key):
+        raise NotImplementedError()
+
+    def iteritems(self):
+        updates = self.updates
+        for key, value in self.base.iteritems():
+            if key not in updates:
+                yield key, value
+        for item in updates.iteritems():
+            yield item
+
+    def get_value(self, key, column, default=None):
+        """
+        Returns the value of a single entry of the row or the default if
+        there is no such entry
+        """
+        row = self.updates.get(key)
+        if row is not None:
+            return row.get(column, default)
+        return get_row_value(self.base, key, column, default)
+
+
+def copy_for_update(mapping):
+    """
+    Returns a copy of a dictionary that can be modified. A packed dictionary
+    is not copied but overlaid by the modifications
+    """
+    if isinstance(mapping, OverlayDict):
+        return OverlayDict(mapping.base, mapping.updates)
+    if isinstance(mapping, (PackedDict, PackedRows)):
+        return OverlayDict(mapping)
+    return dict(mapping)
+
+
+def get_row_value(rows, key, column, default=None):
+    """
+    Returns the entry rows[key][column] of a dictionary of rows or the default
+    if there is no such entry
+    """
+    if isinstance(rows, (PackedRows, OverlayDict)):
+        return rows.get_value(key, column, default)
+    row = rows.get(key)
+    if row is None:
+        return default
+    return row.get(column, default)
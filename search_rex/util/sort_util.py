@@ -0,0 +1,16 @@
+import heapq
+
+
+def top_k(items, k, key=None):
+    """
+    Returns the k largest items in descending order
+
+    The result equals sorted(items, key=key, reverse=True)[:k], i.e., items
+    with equal keys keep their original order, but only a heap of k items is
+    maintained. If k is None, all items are returned sorted
+    """
+    if k is None:
+        return sorted(items, key=key, reverse=True)
+    if k <= 0:
+        return []
+    return heapq.nlargest(k, items, key=key)
@@ -3,7 +3,12 @@ In this module, the views of the recommender API are defined. According to
 their definition, views are functions that take a web request and return a
 web response. Therefore, they are the main entry points of the recommender
 system. Moreover, they describe what the system is capable of and how the
-system is accessed.
+system is accessed. The responses of the recommendation views include the
+version of the model the recommendations have been generated from. If the
+response cache is enabled, the results of the recommendation views are
+cached per model version. The metrics view reports the counters of the
+write-behind buffer and of the response cache of the process that serves the
+request.
 """
 
 from core import InvalidUsage
@@ -12,15 +17,20 @@ from flask import jsonify
 from flask import Blueprint
 from flask import current_app
 from flask.ext.restful.inputs import datetime_from_iso8601
+from werkzeug.wsgi import make_line_iter
 from functools import wraps
 
 import logging
 
 from services import report_view_action
 from services import report_copy_action
+from services import report_actions_bulk
 import services
+from models import ActionType
 
 from .recommendations import get_recommender
+from .recommendations.response_cache import get_cached_result
+from .recommendations.response_cache import get_response_cache_metrics
 
 
 logger = logging.getLogger(__name__)
@@ -145,6 +155,101 @@ def copy():
     return jsonify(success=True)
 
 
+def parse_action(action, index):
+    """
+    Parses an action of a batch
+
+    Throws an InvalidUsage exception if a field is missing or malformed
+    """
+    if not isinstance(action, dict):
+        raise InvalidUsage(
+            u'Action {} is not an object'.format(index),
+            status_code=400)
+
+    def parse_field(field_name, type=None, required=True):
+        if field_name not in action or action[field_name] is None:
+            if required:
+                raise InvalidUsage(
+                    u'Missing required field {} in action {}'.format(
+                        field_name, index),
+                    status_code=400)
+            return None
+        value = action[field_name]
+        if type is not None:
+            try:
+                value = type(value)
+            except (ValueError, TypeError, AttributeError):
+                raise InvalidUsage(
+                    u'Field {} of action {} could not be parsed'.format(
+                        field_name, index),
+                    status_code=400)
+        return value
+
+    action_type = parse_field('action_type')
+    if action_type not in (ActionType.view, ActionType.copy):
+        raise InvalidUsage(
+            u'Field action_type of action {} could not be parsed'.format(
+                index),
+            status_code=400)
+
+    return {
+        'record_id': parse_field('record_id', type=unicode),
+        'is_internal_record': parse_field(
+            'is_internal_record', type=parse_json_bool),
+        'session_id': parse_field('session_id', type=unicode),
+        'timestamp': parse_field('timestamp', type=datetime_from_iso8601),
+        'action_type': action_type,
+        'query_string': parse_field(
+            'query_string', type=unicode, required=False),
+    }
+
+
+def parse_json_bool(value):
+    """
+    Parsing function for bool values that are given as JSON booleans or as
+    strings
+    """
+    if isinstance(value, bool):
+        return value
+    return parse_bool(value)
+
+
+@rec_api.route('/api/actions/batch', methods=['POST'])
+@api_key_required
+def report_actions_batch():
+    """
+    Stores a batch of view and copy actions in a single transaction
+
+    The body is a JSON object whose field actions holds the list of actions.
+    Each action consists of the record_id, is_internal_record, session_id,
+    timestamp, action_type (view/copy) and optionally the query_string.
+    Duplicate actions are only stored once
+    """
+    body = request.get_json(force=True, silent=True)
+    if not isinstance(body, dict) or not isinstance(
+            body.get('actions'), list):
+        raise InvalidUsage(
+            u'Missing required field actions', status_code=400)
+
+    max_actions = current_app.config.get('MAX_ACTIONS_PER_BATCH', 1000)
+    if len(body['actions']) > max_actions:
+        raise InvalidUsage(
+            u'Too many actions, at most {} are allowed'.format(max_actions),
+            status_code=413)
+
+    actions = [
+        parse_action(action, index)
+        for index, action in enumerate(body['actions'])
+    ]
+
+    current_app.logger.info(
+        'Batch of %d actions received', len(actions))
+
+    num_actions = report_actions_bulk(actions)
+
+    return jsonify(success=True, num_actions=num_actions)
+
+
 @rec_api.route('/api/influenced_by_your_history', methods=['GET'])
 @api_key_required
 def influenced_by_your_history():
@@ -169,12 +274,17 @@ def influenced_by_your_history():
         session_id)
 
     recommender = get_recommender(include_internal_records)
-    recs = recommender.influenced_by_your_history(
-        session_id=session_id, max_num_recs=max_num_recs)
+    model_version = recommender.version
+    results = get_cached_result(
+        'influenced_by_your_history', (session_id, max_num_recs),
+        include_internal_records, model_version,
+        lambda: [
+            {'record_id': record_id, 'score': score}
+            for record_id, score in recommender.influenced_by_your_history(
+                session_id=session_id, max_num_recs=max_num_recs)
+        ])
 
-    return jsonify(results=[
-        {'record_id': record_id, 'score': score} for record_id, score in recs
-    ])
+    return jsonify(results=results, model_version=model_version)
 
 
 @rec_api.route('/api/other_users_also_used', methods=['GET'])
@@ -200,12 +310,17 @@ def other_users_also_used():
         record_id)
 
     recommender = get_recommender(include_internal_records)
-    recs = recommender.other_users_also_used(
-        record_id, max_num_recs=max_num_recs)
+    model_version = recommender.version
+    results = get_cached_result(
+        'other_users_also_used', (record_id, max_num_recs),
+        include_internal_records, model_version,
+        lambda: [
+            {'record_id': r_id, 'score': score}
+            for r_id, score in recommender.other_users_also_used(
+                record_id, max_num_recs=max_num_recs)
+        ])
 
-    return jsonify(results=[
-        {'record_id': r_id, 'score': score} for r_id, score in recs
-    ])
+    return jsonify(results=results, model_version=model_version)
 
 
 @rec_api.route('/api/recommended_search_results', methods=['GET'])
@@ -231,10 +346,16 @@ def recommended_search_results():
         query_string)
 
     recommender = get_recommender(include_internal_records)
-    recs = recommender.recommend_search_results(
-        query_string, max_num_recs=max_num_recs)
+    model_version = recommender.version
+    results = get_cached_result(
+        'recommended_search_results', (query_string, max_num_recs),
+        include_internal_records, model_version,
+        lambda: [
+            rec.serialize() for rec in recommender.recommend_search_results(
+                query_string, max_num_recs=max_num_recs)
+        ])
 
-    return jsonify(results=[rec.serialize() for rec in recs])
+    return jsonify(results=results, model_version=model_version)
 
 
 @rec_api.route('/api/similar_queries', methods=['GET'])
@@ -244,21 +365,44 @@ def similar_queries():
     Returns a list of queries which are similar to the target query
 
     :param query_string: the query that was entered by the user
+    :param max_num_recs: the maximum number of queries to return
     """
 
     query_string = parse_arg(request, 'query_string', required=True)
+    max_num_recs = parse_arg(
+        request, 'max_num_recs', required=False, type=int)
 
     current_app.logger.info(
         'Similar Queries Request received: %s', query_string)
 
-    similar_queries = get_recommender(True).get_similar_queries(
-        query_string)
+    recommender = get_recommender(True)
+    model_version = recommender.version
+    results = get_cached_result(
+        'similar_queries', (query_string, max_num_recs), True, model_version,
+        lambda: list(recommender.get_similar_queries(
+            query_string, max_num_recs=max_num_recs)))
 
     return jsonify(
-        {'results': [sim_q for sim_q in similar_queries]}
+        {
+            'results': results,
+            'model_version': model_version,
+        }
     )
 
 
+@rec_api.route('/api/metrics', methods=['GET'])
+@api_key_required
+def metrics():
+    """
+    Returns the counters of the write-behind buffer and of the response cache
+    of the process that serves the request. The counters of a buffer or cache
+    that is not enabled are null
+    """
+    return jsonify(
+        write_behind=services.get_write_behind_metrics(),
+        response_cache=get_response_cache_metrics())
+
+
 @rec_api.route('/api/set_record_active', methods=['GET'])
 @api_key_required
 def set_record_active():
@@ -311,6 +455,54 @@ def import_record_similarity():
     return jsonify(success=True)
 
 
+SIMILARITY_FORMATS = {
+    'text/csv': 'csv',
+    'application/x-ndjson': 'ndjson',
+}
+
+
+@rec_api.route('/api/import_record_similarities', methods=['POST'])
+@api_key_required
+def import_record_similarities():
+    """
+    Imports the similarities that are uploaded in the body of the request as
+    CSV or NDJSON and replaces the similarities of their from records
+
+    The body is parsed line by line while it is read from the stream, so the
+    upload is never held in memory as a whole. The format is given by the
+    format parameter or else by the content type (text/csv or
+    application/x-ndjson)
+
+    :param format: the format of the body, either csv or ndjson
+    :param max_sims_per_record: max numbers of similarities per record
+    """
+    format = parse_arg(request, 'format', required=False)
+    if format is None:
+        format = SIMILARITY_FORMATS.get(request.mimetype)
+    if format not in SIMILARITY_FORMATS.values():
+        raise InvalidUsage(
+            u'Parameter format could not be parsed', status_code=400)
+    max_sims_per_record = parse_arg(
+        request, 'max_sims_per_record', default_value=100, type=int)
+    if max_sims_per_record <= 0:
+        raise InvalidUsage(
+            u'Parameter max_sims_per_record could not be parsed',
+            status_code=400)
+
+    current_app.logger.info('Similarity import received. Format: %s', format)
+
+    try:
+        num_records, num_sims = services.import_record_similarities_bulk(
+            services.parse_similarities(
+                make_line_iter(request.stream), format),
+            max_sims_per_record=max_sims_per_record)
+    except services.MalformedSimilarityException as e:
+        raise InvalidUsage(unicode(e.args[0]), status_code=400)
+
+    return jsonify(
+        success=True, num_records=num_records, num_similarities=num_sims)
+
+
 @rec_api.errorhandler(InvalidUsage)
 def handle_invalid_usage(error):
     response = jsonify(error.to_dict())
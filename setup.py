@@ -12,5 +12,7 @@ setup(
         'SQLAlchemy',
         'Celery',
         'Flask-RESTful',
+        'numpy',
+        'scipy',
     ]
 )
@@ -1,6 +1,15 @@
 from test_base import BaseTestCase
 from datetime import datetime
 from json import loads
+from json import dumps
+from search_rex.models import Action
+from search_rex.models import ImportedRecordSimilarity
+from search_rex import services
+from search_rex.recommendations.response_cache import enable_response_cache
+from search_rex.recommendations.response_cache import\
+    disable_response_cache
+from flask import request
+import mock
 
 
 URL = '/api/'
@@ -35,6 +44,180 @@ class TestParameters(BaseTestCase):
             'Parameter timestamp could not be parsed'
 
 
+    def post_actions(self, body):
+        return self.client.post(
+            create_request(
+                URL + 'actions/batch',
+                {'api_key': self.app.config['API_KEY']}),
+            data=dumps(body), content_type='application/json')
+
+    def test__actions_batch__actions_stored(self):
+        action = dict(
+            record_id='Secret document',
+            is_internal_record=True,
+            session_id='5556',
+            timestamp=datetime(1999, 12, 24).isoformat(),
+            action_type='view',
+        )
+        copy_action = dict(action, action_type='copy', query_string='hello')
+
+        response = self.post_actions(
+            {'actions': [action, copy_action, action]})
+
+        assert response.status_code == 200
+        assert loads(response.data)['num_actions'] == 2
+        assert Action.query.count() == 2
+
+    def test__actions_batch__missing_field(self):
+        response = self.post_actions({'actions': [dict(
+            record_id='Secret document',
+            is_internal_record=True,
+            timestamp=datetime(1999, 12, 24).isoformat(),
+            action_type='view',
+        )]})
+
+        assert response.status_code == 400
+        assert loads(response.data)['message'] ==\
+            'Missing required field session_id in action 0'
+        assert Action.query.count() == 0
+
+    def test__actions_batch__wrong_action_type(self):
+        response = self.post_actions({'actions': [dict(
+            record_id='Secret document',
+            is_internal_record=True,
+            session_id='5556',
+            timestamp=datetime(1999, 12, 24).isoformat(),
+            action_type='print',
+        )]})
+
+        assert response.status_code == 400
+        assert loads(response.data)['message'] ==\
+            'Field action_type of action 0 could not be parsed'
+
+    def test__actions_batch__no_actions_list(self):
+        response = self.post_actions({'action': []})
+
+        assert response.status_code == 400
+
+    def test__actions_batch__too_many_actions(self):
+        self.app.config['MAX_ACTIONS_PER_BATCH'] = 1
+        response = self.post_actions({'actions': [{}, {}]})
+        self.app.config['MAX_ACTIONS_PER_BATCH'] = 1000
+
+        assert response.status_code == 413
+
+
+    def test__import_record_similarities__csv_stored(self):
+        body = (
+            'from_record_id,from_record_is_internal,to_record_id,'
+            'to_record_is_internal,similarity_value\n'
+            'tree,true,forest,false,0.5\n'
+            'tree,true,moor,false,0.7\n'
+        )
+        response = self.client.post(
+            create_request(
+                URL + 'import_record_similarities',
+                {'api_key': self.app.config['API_KEY'],
+                 'max_sims_per_record': 1}),
+            data=body, content_type='text/csv')
+
+        assert response.status_code == 200
+        assert loads(response.data)['num_similarities'] == 1
+        sim = ImportedRecordSimilarity.query.one()
+        assert (sim.to_record_id, sim.similarity_value) == ('moor', 0.7)
+
+    def test__import_record_similarities__body_parsed_while_streamed(self):
+        body = (
+            'from_record_id,from_record_is_internal,to_record_id,'
+            'to_record_is_internal,similarity_value\n' +
+            ''.join(
+                'tree,true,forest{},false,0.5\n'.format(i)
+                for i in xrange(2000))
+        )
+        stream_positions = []
+
+        def import_similarities(similarities, max_sims_per_record):
+            next(similarities)
+            stream_positions.append(request.stream.tell())
+            return 1, 1 + sum(1 for _ in similarities)
+
+        with mock.patch.object(
+                services, 'import_record_similarities_bulk',
+                side_effect=import_similarities):
+            response = self.client.post(
+                create_request(
+                    URL + 'import_record_similarities',
+                    {'api_key': self.app.config['API_KEY']}),
+                data=body, content_type='text/csv')
+
+        assert response.status_code == 200
+        assert loads(response.data)['num_similarities'] == 2000
+        assert stream_positions[0] < len(body)
+
+    def test__import_record_similarities__malformed_line(self):
+        response = self.client.post(
+            create_request(
+                URL + 'import_record_similarities',
+                {'api_key': self.app.config['API_KEY'],
+                 'format': 'ndjson'}),
+            data='{"from_record_id": "tree"}\n',
+            content_type='application/octet-stream')
+
+        assert response.status_code == 400
+        assert loads(response.data)['message'] ==\
+            'Line 1: Missing field from_record_is_internal'
+
+    def test__import_record_similarities__unknown_format(self):
+        response = self.client.post(
+            create_request(
+                URL + 'import_record_similarities',
+                {'api_key': self.app.config['API_KEY']}),
+            data='', content_type='application/octet-stream')
+
+        assert response.status_code == 400
+
+
+    def get_metrics(self):
+        response = self.client.get(
+            create_request(
+                URL + 'metrics', {'api_key': self.app.config['API_KEY']}))
+        assert response.status_code == 200
+        return loads(response.data)
+
+    def test__metrics__write_behind_disabled(self):
+        assert self.get_metrics()['write_behind'] is None
+
+    def test__metrics__write_behind_counters(self):
+        services.start_write_behind(self.app)
+        try:
+            services.report_view_action(
+                record_id='tree', is_internal_record=False,
+                session_id='5556', timestamp=datetime(1999, 12, 24))
+            write_behind = self.get_metrics()['write_behind']
+        finally:
+            services.stop_write_behind()
+
+        assert write_behind['num_enqueued'] == 1
+        assert write_behind['num_failed'] == 0
+
+
+    def test__metrics__response_cache_disabled(self):
+        assert self.get_metrics()['response_cache'] is None
+
+    def test__metrics__response_cache_counters(self):
+        cache = enable_response_cache()
+        try:
+            for _ in xrange(2):
+                cache.get_or_compute(
+                    'similar_queries', ('tree', 10), True, 1, lambda: [])
+            response_cache = self.get_metrics()['response_cache']
+        finally:
+            disable_response_cache()
+
+        assert response_cache['similar_queries']['num_hits'] == 1
+        assert response_cache['similar_queries']['num_misses'] == 1
+
+
 def create_throws_400_test(view_to_test, parameters, leave_out_pm):
 
     def do_test_expected(self):
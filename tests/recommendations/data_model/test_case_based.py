@@ -7,21 +7,21 @@ from search_rex.recommendations.data_model.case_based import\
 from search_rex.recommendations.data_model.case_based import\
     Hit
 from search_rex.recommendations import queries
+from search_rex.util.packed_dict import PackedRows
 from datetime import datetime
 from datetime import timedelta
-from search_rex.models import Action
 from search_rex.models import ActionType
 import mock
+from collections import namedtuple
 from search_rex.util import date_util
 
 
+ActionRow = namedtuple(
+    'ActionRow', ['record_id', 'session_id', 'action_type', 'time_created'])
+
+
 def create_action(action_type, query_str, record_id, time_created):
-    action = Action()
-    action.action_type = action_type
-    action.record_id = record_id
-    action.time_created = time_created
-    action.query_str = query_str
-    return action
+    return ActionRow(record_id, 'session', action_type, time_created)
 
 
 def assert_hit_equal(hit1, hit2):
@@ -223,6 +223,30 @@ def test__in_mem_dm__get_hit_rows():
             assert hits[query][record] == hit
 
 
+def test__in_mem_dm__get_hit_total():
+    query_rome = 'rome'
+    query_caesar = 'caesar'
+
+    record_brutus = 'brutus'
+    record_caesar = 'caesar'
+
+    hits = {
+        query_rome: {
+            record_caesar: Hit(1.0, datetime(1999, 1, 1)),
+            record_brutus: Hit(2.0, datetime(1999, 1, 1)),
+        },
+    }
+    fake_model = AbstractQueryDataModel()
+    fake_model.get_hit_rows = mock.Mock(
+        return_value=hits.iteritems())
+
+    sut = InMemoryQueryDataModel(fake_model)
+
+    assert sut.get_hit_total(query_rome) == 3.0
+    assert sut.get_hit_total(query_caesar) is None
+    assert fake_model.get_hit_total(query_rome) is None
+
+
 def test__in_mem_dm__get_hit_rows_for_queries():
     query_rome = 'rome'
     query_caesar = 'caesar'
@@ -351,3 +375,379 @@ def test__in_mem_dm__refresh__data_is_reloaded():
     for record_id, rec_prefs in sut.get_hit_rows():
         for session_id, pref in rec_prefs.iteritems():
             assert hits[record_id][session_id] == pref
+
+
+def test__pers_dm__get_hit_rows_since__decay_relative_to_reference_time():
+    record_caesar = 'caesar'
+    query_rome = 'rome'
+    rome_view_caesar = create_action(
+        ActionType.view, query_rome, record_caesar, datetime(1999, 1, 3))
+
+    queries.get_actions_for_queries = mock.Mock(
+        return_value={
+            query_rome: [rome_view_caesar]
+        }.iteritems())
+    date_util._utcnow = mock.Mock(return_value=datetime(1999, 1, 9))
+
+    sut = PersistentQueryDataModel(
+        include_internal_records=True, perform_time_decay=True,
+        time_interval=timedelta(days=1), half_life=1, max_age=4)
+
+    hits = list(sut.get_hit_rows_since(
+        datetime(1999, 1, 2), reference_time=datetime(1999, 1, 4)))
+
+    assert len(hits) == 1
+    query, query_hits = hits[0]
+    assert query == query_rome
+    assert_hit_equal(
+        query_hits[record_caesar], Hit(0.5, datetime(1999, 1, 3)))
+    queries.get_actions_for_queries.assert_called_once_with(
+        True, None, min_time_created=datetime(1999, 1, 2),
+        max_time_created=None)
+
+
+def test__pers_dm__age_hits():
+    hit = Hit(4.0, datetime(1999, 1, 1))
+    hit.num_views = 2
+    sut = PersistentQueryDataModel(
+        include_internal_records=True, perform_time_decay=True,
+        time_interval=timedelta(days=1), half_life=1)
+
+    aged_hits = sut.age_hits({'caesar': hit}, 2)
+
+    assert_hit_equal(aged_hits['caesar'], Hit(1.0, datetime(1999, 1, 1)))
+    assert aged_hits['caesar'].num_views == 2
+    assert hit.value == 4.0
+
+
+def test__pers_dm__get_elapsed_intervals():
+    sut = PersistentQueryDataModel(
+        include_internal_records=True, time_interval=timedelta(days=1))
+
+    assert sut.get_elapsed_intervals(
+        datetime(1999, 1, 1), datetime(1999, 1, 3, 12)) == 2
+    assert sut.get_elapsed_intervals(
+        datetime(1999, 1, 3), datetime(1999, 1, 1)) == 0
+
+
+def create_incremental_in_mem_dm(hits):
+    fake_model = PersistentQueryDataModel(
+        include_internal_records=True, perform_time_decay=True,
+        time_interval=timedelta(days=1), half_life=1)
+    fake_model.get_hit_rows_until = mock.Mock(return_value=hits.iteritems())
+    fake_model.get_actions_since = mock.Mock(return_value=iter([]))
+
+    date_util._utcnow = mock.Mock(return_value=datetime(1999, 1, 10))
+    sut = InMemoryQueryDataModel(
+        fake_model, full_refresh_interval=timedelta(days=7),
+        overlap_window=timedelta(minutes=10))
+    return fake_model, sut
+
+
+def test__in_mem_dm__incremental__init_loads_overlap_window_by_action():
+    fake_model, sut = create_incremental_in_mem_dm({})
+
+    fake_model.get_hit_rows_until.assert_called_once_with(
+        datetime(1999, 1, 9, 23, 50), datetime(1999, 1, 10))
+    fake_model.get_actions_since.assert_called_once_with(
+        datetime(1999, 1, 9, 23, 50))
+    assert sut.decay_time == datetime(1999, 1, 10)
+
+
+def test__in_mem_dm__incremental_refresh__new_hits_are_folded_in():
+    query_rome = 'rome'
+    query_caesar = 'caesar'
+    record_caesar = 'caesar'
+    record_brutus = 'brutus'
+
+    old_rome_row = {
+        record_caesar: Hit(1.0, datetime(1999, 1, 9)),
+    }
+    fake_model, sut = create_incremental_in_mem_dm({query_rome: old_rome_row})
+    fake_model.get_actions_since.return_value = iter([
+        (query_rome, [
+            create_action(
+                ActionType.copy, query_rome, record_caesar,
+                datetime(1999, 1, 10, 1)),
+            create_action(
+                ActionType.view, query_rome, record_brutus,
+                datetime(1999, 1, 10, 2)),
+        ]),
+        (query_caesar, [
+            create_action(
+                ActionType.view, query_caesar, record_caesar,
+                datetime(1999, 1, 10, 3)),
+        ]),
+    ])
+
+    date_util._utcnow = mock.Mock(return_value=datetime(1999, 1, 10, 6))
+    sut.refresh(set())
+
+    fake_model.get_actions_since.assert_called_with(
+        datetime(1999, 1, 9, 23, 50))
+    assert fake_model.get_hit_rows_until.call_count == 1
+    hit_mat = {q: hits for q, hits in sut.get_hit_rows()}
+    # The old hit is decayed relative to the end of the current day
+    assert_hit_equal(
+        hit_mat[query_rome][record_caesar],
+        Hit(2.5, datetime(1999, 1, 10, 1)))
+    assert_hit_equal(
+        hit_mat[query_rome][record_brutus],
+        Hit(1.0, datetime(1999, 1, 10, 2)))
+    assert_hit_equal(
+        hit_mat[query_caesar][record_caesar],
+        Hit(1.0, datetime(1999, 1, 10, 3)))
+    assert sut.watermark == datetime(1999, 1, 10, 3)
+    assert sut.decay_time == datetime(1999, 1, 11)
+    assert sut.get_hit_total(query_rome) == 3.5
+    assert sut.get_hit_total(query_caesar) == 1.0
+    assert sut.window_start == datetime(1999, 1, 10, 5, 50)
+    assert sut.recent_actions == {}
+    # The rows that were handed out before are left untouched
+    assert_hit_equal(
+        old_rome_row[record_caesar], Hit(1.0, datetime(1999, 1, 9)))
+    assert record_brutus not in old_rome_row
+
+
+def test__in_mem_dm__incremental_refresh__late_actions_folded_in_once():
+    query_rome = 'rome'
+    record_caesar = 'caesar'
+    record_brutus = 'brutus'
+    caesar_view = create_action(
+        ActionType.view, query_rome, record_caesar,
+        datetime(1999, 1, 10, 0, 5))
+    late_brutus_view = create_action(
+        ActionType.view, query_rome, record_brutus,
+        datetime(1999, 1, 10, 0, 1))
+
+    fake_model, sut = create_incremental_in_mem_dm({})
+    fake_model.get_actions_since.return_value = iter([
+        (query_rome, [caesar_view])])
+    date_util._utcnow = mock.Mock(return_value=datetime(1999, 1, 10, 0, 6))
+    sut.refresh(set())
+
+    # The view on brutus is written after the refresh, but it was created
+    # before the newest known action
+    fake_model.get_actions_since.return_value = iter([
+        (query_rome, [late_brutus_view, caesar_view])])
+    date_util._utcnow = mock.Mock(return_value=datetime(1999, 1, 10, 0, 8))
+    sut.refresh(set())
+
+    fake_model.get_actions_since.assert_called_with(
+        datetime(1999, 1, 9, 23, 56))
+    hit_mat = {q: hits for q, hits in sut.get_hit_rows()}
+    assert_hit_equal(
+        hit_mat[query_rome][record_caesar],
+        Hit(1.0, datetime(1999, 1, 10, 0, 5)))
+    assert_hit_equal(
+        hit_mat[query_rome][record_brutus],
+        Hit(1.0, datetime(1999, 1, 10, 0, 1)))
+    assert sut.get_hit_total(query_rome) == 2.0
+    assert sut.watermark == datetime(1999, 1, 10, 0, 5)
+
+
+def test__in_mem_dm__incremental_refresh__decay_applied_per_interval():
+    query_rome = 'rome'
+    record_caesar = 'caesar'
+
+    fake_model, sut = create_incremental_in_mem_dm({
+        query_rome: {
+            record_caesar: Hit(4.0, datetime(1999, 1, 9)),
+        }
+    })
+
+    date_util._utcnow = mock.Mock(return_value=datetime(1999, 1, 12, 6))
+    sut.refresh(set())
+
+    hit_mat = {q: hits for q, hits in sut.get_hit_rows()}
+    assert_hit_equal(
+        hit_mat[query_rome][record_caesar], Hit(0.5, datetime(1999, 1, 9)))
+    assert sut.get_hit_total(query_rome) == 0.5
+    assert sut.decay_time == datetime(1999, 1, 13)
+    fake_model.get_actions_since.assert_called_with(
+        datetime(1999, 1, 9, 23, 50))
+
+
+def test__in_mem_dm__incremental_refresh__same_hits_as_full_reload():
+    time_interval = timedelta(hours=5)
+    stored_actions = []
+
+    def get_actions_for_queries(
+            include_internal_records, query_strings=None, max_age=None,
+            min_time_created=None, max_time_created=None):
+        rows = {}
+        for query, action in stored_actions:
+            if min_time_created is not None and\
+                    action.time_created <= min_time_created:
+                continue
+            if max_time_created is not None and\
+                    action.time_created > max_time_created:
+                continue
+            rows.setdefault(query, []).append(action)
+        return rows.iteritems()
+
+    def store_actions(start, num_actions):
+        for i in xrange(num_actions):
+            query = ['rome', 'gaul'][i % 2]
+            record = ['caesar', 'brutus', 'cleopatra'][i % 3]
+            action = ActionRow(
+                record, 'session{}'.format(len(stored_actions)),
+                [ActionType.view, ActionType.copy][i % 5 == 0],
+                start + timedelta(minutes=37*i))
+            stored_actions.append((query, action))
+
+    queries.get_actions_for_queries = mock.Mock(
+        side_effect=get_actions_for_queries)
+
+    def create_sut():
+        return InMemoryQueryDataModel(
+            PersistentQueryDataModel(
+                include_internal_records=True, perform_time_decay=True,
+                time_interval=time_interval, half_life=3),
+            full_refresh_interval=timedelta(days=7),
+            overlap_window=timedelta(minutes=10))
+
+    store_actions(datetime(1999, 1, 1, 4, 13), 100)
+    date_util._utcnow = mock.Mock(return_value=datetime(1999, 1, 4, 7, 13))
+    sut = create_sut()
+
+    # The newest of these actions is created at 13:58
+    store_actions(datetime(1999, 1, 4, 7, 45), 50)
+    date_util._utcnow = mock.Mock(return_value=datetime(1999, 1, 5, 14))
+    sut.refresh(set())
+    # An action that is created before the newest one, but written late
+    store_actions(datetime(1999, 1, 5, 13, 55), 1)
+    date_util._utcnow = mock.Mock(return_value=datetime(1999, 1, 5, 19, 2))
+    sut.refresh(set())
+
+    full_reload = create_sut()
+
+    assert sorted(sut.get_queries()) == sorted(full_reload.get_queries())
+    for query, hits in full_reload.get_hit_rows():
+        incremental_hits = sut.hit_mat[query]
+        assert set(incremental_hits) == set(hits)
+        for record, hit in hits.iteritems():
+            assert abs(incremental_hits[record].value - hit.value) < 1e-9
+            assert incremental_hits[record].last_interaction ==\
+                hit.last_interaction
+        assert abs(
+            sut.get_hit_total(query) - full_reload.get_hit_total(query)) <\
+            1e-9
+
+
+def test__in_mem_dm__incremental_refresh__full_reload_after_interval():
+    query_rome = 'rome'
+    record_caesar = 'caesar'
+
+    hits = {}
+    fake_model, sut = create_incremental_in_mem_dm(hits)
+    hits[query_rome] = {
+        record_caesar: Hit(1.0, datetime(1999, 1, 16)),
+    }
+    fake_model.get_hit_rows_until.return_value = hits.iteritems()
+
+    date_util._utcnow = mock.Mock(return_value=datetime(1999, 1, 17))
+    sut.refresh(set())
+
+    assert fake_model.get_hit_rows_until.call_count == 2
+    fake_model.get_hit_rows_until.assert_called_with(
+        datetime(1999, 1, 16, 23, 50), datetime(1999, 1, 17))
+    assert sut.last_full_refresh == datetime(1999, 1, 17)
+    assert sut.watermark == datetime(1999, 1, 16)
+
+
+def test__pers_dm__get_reference_time__end_of_interval():
+    sut = PersistentQueryDataModel(
+        include_internal_records=True, time_interval=timedelta(hours=5))
+
+    assert sut.get_reference_time(datetime(1999, 1, 4, 7, 13)) ==\
+        datetime(1999, 1, 4, 10)
+    assert sut.get_reference_time(datetime(1999, 1, 4, 5)) ==\
+        datetime(1999, 1, 4, 5)
+
+
+def test__pers_dm__get_hit_rows__aggregate_in_database():
+    record_caesar = 'caesar'
+    query_rome = 'rome'
+    actions = [
+        create_action(
+            ActionType.view, query_rome, record_caesar, datetime(1999, 1, 3)),
+        create_action(
+            ActionType.view, query_rome, record_caesar, datetime(1999, 1, 4)),
+        create_action(
+            ActionType.copy, query_rome, record_caesar, datetime(1999, 1, 4)),
+    ]
+    cells = [
+        (record_caesar, 1, 1, 0, datetime(1999, 1, 3)),
+        (record_caesar, 0, 1, 1, datetime(1999, 1, 4)),
+    ]
+    queries.get_actions_for_queries = mock.Mock(
+        return_value={query_rome: actions}.iteritems())
+    queries.get_hit_cells_for_queries = mock.Mock(
+        return_value={query_rome: cells}.iteritems())
+    date_util._utcnow = mock.Mock(return_value=datetime(1999, 1, 4))
+
+    def create_sut(aggregate_in_database):
+        return PersistentQueryDataModel(
+            include_internal_records=True, perform_time_decay=True,
+            time_interval=timedelta(days=1), half_life=1, max_age=4,
+            aggregate_in_database=aggregate_in_database)
+
+    expected_hits = dict(create_sut(False).get_hit_rows())
+    hits = dict(create_sut(True).get_hit_rows())
+
+    hit = hits[query_rome][record_caesar]
+    expected_hit = expected_hits[query_rome][record_caesar]
+    assert_hit_equal(hit, Hit(3.5, datetime(1999, 1, 4)))
+    assert_hit_equal(hit, expected_hit)
+    assert hit.num_views == expected_hit.num_views == 2
+    assert hit.num_copies == expected_hit.num_copies == 1
+    queries.get_hit_cells_for_queries.assert_called_once_with(
+        True, datetime(1999, 1, 4), timedelta(days=1), None,
+        min_time_created=None, max_time_created=None)
+
+
+def test__pers_dm__get_hit_rows__aggregate_in_database__max_age():
+    queries.get_hit_cells_for_queries = mock.Mock(
+        return_value={'rome': [
+            ('caesar', 5, 1, 1, datetime(1999, 1, 1)),
+        ]}.iteritems())
+    date_util._utcnow = mock.Mock(return_value=datetime(1999, 1, 6))
+    sut = PersistentQueryDataModel(
+        include_internal_records=True, perform_time_decay=True,
+        time_interval=timedelta(days=1), half_life=1, max_age=4,
+        aggregate_in_database=True)
+
+    hits = dict(sut.get_hit_rows())
+
+    assert_hit_equal(hits['rome']['caesar'], Hit(0.0, datetime(1999, 1, 1)))
+
+
+def test__in_mem_dm__state__hit_matrix_is_packed():
+    caesar_hit = Hit(1.0, datetime(1999, 1, 1))
+    caesar_hit.num_copies = 1
+    caesar_hit.num_views = 2
+    hits = {
+        'rome': {
+            'caesar': caesar_hit,
+            'brutus': Hit(2.0, datetime(1999, 1, 2)),
+        },
+    }
+    fake_model = AbstractQueryDataModel()
+    fake_model.get_hit_rows = mock.Mock(return_value=hits.iteritems())
+    sut = InMemoryQueryDataModel(fake_model)
+
+    restored = InMemoryQueryDataModel.__new__(InMemoryQueryDataModel)
+    restored.__dict__.update(sut.__getstate__())
+
+    assert isinstance(restored.hit_mat, PackedRows)
+    assert restored.get_queries() == ['rome']
+    assert restored.get_hit_total('rome') == 3.0
+    assert restored.get_hit_total('gaul') is None
+    (query, q_hits), = restored.get_hit_rows_for_queries(['rome', 'gaul'])
+    assert query == 'rome'
+    assert sorted(q_hits.keys()) == ['brutus', 'caesar']
+    for record, hit in hits['rome'].iteritems():
+        assert_hit_equal(q_hits[record], hit)
+        assert q_hits[record].num_copies == hit.num_copies
+        assert q_hits[record].num_views == hit.num_views
@@ -5,11 +5,20 @@ from search_rex.recommendations.data_model.item_based import\
     AbstractRecordDataModel
 from search_rex.recommendations.data_model.item_based import\
     InMemoryRecordDataModel
+from search_rex.recommendations.data_model.item_based import\
+    SparseRecordDataModel
+from search_rex.recommendations.data_model.item_based import\
+    TimePartitioning
+from search_rex.recommendations.data_model import item_based as item_based_dm
+from datetime import timedelta
 from search_rex.recommendations import queries
+from search_rex.util.packed_dict import OverlayDict
+from search_rex.util.packed_dict import PackedRows
 from datetime import datetime
-from search_rex.models import Action
 from search_rex.models import ActionType
 import mock
+import math
+from collections import namedtuple
 
 
 def test__preference__init():
@@ -27,13 +36,12 @@ record_caesar = 'caesar'
 record_brutus = 'brutus'
 
 
+ActionRow = namedtuple(
+    'ActionRow', ['record_id', 'session_id', 'action_type', 'time_created'])
+
+
 def create_action(action_type, session_id, record_id, time_created):
-    action = Action()
-    action.session_id = session_id
-    action.action_type = action_type
-    action.record_id = record_id
-    action.time_created = time_created
-    return action
+    return ActionRow(record_id, session_id, action_type, time_created)
 
 
 def assert_pref_equal(pref1, pref2):
@@ -306,6 +314,80 @@ def test__in_mem_dm__get_preferences_of_session__session_not_present():
     assert sut.get_preferences_of_session('dogma') == {}
 
 
+def test__in_mem_dm__get_preferences_of_session__fall_back_on_unknown():
+    preferences = {
+        record_caesar: {
+            session_alice: Preference(1.0, datetime(1999, 1, 1)),
+        },
+    }
+    bob_prefs = {
+        record_brutus: Preference(1.0, datetime(1999, 1, 2)),
+    }
+    fake_model = AbstractRecordDataModel()
+    fake_model.get_preferences_for_records = mock.Mock(
+        return_value=preferences.iteritems())
+    fake_model.get_preferences_of_session = mock.Mock(
+        return_value=bob_prefs)
+
+    sut = InMemoryRecordDataModel(
+        fake_model, fall_back_on_unknown_sessions=True)
+
+    assert sut.get_preferences_of_session(session_bob) == bob_prefs
+    fake_model.get_preferences_of_session.assert_called_once_with(
+        session_bob)
+
+    sess_prefs = sut.get_preferences_of_session(session_alice)
+    assert sess_prefs == {
+        record_caesar: preferences[record_caesar][session_alice]}
+    assert fake_model.get_preferences_of_session.call_count == 1
+
+
+def test__in_mem_dm__time_partitions_are_assigned():
+    preferences = {
+        record_caesar: {
+            session_alice: Preference(1.0, datetime(1999, 1, 30)),
+            session_bob: Preference(2.0, datetime(1999, 1, 20)),
+        },
+    }
+    fake_model = AbstractRecordDataModel()
+    fake_model.get_preferences_for_records = mock.Mock(
+        return_value=preferences.iteritems())
+    item_based_dm.utcnow = mock.Mock(return_value=datetime(1999, 1, 31))
+
+    sut = InMemoryRecordDataModel(
+        fake_model, time_partitioning=TimePartitioning(
+            time_interval=timedelta(7), max_age=4))
+
+    rec_prefs = sut.get_preferences_for_record(record_caesar)
+    assert rec_prefs[session_alice].time_partition == 0
+    assert rec_prefs[session_bob].time_partition == 1
+
+
+def test__in_mem_dm__norms_are_computed():
+    preferences = {
+        record_caesar: {
+            session_alice: Preference(3.0, datetime(1999, 1, 30)),
+            session_bob: Preference(4.0, datetime(1999, 1, 20)),
+        },
+    }
+    fake_model = AbstractRecordDataModel()
+    fake_model.get_preferences_for_records = mock.Mock(
+        return_value=preferences.iteritems())
+    item_based_dm.utcnow = mock.Mock(return_value=datetime(1999, 1, 31))
+    time_partitioning = TimePartitioning(time_interval=timedelta(7), max_age=4)
+
+    sut = InMemoryRecordDataModel(
+        fake_model, time_partitioning=time_partitioning)
+
+    assert sut.get_record_norm(record_caesar) == 5.0
+    assert sut.get_record_norm(record_brutus) is None
+    assert sut.get_partition_squares(record_caesar, time_partitioning) ==\
+        [9.0, 16.0, 0.0, 0.0]
+    assert sut.get_partition_squares(
+        record_caesar, TimePartitioning(
+            time_interval=timedelta(7), max_age=4)) is None
+
+
 def test__in_mem_dm__refresh__underlying_data_model_is_refreshed():
     preferences = {
     }
@@ -345,3 +427,338 @@ def test__in_mem_dm__refresh__data_is_reloaded():
     for record_id, rec_prefs in sut.get_preferences_for_records():
         for session_id, pref in rec_prefs.iteritems():
             assert preferences[record_id][session_id] == pref
+
+
+sparse_preferences = {
+    record_caesar: {
+        session_alice: Preference(1.0, datetime(1999, 1, 1)),
+        session_bob: Preference(2.0, datetime(1999, 1, 2, 12, 30, 5, 7)),
+    },
+    record_brutus: {
+        session_alice: Preference(2.0, datetime(1999, 1, 3)),
+    }
+}
+
+
+def create_sparse_data_model(preferences):
+    fake_model = AbstractRecordDataModel()
+    fake_model.get_preferences_for_records = mock.Mock(
+        side_effect=lambda: preferences.iteritems())
+    fake_model.refresh = mock.Mock()
+    return SparseRecordDataModel(fake_model)
+
+
+def test__sparse_dm__get_records():
+    sut = create_sparse_data_model(sparse_preferences)
+
+    assert set(sut.get_records()) == set([record_caesar, record_brutus])
+
+
+def test__sparse_dm__get_preferences_for_record():
+    sut = create_sparse_data_model(sparse_preferences)
+
+    rec_prefs = sut.get_preferences_for_record(record_caesar)
+
+    assert set(rec_prefs.keys()) == set([session_alice, session_bob])
+    for session_id, pref in rec_prefs.iteritems():
+        assert_pref_equal(pref, sparse_preferences[record_caesar][session_id])
+
+
+def test__sparse_dm__get_preferences_for_record__record_not_present():
+    sut = create_sparse_data_model(sparse_preferences)
+
+    assert sut.get_preferences_for_record('dogma') == {}
+
+
+def test__sparse_dm__get_preferences_of_session():
+    sut = create_sparse_data_model(sparse_preferences)
+
+    sess_prefs = sut.get_preferences_of_session(session_alice)
+
+    assert set(sess_prefs.keys()) == set([record_caesar, record_brutus])
+    for record_id, pref in sess_prefs.iteritems():
+        assert_pref_equal(pref, sparse_preferences[record_id][session_alice])
+
+
+def test__sparse_dm__get_preferences_of_session__session_not_present():
+    sut = create_sparse_data_model(sparse_preferences)
+
+    assert sut.get_preferences_of_session('dogma') == {}
+
+
+def test__sparse_dm__get_preferences_for_records():
+    sut = create_sparse_data_model(sparse_preferences)
+
+    returned_preferences = dict(sut.get_preferences_for_records())
+
+    assert set(returned_preferences.keys()) == set(sparse_preferences.keys())
+    for record_id, rec_prefs in returned_preferences.iteritems():
+        assert len(rec_prefs) == len(sparse_preferences[record_id])
+        for session_id, pref in rec_prefs.iteritems():
+            assert_pref_equal(pref, sparse_preferences[record_id][session_id])
+
+
+def test__sparse_dm__refresh__data_is_reloaded():
+    preferences = {}
+    sut = create_sparse_data_model(preferences)
+
+    assert list(sut.get_preferences_for_records()) == []
+    assert sut.get_preferences_of_session(session_alice) == {}
+
+    preferences[record_caesar] = {
+        session_alice: Preference(1.0, datetime(1999, 1, 1)),
+    }
+    refreshed_components = set()
+    sut.refresh(refreshed_components)
+
+    assert sut.data_model in refreshed_components
+    assert sut in refreshed_components
+    assert_pref_equal(
+        sut.get_preferences_of_session(session_alice)[record_caesar],
+        preferences[record_caesar][session_alice])
+
+
+def test__pers_dm__merge_preferences():
+    sut = PersistentRecordDataModel(
+        include_internal_records=True, copy_action_weight=2.0,
+        view_action_weight=1.0)
+    view = Preference(1.0, datetime(1999, 1, 1))
+    later_view = Preference(1.0, datetime(1999, 1, 2))
+    copy = Preference(2.0, datetime(1999, 1, 1))
+    later_copy = Preference(2.0, datetime(1999, 1, 2))
+
+    assert sut.merge_preferences(view, later_view) is view
+    assert sut.merge_preferences(view, later_copy) is later_copy
+    assert sut.merge_preferences(copy, later_view) is copy
+    assert sut.merge_preferences(copy, later_copy) is later_copy
+    assert sut.merge_preferences(later_copy, later_copy) is later_copy
+
+
+def create_incremental_in_mem_dm(preferences, actions=()):
+    fake_model = PersistentRecordDataModel(include_internal_records=True)
+    fake_model.get_preferences_for_records_until = mock.Mock(
+        side_effect=lambda max_time_created: preferences.iteritems())
+    fake_model.get_actions_since = mock.Mock(return_value=iter(actions))
+    fake_model.get_preferences_from_actions = mock.Mock(
+        wraps=fake_model.get_preferences_from_actions)
+    item_based_dm.utcnow = mock.Mock(return_value=datetime(1999, 1, 10))
+
+    sut = InMemoryRecordDataModel(
+        fake_model, full_refresh_interval=timedelta(days=1),
+        overlap_window=timedelta(minutes=10))
+    return fake_model, sut
+
+
+def test__in_mem_dm__incremental_init__overlap_window_is_loaded_by_action():
+    fake_model, sut = create_incremental_in_mem_dm({
+        record_caesar: {
+            session_alice: Preference(1.0, datetime(1999, 1, 2)),
+        },
+    }, [
+        (record_caesar, [
+            ActionRow(record_caesar, session_bob, ActionType.view,
+                      datetime(1999, 1, 9, 23, 55)),
+        ]),
+    ])
+
+    fake_model.get_preferences_for_records_until.assert_called_once_with(
+        datetime(1999, 1, 9, 23, 50))
+    fake_model.get_actions_since.assert_called_once_with(
+        datetime(1999, 1, 9, 23, 50))
+    assert sorted(sut.get_preferences_for_record(record_caesar)) ==\
+        sorted([session_alice, session_bob])
+    assert sut.watermark == datetime(1999, 1, 9, 23, 55)
+    assert sut.window_start == datetime(1999, 1, 9, 23, 50)
+    assert sut.recent_actions == {
+        (record_caesar, session_bob, ActionType.view):
+            datetime(1999, 1, 9, 23, 55),
+    }
+    assert sut.get_touched_records() is None
+
+
+def test__in_mem_dm__incremental_refresh__new_preferences_are_merged():
+    caesar_prefs = {
+        session_alice: Preference(1.0, datetime(1999, 1, 2)),
+    }
+    fake_model, sut = create_incremental_in_mem_dm({
+        record_caesar: caesar_prefs,
+    })
+    alice_prefs = sut.get_preferences_of_session(session_alice)
+    fake_model.get_actions_since.return_value = iter([
+        (record_brutus, [
+            ActionRow(record_brutus, session_alice, ActionType.copy,
+                      datetime(1999, 1, 10, 3)),
+        ]),
+        (record_caesar, [
+            ActionRow(record_caesar, session_alice, ActionType.view,
+                      datetime(1999, 1, 10, 1)),
+            ActionRow(record_caesar, session_bob, ActionType.copy,
+                      datetime(1999, 1, 10, 2)),
+        ]),
+    ])
+    item_based_dm.utcnow = mock.Mock(return_value=datetime(1999, 1, 10, 6))
+
+    sut.refresh(set())
+
+    fake_model.get_actions_since.assert_called_with(
+        datetime(1999, 1, 9, 23, 50))
+    assert sorted(sut.get_records()) == sorted([record_caesar, record_brutus])
+    rec_prefs = sut.get_preferences_for_record(record_caesar)
+    assert_pref_equal(
+        rec_prefs[session_alice], Preference(1.0, datetime(1999, 1, 2)))
+    assert_pref_equal(
+        rec_prefs[session_bob], Preference(2.0, datetime(1999, 1, 10, 2)))
+    session_prefs = sut.get_preferences_of_session(session_alice)
+    assert sorted(session_prefs.keys()) ==\
+        sorted([record_caesar, record_brutus])
+    assert sut.get_touched_records() == set([record_caesar, record_brutus])
+    assert sut.watermark == datetime(1999, 1, 10, 3)
+    assert sut.get_record_norm(record_caesar) == math.sqrt(5.0)
+    assert sut.get_record_norm(record_brutus) == 2.0
+    # The window is moved and the actions before it are forgotten
+    assert sut.window_start == datetime(1999, 1, 10, 5, 50)
+    assert sut.recent_actions == {}
+    # The rows that were handed out before are left untouched
+    assert caesar_prefs.keys() == [session_alice]
+    assert alice_prefs.keys() == [record_caesar]
+
+
+def test__in_mem_dm__incremental_refresh__late_actions_merged_once():
+    known_action = ActionRow(
+        record_caesar, session_alice, ActionType.view,
+        datetime(1999, 1, 9, 23, 55))
+    fake_model, sut = create_incremental_in_mem_dm({}, [
+        (record_caesar, [known_action]),
+    ])
+    # The late action was created before the newest known action but was
+    # written to the database after the last refresh
+    late_action = ActionRow(
+        record_caesar, session_bob, ActionType.copy,
+        datetime(1999, 1, 9, 23, 52))
+    fake_model.get_actions_since.return_value = iter([
+        (record_caesar, [late_action, known_action]),
+    ])
+    item_based_dm.utcnow = mock.Mock(return_value=datetime(1999, 1, 10, 0, 1))
+
+    sut.refresh(set())
+
+    fake_model.get_preferences_from_actions.assert_called_with([late_action])
+    rec_prefs = sut.get_preferences_for_record(record_caesar)
+    assert_pref_equal(
+        rec_prefs[session_bob], Preference(2.0, datetime(1999, 1, 9, 23, 52)))
+    assert_pref_equal(
+        rec_prefs[session_alice],
+        Preference(1.0, datetime(1999, 1, 9, 23, 55)))
+    assert sut.get_touched_records() == set([record_caesar])
+    assert sut.watermark == datetime(1999, 1, 9, 23, 55)
+    assert sut.window_start == datetime(1999, 1, 9, 23, 51)
+    assert sorted(sut.recent_actions) == sorted([
+        tuple(known_action[:3]), tuple(late_action[:3])])
+
+
+def test__in_mem_dm__incremental_refresh__unchanged_records_not_touched():
+    fake_model, sut = create_incremental_in_mem_dm({
+        record_caesar: {
+            session_alice: Preference(1.0, datetime(1999, 1, 2)),
+        },
+    })
+    fake_model.get_actions_since.return_value = iter([
+        (record_caesar, [
+            ActionRow(record_caesar, session_alice, ActionType.view,
+                      datetime(1999, 1, 10, 1)),
+        ]),
+    ])
+
+    sut.refresh(set())
+
+    assert sut.get_touched_records() == set()
+
+
+def test__in_mem_dm__incremental_refresh__full_reload_after_interval():
+    preferences = {}
+    fake_model, sut = create_incremental_in_mem_dm(preferences)
+    preferences[record_caesar] = {
+        session_alice: Preference(1.0, datetime(1999, 1, 10)),
+    }
+    item_based_dm.utcnow = mock.Mock(return_value=datetime(1999, 1, 11))
+
+    sut.refresh(set())
+
+    fake_model.get_preferences_for_records_until.assert_called_with(
+        datetime(1999, 1, 10, 23, 50))
+    assert sut.get_touched_records() is None
+    assert sut.get_records() == [record_caesar]
+    assert sut.watermark == datetime(1999, 1, 10)
+
+
+def restore_state(sut):
+    restored = sut.__class__.__new__(sut.__class__)
+    restored.__dict__.update(sut.__getstate__())
+    return restored
+
+
+def test__in_mem_dm__state__matrices_are_packed():
+    time_partitioning = TimePartitioning(timedelta(days=1), max_age=4)
+    fake_model = AbstractRecordDataModel()
+    fake_model.get_preferences_for_records = mock.Mock(
+        return_value=iter([
+            (record_caesar, {
+                session_alice: Preference(1.0, datetime(1999, 1, 9)),
+                session_bob: Preference(2.0, datetime(1999, 1, 7)),
+            }),
+        ]))
+    item_based_dm.utcnow = mock.Mock(return_value=datetime(1999, 1, 10))
+    sut = InMemoryRecordDataModel(
+        fake_model, time_partitioning=time_partitioning)
+
+    restored = restore_state(sut)
+
+    assert isinstance(restored.record_session_mat, PackedRows)
+    assert isinstance(restored.session_record_mat, PackedRows)
+    assert restored.get_records() == [record_caesar]
+    for session_id, pref in sut.get_preferences_for_record(
+            record_caesar).iteritems():
+        restored_pref = restored.get_preferences_for_record(
+            record_caesar)[session_id]
+        assert_pref_equal(restored_pref, pref)
+        assert restored_pref.time_partition == pref.time_partition
+        assert_pref_equal(
+            restored.get_preferences_of_session(session_id)[record_caesar],
+            pref)
+    assert restored.get_preferences_of_session('carol') == {}
+    assert restored.get_record_norm(record_caesar) ==\
+        sut.get_record_norm(record_caesar)
+    assert restored.get_partition_squares(
+        record_caesar, time_partitioning) == [0.0, 1.0, 0.0, 4.0]
+
+
+def test__in_mem_dm__state__incremental_refresh_overlays_packed_rows():
+    fake_model, sut = create_incremental_in_mem_dm({
+        record_caesar: {
+            session_alice: Preference(1.0, datetime(1999, 1, 2)),
+        },
+        record_brutus: {
+            session_bob: Preference(1.0, datetime(1999, 1, 3)),
+        },
+    })
+    restored = restore_state(sut)
+    fake_model.get_actions_since.return_value = iter([
+        (record_caesar, [
+            ActionRow(record_caesar, session_bob, ActionType.copy,
+                      datetime(1999, 1, 10, 1)),
+        ]),
+    ])
+    item_based_dm.utcnow = mock.Mock(return_value=datetime(1999, 1, 10, 6))
+
+    restored.update_model()
+
+    assert isinstance(restored.record_session_mat, OverlayDict)
+    assert restored.record_session_mat.updates.keys() == [record_caesar]
+    assert sorted(restored.get_records()) ==\
+        sorted([record_caesar, record_brutus])
+    assert sorted(restored.get_preferences_for_record(record_caesar)) ==\
+        sorted([session_alice, session_bob])
+    assert sorted(restored.get_preferences_of_session(session_bob)) ==\
+        sorted([record_caesar, record_brutus])
+    assert restored.get_record_norm(record_caesar) == math.sqrt(5.0)
+    assert restored.get_record_norm(record_brutus) == 1.0
@@ -1,10 +1,26 @@
 from search_rex.recommendations.neighbourhood.case_based import\
     ThresholdQueryNeighbourhood
+from search_rex.recommendations.neighbourhood.case_based import\
+    ShingleIndexQueryNeighbourhood
+from search_rex.recommendations.neighbourhood.case_based import\
+    MinHashQueryNeighbourhood
+from search_rex.recommendations.neighbourhood.case_based import\
+    ShingleIndex
+from search_rex.recommendations.neighbourhood.case_based import\
+    MinHasher
+from search_rex.recommendations.neighbourhood.case_based import\
+    hash_shingle
 from search_rex.recommendations.similarity.case_based import\
     AbstractQuerySimilarity
+from search_rex.recommendations.similarity.case_based import\
+    StringJaccardSimilarity
 from search_rex.recommendations.data_model.case_based import\
     AbstractQueryDataModel
+from search_rex.recommendations.similarity.case_based import shingle
+from search_rex.recommendations.similarity.similarity_metrics import\
+    jaccard_sim
 import mock
+import numpy as np
 
 
 def test__ThresholdQueryNeighbourhood():
@@ -38,6 +54,30 @@ def test__ThresholdQueryNeighbourhood():
     assert nbours[0] == 'fat rat'
 
 
+def test__thres_nhood__get_scored_neighbours__best_nbours_are_kept():
+    similarities = {
+        'fat rat': 0.5,
+        'fat cat': 0.75,
+        'fat fat': 0.6,
+        'dog': 0.1,
+    }
+    fake_model = AbstractQueryDataModel()
+    fake_model.get_queries = mock.Mock(side_effect=similarities.keys)
+    fake_sim = AbstractQuerySimilarity()
+    fake_sim.get_similarity = mock.Mock(
+        side_effect=lambda query1, query2: similarities[query2])
+
+    sut = ThresholdQueryNeighbourhood(
+        data_model=fake_model, query_sim=fake_sim, sim_threshold=0.5,
+        max_size=2)
+
+    assert sut.get_scored_neighbours('fat cat') ==\
+        [('fat cat', 0.75), ('fat fat', 0.6)]
+    assert sut.get_scored_neighbours('fat cat', max_size=1) ==\
+        [('fat cat', 0.75)]
+    assert sut.get_neighbours('fat cat', max_size=5) == ['fat cat', 'fat fat']
+
+
 def test__thres_nhood__refresh__data_model_and_similarity_refreshed():
     fake_model = AbstractQueryDataModel()
     fake_model.refresh = mock.Mock()
@@ -57,3 +97,195 @@ def test__thres_nhood__refresh__data_model_and_similarity_refreshed():
     assert sut in refreshed_components
     assert fake_model.refresh.call_count == 1
     assert fake_sim.refresh.call_count == 1
+
+
+past_queries = [
+    'fat cat', 'fat rat', 'fat fat', 'cat', 'the fat cat sat on the mat',
+    'dog', 'fa', 'hello', 'yellow', 'mellow yellow', '',
+]
+
+
+def create_query_data_model(queries):
+    fake_model = AbstractQueryDataModel()
+    fake_model.get_queries = mock.Mock(side_effect=lambda: list(queries))
+    fake_model.refresh = mock.Mock()
+    return fake_model
+
+
+def test__shingle_index__get_overlaps():
+    sut = ShingleIndex(['fat cat', 'fat rat', 'dog'], k_shingles=3)
+    shingles = shingle('fat mat', 3)
+
+    query_ids, overlaps = sut.get_overlaps(shingles, 0, float('inf'))
+
+    assert dict(zip(query_ids.tolist(), overlaps.tolist())) ==\
+        {0: 2, 1: 2}
+    query_ids, overlaps = sut.get_overlaps(shingles, 0, 4)
+    assert len(query_ids) == 0
+    query_ids, overlaps = sut.get_overlaps(['xyz'], 0, float('inf'))
+    assert len(query_ids) == 0
+
+
+def test__shingle_index_nhood__same_nbours_as_threshold_nhood():
+    fake_model = create_query_data_model(past_queries)
+
+    for sim_threshold in [0.0, 0.1, 0.25, 0.4, 0.5, 1.0]:
+        threshold_nhood = ThresholdQueryNeighbourhood(
+            data_model=fake_model,
+            query_sim=StringJaccardSimilarity(k_shingles=3),
+            sim_threshold=sim_threshold)
+        sut = ShingleIndexQueryNeighbourhood(
+            data_model=fake_model, k_shingles=3,
+            sim_threshold=sim_threshold)
+
+        for query_string in past_queries + ['fat', 'mellow', 'unknown']:
+            assert dict(sut.get_scored_neighbours(query_string)) ==\
+                dict(threshold_nhood.get_scored_neighbours(query_string))
+
+
+def test__shingle_index_nhood__no_shared_shingle():
+    fake_model = create_query_data_model(past_queries)
+
+    sut = ShingleIndexQueryNeighbourhood(
+        data_model=fake_model, k_shingles=3, sim_threshold=0.25)
+
+    assert list(sut.get_neighbours('xyz')) == []
+
+
+def test__shingle_index_nhood__refresh__index_is_rebuilt():
+    queries = ['fat cat']
+    fake_model = create_query_data_model(queries)
+
+    sut = ShingleIndexQueryNeighbourhood(
+        data_model=fake_model, k_shingles=3, sim_threshold=0.5)
+
+    assert list(sut.get_neighbours('fat rat')) == []
+
+    queries.append('fat rat')
+    refreshed_components = set()
+    sut.refresh(refreshed_components)
+
+    assert list(sut.get_neighbours('fat rat')) == ['fat rat']
+    assert fake_model in refreshed_components
+    assert sut in refreshed_components
+    assert fake_model.refresh.call_count == 1
+
+
+def test__shingle_index_nhood__max_size():
+    fake_model = create_query_data_model(past_queries)
+
+    sut = ShingleIndexQueryNeighbourhood(
+        data_model=fake_model, k_shingles=3, sim_threshold=0.0, max_size=3)
+
+    scored_nbours = sut.get_scored_neighbours('fat cat')
+    assert len(scored_nbours) == 3
+    assert scored_nbours[0] == ('fat cat', 1.0)
+    sims = [sim for _, sim in scored_nbours]
+    assert sims == sorted(sims, reverse=True)
+
+
+def test__min_hasher__signature_agreement_estimates_jaccard():
+    sut = MinHasher(num_hashes=400)
+    shingles_a = shingle('the fat cat sat on the mat', 3)
+    shingles_b = shingle('the fat rat sat on the mat', 3)
+
+    sig_a = sut.get_signature(shingles_a)
+    sig_b = sut.get_signature(shingles_b)
+    agreement = sum(
+        1 for a, b in zip(sig_a, sig_b) if a == b) / float(len(sig_a))
+
+    assert abs(agreement - jaccard_sim(shingles_a, shingles_b)) < 0.1
+    assert np.array_equal(sut.get_signature(shingles_a), sig_a)
+
+
+def test__min_hasher__get_signatures__same_as_single_signatures():
+    sut = MinHasher(num_hashes=50)
+    sut.chunk_size = 7
+    shingle_sets = [shingle(query, 3) for query in past_queries] + [set()]
+
+    signatures = sut.get_signatures(shingle_sets)
+
+    assert signatures.shape == (len(shingle_sets), 50)
+    for shingles, signature in zip(shingle_sets, signatures):
+        expected = [
+            min((a*hash_shingle(q_shingle) % sut.prime + b) % sut.prime
+                for q_shingle in shingles) if shingles else sut.prime
+            for a, b in zip(sut.a.tolist(), sut.b.tolist())
+        ]
+        assert signature.tolist() == expected
+
+
+def test__min_hash_nhood__nbours_are_subset_of_exact_nbours():
+    fake_model = create_query_data_model(past_queries)
+    exact_nhood = ShingleIndexQueryNeighbourhood(
+        data_model=fake_model, k_shingles=3, sim_threshold=0.25)
+
+    sut = MinHashQueryNeighbourhood(
+        data_model=fake_model, k_shingles=3, sim_threshold=0.25,
+        num_bands=4, rows_per_band=8)
+
+    for query_string in past_queries:
+        nbours = list(sut.get_neighbours(query_string))
+        assert query_string in nbours
+        assert set(nbours) <= set(exact_nhood.get_neighbours(query_string))
+
+
+def test__min_hash_nhood__similar_queries_are_found():
+    fake_model = create_query_data_model(past_queries)
+
+    sut = MinHashQueryNeighbourhood(
+        data_model=fake_model, k_shingles=3, sim_threshold=0.4,
+        num_bands=50, rows_per_band=2)
+
+    assert set(sut.get_neighbours('hello')) == set(['hello', 'yellow'])
+
+
+def test__min_hash_nhood__detection_probability():
+    fake_model = create_query_data_model([])
+
+    sut = MinHashQueryNeighbourhood(
+        data_model=fake_model, k_shingles=3, sim_threshold=0.5,
+        num_bands=20, rows_per_band=5)
+
+    assert sut.get_detection_probability(1.0) == 1.0
+    assert sut.get_detection_probability(0.0) == 0.0
+    assert sut.get_detection_probability(0.8) > 0.99
+    assert sut.get_detection_probability(0.2) < 0.01
+
+
+def test__min_hash_nhood__refresh__buckets_are_rebuilt():
+    queries = ['fat cat']
+    fake_model = create_query_data_model(queries)
+
+    sut = MinHashQueryNeighbourhood(
+        data_model=fake_model, k_shingles=3, sim_threshold=0.5)
+
+    assert list(sut.get_neighbours('fat rat')) == []
+
+    queries.append('fat rat')
+    refreshed_components = set()
+    sut.refresh(refreshed_components)
+
+    assert list(sut.get_neighbours('fat rat')) == ['fat rat']
+    assert fake_model in refreshed_components
+    assert sut in refreshed_components
+
+
+def test__min_hash_nhood__refresh__only_new_queries_are_hashed():
+    queries = ['fat cat', 'fat rat']
+    fake_model = create_query_data_model(queries)
+    sut = MinHashQueryNeighbourhood(
+        data_model=fake_model, k_shingles=3, sim_threshold=0.5)
+    signatures = sut.signatures
+
+    queries[:] = ['fat rat', 'hello']
+    with mock.patch.object(
+            sut.min_hasher, 'get_signatures',
+            wraps=sut.min_hasher.get_signatures) as get_signatures:
+        sut.refresh(set())
+
+    get_signatures.assert_called_once_with([shingle('hello', 3)])
+    assert np.array_equal(sut.signatures[0], signatures[1])
+    assert list(sut.get_neighbours('fat rat')) == ['fat rat']
+    assert list(sut.get_neighbours('fat cat')) == []
+    assert list(sut.get_neighbours('hello')) == ['hello']
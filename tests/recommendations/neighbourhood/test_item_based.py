@@ -8,6 +8,23 @@ from search_rex.recommendations.similarity.item_based import\
     AbstractRecordSimilarity
 from search_rex.recommendations.data_model.item_based import\
     AbstractRecordDataModel
+from search_rex.recommendations.data_model.item_based import\
+    Preference
+from search_rex.recommendations.data_model.item_based import\
+    PersistentRecordDataModel
+from search_rex.recommendations.data_model.item_based import\
+    InMemoryRecordDataModel
+from search_rex.recommendations.data_model import item_based as item_based_dm
+from search_rex.recommendations.similarity.item_based import\
+    RecordSimilarity
+from search_rex.recommendations.similarity.item_based import\
+    CosineSimilarity
+from search_rex.recommendations.record_filter import InternalRecordFilter
+from search_rex.recommendations import queries
+from search_rex.util.packed_dict import PackedRows
+from search_rex.models import ActionType
+from datetime import datetime
+from datetime import timedelta
 import mock
 import math
 
@@ -54,6 +71,22 @@ def test__knn__get_nbours__more_than_k_possible_neighbours():
     assert set(sut.get_neighbours(target_record)) == set([record_1, record_2])
 
 
+def test__knn__get_scored_nbours__ordered_by_similarity():
+    target_record = 'caesar'
+    record_sims = {
+        target_record: 1.0,
+        'rome': 0.5,
+        'brutus': 0.75,
+        'cleopatra': 0.25,
+    }
+    sut = create_k_nearest_neighbourhood(
+        k=2, doc_sims=record_sims, docs=record_sims.keys())
+
+    assert sut.get_scored_neighbours(target_record) ==\
+        [('brutus', 0.75), ('rome', 0.5)]
+    assert sut.get_neighbours(target_record) == ['brutus', 'rome']
+
+
 def test__knn__get_nbours__less_than_k_possible_neighbours():
     target_record = 'caesar'
     record_1 = 'rome'
@@ -238,3 +271,212 @@ def test__in_mem_knn__refresh__data_is_reloaded():
     assert sut.get_neighbours(record_caesar) == nbours[record_caesar]
     assert sut.get_similarity(record_caesar, record_brutus) ==\
         sims[record_caesar][record_brutus]
+
+
+def test__in_mem_knn__similarity_matrix__same_nbours_as_knn():
+    preferences = {
+        'caesar': {1: Preference(1.0, datetime(1999, 1, 1)),
+                   2: Preference(2.0, datetime(1999, 1, 1)),
+                   3: Preference(1.0, datetime(1999, 1, 1))},
+        'brutus': {1: Preference(2.0, datetime(1999, 1, 1)),
+                   2: Preference(1.0, datetime(1999, 1, 1))},
+        'cleopatra': {2: Preference(1.0, datetime(1999, 1, 1)),
+                      4: Preference(1.0, datetime(1999, 1, 1))},
+        'rome': {3: Preference(2.0, datetime(1999, 1, 1))},
+        'napoleon': {5: Preference(1.0, datetime(1999, 1, 1))},
+    }
+    fake_model = AbstractRecordDataModel()
+    fake_model.get_records = mock.Mock(
+        side_effect=lambda: preferences.keys())
+    fake_model.get_preferences_for_records = mock.Mock(
+        side_effect=lambda: preferences.iteritems())
+    fake_model.get_preferences_for_record = mock.Mock(
+        side_effect=lambda r: preferences.get(r, {}))
+    record_sim = RecordSimilarity(fake_model, CosineSimilarity())
+
+    sut = InMemoryRecordNeighbourhood(fake_model, record_sim, 2)
+    knn = KNearestRecordNeighbourhood(2, fake_model, record_sim)
+
+    for record in preferences.keys():
+        nbours = sut.get_neighbours(record)
+        assert set(nbours) == set(knn.get_neighbours(record))
+        for nbour in nbours:
+            assert abs(
+                sut.get_similarity(record, nbour) -
+                record_sim.get_similarity(record, nbour)) < 1e-9
+    assert sut.get_neighbours('napoleon') == []
+
+
+def test__in_mem_knn__similarity_blocks__same_nbours_as_whole_matrix():
+    preferences = {
+        'caesar': {1: Preference(1.0, datetime(1999, 1, 1)),
+                   2: Preference(2.0, datetime(1999, 1, 1)),
+                   3: Preference(1.0, datetime(1999, 1, 1))},
+        'brutus': {1: Preference(2.0, datetime(1999, 1, 1)),
+                   2: Preference(1.0, datetime(1999, 1, 1))},
+        'cleopatra': {2: Preference(1.0, datetime(1999, 1, 1)),
+                      4: Preference(1.0, datetime(1999, 1, 1))},
+        'rome': {3: Preference(2.0, datetime(1999, 1, 1))},
+        'napoleon': {5: Preference(1.0, datetime(1999, 1, 1))},
+    }
+    fake_model = AbstractRecordDataModel()
+    fake_model.get_records = mock.Mock(
+        side_effect=lambda: preferences.keys())
+    fake_model.get_preferences_for_records = mock.Mock(
+        side_effect=lambda: preferences.iteritems())
+    record_sim = RecordSimilarity(fake_model, CosineSimilarity())
+
+    sut = InMemoryRecordNeighbourhood(
+        fake_model, record_sim, 2, block_size=2)
+    whole_matrix = InMemoryRecordNeighbourhood(
+        fake_model, record_sim, 2, block_size=len(preferences))
+
+    assert sut.nbours_dict == whole_matrix.nbours_dict
+
+
+def test__in_mem_knn__incremental_refresh__same_nbours_as_recomputation():
+    t = datetime(1999, 1, 1)
+    preferences = {
+        'caesar': {1: Preference(1.0, t), 2: Preference(2.0, t),
+                   3: Preference(1.0, t)},
+        'brutus': {1: Preference(2.0, t), 2: Preference(1.0, t)},
+        'cleopatra': {2: Preference(1.0, t), 4: Preference(1.0, t)},
+        'rome': {3: Preference(2.0, t), 6: Preference(1.0, t)},
+        'gaul': {4: Preference(2.0, t), 6: Preference(2.0, t)},
+        'napoleon': {5: Preference(1.0, t)},
+    }
+    persistent_model = PersistentRecordDataModel(include_internal_records=True)
+    persistent_model.get_preferences_for_records_until = mock.Mock(
+        side_effect=lambda max_time_created: preferences.iteritems())
+    persistent_model.get_actions_since = mock.Mock(return_value=iter([]))
+    item_based_dm.utcnow = mock.Mock(return_value=datetime(1999, 1, 2))
+    data_model = InMemoryRecordDataModel(
+        persistent_model, full_refresh_interval=timedelta(days=1))
+    record_sim = RecordSimilarity(data_model, CosineSimilarity())
+    sut = InMemoryRecordNeighbourhood(data_model, record_sim, 2)
+
+    new_time = datetime(1999, 1, 2, 1)
+    persistent_model.get_actions_since.return_value = iter([
+        ('napoleon', [('napoleon', 1, ActionType.copy, new_time)]),
+        ('rome', [('rome', 2, ActionType.copy, new_time)]),
+    ])
+    item_based_dm.utcnow = mock.Mock(return_value=datetime(1999, 1, 2, 2))
+    sut.refresh(set())
+
+    assert data_model.get_touched_records() == set(['napoleon', 'rome'])
+    recomputed = InMemoryRecordNeighbourhood(data_model, record_sim, 2)
+    for record in preferences.keys():
+        nbours = sut.get_neighbours(record)
+        assert set(nbours) == set(recomputed.get_neighbours(record))
+        for nbour in nbours:
+            assert abs(
+                sut.get_similarity(record, nbour) -
+                recomputed.get_similarity(record, nbour)) < 1e-9
+    for record in preferences.keys():
+        for nbour, reverse in sut.reverse_nbours.iteritems():
+            assert (record in reverse) == (nbour in sut.nbours_dict[record])
+
+
+def test__in_mem_knn__refresh__untouched_records_are_kept():
+    nbours = {'caesar': ['brutus'], 'brutus': ['caesar'], 'napoleon': []}
+    fake_model = AbstractRecordDataModel()
+    fake_model.get_records = mock.Mock(side_effect=lambda: nbours.keys())
+    fake_model.get_touched_records = mock.Mock(return_value=set(['napoleon']))
+    fake_model.get_preferences_for_record = mock.Mock(return_value={})
+    fake_model.refresh = mock.Mock()
+    fake_sim = AbstractRecordSimilarity()
+    fake_sim.get_similarity = mock.Mock(return_value=0.5)
+    fake_sim.refresh = mock.Mock()
+    fake_nhood = AbstractRecordNeighbourhood()
+    fake_nhood.get_neighbours = mock.Mock(side_effect=lambda r: nbours[r])
+
+    sut = InMemoryRecordNeighbourhood(
+        fake_model, fake_sim, 50,
+        nhood_factory=lambda dm, sim, num_nh: fake_nhood)
+    nbours['napoleon'] = ['caesar']
+    fake_nhood.get_neighbours.reset_mock()
+
+    sut.refresh(set())
+
+    fake_nhood.get_neighbours.assert_called_once_with('napoleon')
+    assert sut.get_neighbours('napoleon') == ['caesar']
+    assert sut.get_neighbours('caesar') == ['brutus']
+
+
+def test__knn__get_nbours__exclude_internal_records__k_external_nbours():
+    target_record = 'caesar'
+    record_sims = {
+        target_record: 1.0,
+        'rome': 1.0,
+        'brutus': 0.75,
+        'cleopatra': 0.5,
+    }
+    sut = create_k_nearest_neighbourhood(
+        k=2, doc_sims=record_sims, docs=record_sims.keys())
+    with mock.patch.object(
+            queries, 'get_records',
+            return_value=[target_record, 'brutus', 'cleopatra']):
+        sut.record_filter = InternalRecordFilter()
+
+    assert set(sut.get_neighbours(target_record)) == set(['rome', 'brutus'])
+    assert set(sut.get_neighbours(
+        target_record, include_internal_records=False)) ==\
+        set(['brutus', 'cleopatra'])
+
+
+def test__in_mem_knn__get_scored_nbours__sims_of_knn_are_kept():
+    record_sims = {
+        'caesar': 0.25,
+        'rome': 0.5,
+        'brutus': 0.75,
+    }
+    fake_model = AbstractRecordDataModel()
+    fake_model.get_records = mock.Mock(return_value=record_sims.keys())
+    fake_sim = AbstractRecordSimilarity()
+    fake_sim.get_similarity = mock.Mock(
+        side_effect=lambda from_id, to_id: record_sims[to_id])
+
+    sut = InMemoryRecordNeighbourhood(fake_model, fake_sim, 50)
+
+    # Each pair is compared once by the k-nearest neighbourhood
+    assert fake_sim.get_similarity.call_count == 9
+    assert sut.get_scored_neighbours('caesar') ==\
+        [('brutus', 0.75), ('rome', 0.5)]
+    with mock.patch.object(
+            queries, 'get_records', return_value=['caesar', 'rome']):
+        sut.record_filter = InternalRecordFilter()
+    assert sut.get_scored_neighbours(
+        'caesar', include_internal_records=False) == [('rome', 0.5)]
+
+
+def test__in_mem_knn__state__neighbours_are_packed():
+    nbours = {'caesar': ['brutus'], 'brutus': ['caesar'], 'napoleon': []}
+    fake_model = AbstractRecordDataModel()
+    fake_model.get_records = mock.Mock(side_effect=lambda: nbours.keys())
+    fake_model.get_touched_records = mock.Mock(return_value=set(['napoleon']))
+    fake_model.get_preferences_for_record = mock.Mock(return_value={})
+    fake_sim = AbstractRecordSimilarity()
+    fake_sim.get_similarity = mock.Mock(return_value=0.5)
+    fake_nhood = AbstractRecordNeighbourhood()
+    fake_nhood.get_neighbours = mock.Mock(side_effect=lambda r: nbours[r])
+    sut = InMemoryRecordNeighbourhood(
+        fake_model, fake_sim, 50,
+        nhood_factory=lambda dm, sim, num_nh: fake_nhood)
+
+    restored = InMemoryRecordNeighbourhood.__new__(
+        InMemoryRecordNeighbourhood)
+    restored.__dict__.update(sut.__getstate__())
+
+    assert isinstance(restored.nbours_dict, PackedRows)
+    assert restored.reverse_nbours is None
+    for record in nbours:
+        assert restored.get_scored_neighbours(record) ==\
+            sut.get_scored_neighbours(record)
+    assert restored.get_similarity('caesar', 'brutus') == 0.5
+    assert math.isnan(restored.get_similarity('caesar', 'napoleon'))
+
+    nbours['napoleon'] = ['caesar']
+    restored.update_similarities()
+
+    assert restored.get_neighbours('napoleon') == ['caesar']
+    assert restored.reverse_nbours['caesar'] == set(['brutus', 'napoleon'])
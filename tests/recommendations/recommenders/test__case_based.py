@@ -13,9 +13,14 @@ from search_rex.recommendations.similarity.case_based import\
     AbstractQuerySimilarity
 from search_rex.recommendations.neighbourhood.case_based import\
     AbstractQueryNeighbourhood
+from search_rex.recommendations.neighbourhood.case_based import\
+    ShingleIndexQueryNeighbourhood
+from search_rex.recommendations.record_filter import InternalRecordFilter
+from search_rex.recommendations import queries
 from ...test_util import assert_almost_equal
 
 from collections import namedtuple
+from datetime import datetime
 
 import mock
 
@@ -29,6 +34,9 @@ Hit = namedtuple(
 )
 
 
+FakeHit = namedtuple('FakeHit', ['value', 'num_views', 'last_interaction'])
+
+
 query_1 = 'query_1'
 query_2 = 'query_2'
 query_3 = 'query_3'
@@ -66,6 +74,10 @@ def test__relevance__total_hits_is_zero():
     assert relevance(doc_1, {doc_1: 0.0, doc_2: 0.0}) == 0.0
 
 
+def test__relevance__total_hits_are_given():
+    assert relevance(doc_1, {doc_1: 2.0, doc_2: 2.0}, total_hits=8.0) == 0.25
+
+
 def test__relevance__total_hit_row_is_empty():
     assert relevance(doc_1, {}) == 0.0
 
@@ -182,6 +194,68 @@ def test__weighted_sum_scorer__no_record():
     assert score == 0.0
 
 
+fake_hit_rows = {
+    query: {
+        record: FakeHit(value, int(value), datetime(2001, 1, int(value)))
+        for record, value in hit_row.iteritems()
+    }
+    for query, hit_row in query_hit_rows.iteritems()
+}
+
+
+def assert_scores_match_single_scores(sut, query_sims):
+    recs = sut.compute_scores(fake_hit_rows, query_sims)
+
+    assert sorted(recs.keys()) == [doc_1, doc_2, doc_3, doc_4, doc_5]
+    for record, rec in recs.iteritems():
+        assert_almost_equal(
+            rec.score,
+            sut.compute_score(record, query_hit_rows, query_sims), 0.00001)
+
+
+def test__weighted_scorers__compute_scores__same_as_compute_score():
+    score_functions = [
+        relevance, LogFrequency(base=2), Frequency(),
+        lambda record, hit_row: 1.0,
+    ]
+    for score_function in score_functions:
+        assert_scores_match_single_scores(
+            WeightedSumScorer(score_function), query_sims)
+        assert_scores_match_single_scores(
+            WeightedAverageScorer(score_function), query_sims)
+
+
+def test__weighted_scorers__compute_scores__hit_totals_are_used():
+    sut = WeightedSumScorer(relevance)
+
+    recs = sut.compute_scores(
+        {query_1: fake_hit_rows[query_1]}, {query_1: 1.0}, {query_1: 40.0})
+
+    assert recs[doc_1].score == 0.2
+
+
+def test__weighted_scorers__compute_scores__views_are_accumulated():
+    sut = WeightedSumScorer(relevance)
+
+    recs = sut.compute_scores(fake_hit_rows, query_sims)
+
+    assert recs[doc_2].total_hits == 24
+    assert recs[doc_2].last_interaction == datetime(2001, 1, 16)
+    assert recs[doc_4].total_hits == 2
+    assert recs[doc_4].last_interaction == datetime(2001, 1, 2)
+
+
+def test__weighted_scorers__compute_scores__query_without_sim():
+    sut = WeightedSumScorer(relevance)
+
+    recs = sut.compute_scores(fake_hit_rows, {query_1: 1.0})
+
+    # The views of the query count, but it does not add to the score
+    assert recs[doc_5].total_hits == 12
+    assert recs[doc_5].score == 0.0
+    assert recs[doc_1].score == 0.4
+
+
 def test__q_recommender__refresh__underlying_components_are_refreshed():
     fake_model = AbstractQueryDataModel()
     fake_model.refresh = mock.Mock()
@@ -206,3 +280,147 @@ def test__q_recommender__refresh__underlying_components_are_refreshed():
     assert fake_model.refresh.call_count == 1
     assert fake_sim.refresh.call_count == 1
     assert fake_nhood.refresh.call_count == 1
+
+
+def create_record_filter(external_records):
+    with mock.patch.object(
+            queries, 'get_records', return_value=external_records):
+        return InternalRecordFilter()
+
+
+def create_filtering_recommender(hit_rows, nbours, external_records):
+    data_model = AbstractQueryDataModel()
+    data_model.get_hit_rows_for_queries = mock.Mock(
+        side_effect=lambda queries: [
+            (query, hit_rows[query]) for query in queries])
+    query_sim = AbstractQuerySimilarity()
+    query_sim.get_similarity = mock.Mock(return_value=1.0)
+    query_nhood = AbstractQueryNeighbourhood()
+    query_nhood.iter_scored_neighbours = mock.Mock(
+        return_value=[(nbour, 1.0) for nbour in nbours])
+
+    return QueryBasedRecommender(
+        data_model, query_nhood, query_sim, WeightedSumScorer(relevance),
+        record_filter=create_record_filter(external_records))
+
+
+def test__q_recommender__exclude_internal_records__hit_rows_are_filtered():
+    hit_rows = {
+        query_1: {
+            doc_1: FakeHit(1.0, 1, None),
+            doc_2: FakeHit(3.0, 3, None),
+        },
+    }
+    sut = create_filtering_recommender(hit_rows, [query_1], [doc_1])
+
+    internal_recs = sut.recommend_search_results(query_1)
+    external_recs = sut.recommend_search_results(
+        query_1, include_internal_records=False)
+
+    assert [rec.record_id for rec in internal_recs] == [doc_2, doc_1]
+    assert [rec.record_id for rec in external_recs] == [doc_1]
+    # The relevance is computed on the filtered hit row
+    assert external_recs[0].score == 1.0
+
+
+def test__q_recommender__exclude_internal_records__similar_queries_filtered():
+    hit_rows = {
+        query_1: {doc_1: FakeHit(1.0, 1, None)},
+        query_2: {doc_2: FakeHit(1.0, 1, None)},
+        query_3: {
+            doc_1: FakeHit(1.0, 1, None),
+            doc_2: FakeHit(1.0, 1, None),
+        },
+    }
+    sut = create_filtering_recommender(
+        hit_rows, [query_3, query_2, query_1], [doc_1])
+
+    assert sut.get_similar_queries(query_1) == [query_3, query_2, query_1]
+    assert sut.get_similar_queries(
+        query_1, include_internal_records=False) == [query_3, query_1]
+
+
+def test__q_recommender__similarities_of_nhood_are_used():
+    hit_rows = {
+        query_1: {doc_1: FakeHit(1.0, 1, None)},
+        query_2: {doc_2: FakeHit(1.0, 1, None)},
+    }
+    sut = create_filtering_recommender(hit_rows, [], [doc_1, doc_2])
+    sut.query_nhood.iter_scored_neighbours.return_value = [
+        (query_1, 0.25), (query_2, 0.5)]
+
+    recs = sut.recommend_search_results(query_1)
+
+    assert [(rec.record_id, rec.score) for rec in recs] ==\
+        [(doc_2, 0.5), (doc_1, 0.25)]
+    assert sut.query_sim.get_similarity.call_count == 0
+
+
+def test__q_recommender__get_similar_queries__max_num_recs():
+    hit_rows = {
+        query_1: {doc_1: FakeHit(1.0, 1, None)},
+        query_2: {doc_2: FakeHit(1.0, 1, None)},
+        query_3: {doc_1: FakeHit(1.0, 1, None)},
+    }
+    sut = create_filtering_recommender(
+        hit_rows, [query_3, query_2, query_1], [doc_1])
+
+    assert sut.get_similar_queries(query_1, max_num_recs=2) ==\
+        [query_3, query_2]
+    # The hidden queries do not count towards the maximum
+    assert sut.get_similar_queries(
+        query_1, max_num_recs=2, include_internal_records=False) ==\
+        [query_3, query_1]
+
+
+def create_shingle_index_recommender(hit_rows, record_filter=None):
+    data_model = AbstractQueryDataModel()
+    data_model.get_queries = mock.Mock(side_effect=lambda: hit_rows.keys())
+    data_model.get_hit_rows_for_queries = mock.Mock(
+        side_effect=lambda queries: [
+            (query, hit_rows[query]) for query in queries
+            if query in hit_rows])
+    query_nhood = ShingleIndexQueryNeighbourhood(
+        data_model, k_shingles=3, sim_threshold=0.1, max_size=2)
+
+    return QueryBasedRecommender(
+        data_model, query_nhood, AbstractQuerySimilarity(),
+        WeightedSumScorer(relevance), record_filter=record_filter)
+
+
+def test__q_recommender__exclude_internal_records__same_as_external_build():
+    hit_rows = {
+        'fat cat': {doc_1: FakeHit(4.0, 4, None)},
+        'fat cats': {doc_2: FakeHit(2.0, 2, None)},
+        'fat rat': {doc_3: FakeHit(1.0, 1, None)},
+        'fat bat': {
+            doc_1: FakeHit(2.0, 2, None),
+            doc_4: FakeHit(1.0, 1, None),
+        },
+        'dog': {doc_5: FakeHit(1.0, 1, None)},
+    }
+    external_records = [doc_3, doc_4, doc_5]
+    # A data model without the internal records knows neither the internal
+    # hits nor the queries whose hits are all internal
+    external_hit_rows = {}
+    for query, hit_row in hit_rows.iteritems():
+        external_hit_row = {
+            record: hit for record, hit in hit_row.iteritems()
+            if record in external_records
+        }
+        if external_hit_row:
+            external_hit_rows[query] = external_hit_row
+    sut = create_shingle_index_recommender(
+        hit_rows, create_record_filter(external_records))
+    external_build = create_shingle_index_recommender(external_hit_rows)
+
+    recs = sut.recommend_search_results(
+        'fat cat', include_internal_records=False)
+    external_recs = external_build.recommend_search_results('fat cat')
+
+    assert sorted((rec.record_id, rec.score) for rec in recs) ==\
+        sorted((rec.record_id, rec.score) for rec in external_recs)
+    assert sorted(rec.record_id for rec in recs) == [doc_3, doc_4]
+    assert sorted(sut.get_similar_queries(
+        'fat cat', include_internal_records=False)) ==\
+        sorted(external_build.get_similar_queries('fat cat'))
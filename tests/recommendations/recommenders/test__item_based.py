@@ -8,6 +8,8 @@ from search_rex.recommendations.data_model.item_based import\
     AbstractRecordDataModel
 from search_rex.recommendations.data_model.item_based import\
     Preference
+from search_rex.recommendations.record_filter import InternalRecordFilter
+from search_rex.recommendations import queries
 import mock
 from datetime import datetime
 
@@ -49,8 +51,8 @@ def create_recommender(preferences=default_prefs, doc_sims=doc_sims):
     record_sim.get_similarity = mock.Mock(
         side_effect=lambda from_id, to_id: doc_sims[from_id][to_id])
     record_nhood = AbstractRecordNeighbourhood()
-    record_nhood.get_neighbours = mock.Mock(
-        side_effect=lambda doc_id: doc_sims[doc_id].keys())
+    record_nhood.get_scored_neighbours = mock.Mock(
+        side_effect=lambda doc_id, **kwargs: doc_sims[doc_id].items())
 
     return RecordBasedRecommender(
         data_model, record_nhood, record_sim)
@@ -63,6 +65,15 @@ def test__recommend__recommendations_ordered_by_score():
     assert recs == [(doc_rome, 1.1), (doc_cleopatra, 1.0), (doc_napoleon, 0.0)]
 
 
+def test__recommend__similarities_of_nhood_are_used():
+    sut = create_recommender()
+
+    sut.recommend(session, max_num_recs=10)
+    sut.most_similar_records(doc_caesar, max_num_recs=10)
+
+    assert sut.record_sim.get_similarity.call_count == 0
+
+
 def test__recommend__max_num_recs_steers_amount_of_recs():
     sut = create_recommender()
 
@@ -141,3 +152,34 @@ def test__refresh__underlying_components_are_refreshed():
     assert fake_model.refresh.call_count == 1
     assert fake_sim.refresh.call_count == 1
     assert fake_nhood.refresh.call_count == 1
+
+
+def create_filtering_recommender(external_records):
+    sut = create_recommender()
+    with mock.patch.object(
+            queries, 'get_records', return_value=external_records):
+        sut.record_filter = InternalRecordFilter()
+    return sut
+
+
+def test__recommend__exclude_internal_records__internal_records_filtered():
+    sut = create_filtering_recommender(
+        [doc_caesar, doc_rome, doc_napoleon])
+
+    recs = sut.recommend(
+        session, max_num_recs=10, include_internal_records=False)
+
+    # Neither the preference on brutus nor the internal neighbours count
+    assert recs == [(doc_rome, 0.5), (doc_napoleon, 0.0)]
+    sut.record_nhood.get_scored_neighbours.assert_called_with(
+        doc_caesar, include_internal_records=False)
+
+
+def test__most_similar_records__exclude_internal_records():
+    sut = create_filtering_recommender([doc_caesar, doc_rome])
+
+    assert sut.most_similar_records(
+        doc_caesar, include_internal_records=False) == [(doc_rome, 0.5)]
+    assert sut.most_similar_records(
+        doc_brutus, include_internal_records=False) == []
+    assert len(sut.most_similar_records(doc_brutus)) == 4
@@ -1,6 +1,12 @@
 from search_rex.recommendations.similarity.case_based import shingle
 from search_rex.recommendations.similarity.case_based import\
     StringJaccardSimilarity
+from search_rex.recommendations.data_model.case_based import\
+    AbstractQueryDataModel
+from search_rex.recommendations.similarity.case_based import\
+    shingle as original_shingle
+import search_rex.recommendations.similarity.case_based as case_based_sim
+import mock
 
 
 def test__shingle():
@@ -36,3 +42,63 @@ def test__str_jaccard__refresh():
     sut.refresh(refreshed_components)
 
     assert sut in refreshed_components
+
+
+def create_query_data_model(queries):
+    fake_model = AbstractQueryDataModel()
+    fake_model.get_queries = mock.Mock(side_effect=lambda: list(queries))
+    fake_model.refresh = mock.Mock()
+    return fake_model
+
+
+def test__string_jaccard_sim__cached_shingles():
+    fake_model = create_query_data_model(['hello', 'yellow'])
+
+    sut = StringJaccardSimilarity(k_shingles=3, data_model=fake_model)
+
+    assert sut.get_shingles('hello') == frozenset(['hel', 'ell', 'llo'])
+    assert sut.get_shingles('hello') is sut.get_shingles('hello')
+    assert sut.get_similarity('hello', 'yellow') == 0.4
+    assert sut.get_similarity('mellow', 'yellow') == 0.6
+
+
+def test__string_jaccard_sim__shingles_are_shared_among_queries():
+    fake_model = create_query_data_model(['hello', 'yellow'])
+
+    sut = StringJaccardSimilarity(k_shingles=3, data_model=fake_model)
+
+    hello_shingles = {s: s for s in sut.get_shingles('hello')}
+    for yellow_shingle in sut.get_shingles('yellow'):
+        if yellow_shingle in hello_shingles:
+            assert yellow_shingle is hello_shingles[yellow_shingle]
+
+
+def test__string_jaccard_sim__target_query_is_shingled_once():
+    fake_model = create_query_data_model(['hello', 'yellow', 'mellow'])
+
+    sut = StringJaccardSimilarity(k_shingles=3, data_model=fake_model)
+
+    with mock.patch.object(
+            case_based_sim, 'shingle',
+            mock.Mock(side_effect=original_shingle)) as shingle_mock:
+        for other_query in ['hello', 'yellow', 'mellow']:
+            sut.get_similarity('jello', other_query)
+
+        assert shingle_mock.call_count == 1
+
+
+def test__string_jaccard_sim__refresh__cache_is_reloaded():
+    queries = ['hello']
+    fake_model = create_query_data_model(queries)
+
+    sut = StringJaccardSimilarity(k_shingles=3, data_model=fake_model)
+    assert 'yellow' not in sut.shingle_cache
+
+    queries.append('yellow')
+    refreshed_components = set()
+    sut.refresh(refreshed_components)
+
+    assert 'yellow' in sut.shingle_cache
+    assert sut.get_similarity('hello', 'yellow') == 0.4
+    assert fake_model in refreshed_components
+    assert fake_model.refresh.call_count == 1
@@ -16,6 +16,12 @@ from search_rex.recommendations.similarity.item_based import\
     RecordSimilarity
 from search_rex.recommendations.similarity.item_based import\
     TimeDecaySimilarity
+from search_rex.recommendations.similarity.item_based import\
+    PreferenceMatrix
+from search_rex.recommendations.similarity.item_based import\
+    TimeDecayCosineSimilarity
+from search_rex.recommendations.data_model.item_based import\
+    TimePartitioning
 from search_rex.recommendations.similarity import item_based\
     as item_based_sim
 
@@ -23,11 +29,19 @@ from search_rex.recommendations.data_model.item_based import\
     Preference
 from search_rex.recommendations.data_model.item_based import\
     AbstractRecordDataModel
+from search_rex.recommendations.data_model.item_based import\
+    InMemoryRecordDataModel
+from search_rex.recommendations.data_model import item_based\
+    as item_based_dm
 
 from search_rex import services
+from search_rex.recommendations.record_filter import InternalRecordFilter
+from search_rex.util.packed_dict import PackedRows
 
 import mock
 import math
+import random
+import numpy as np
 from datetime import timedelta
 from datetime import datetime
 from ..test_base import BaseTestCase
@@ -228,6 +242,44 @@ class InMemorySimilarityTestCase(BaseTestCase):
 
         assert math.isnan(sut.get_similarity(record_caesar, record_napoleon))
 
+    def test__in_mem_sim__record_filter__same_sims_as_external_build(self):
+        is_internal = {
+            'caesar': False, 'brutus': False, 'napoleon': False,
+            'cleopatra': False, 'secret': True, 'classified': True,
+        }
+        sims = {
+            'caesar': {
+                'secret': 0.9, 'classified': 0.8, 'brutus': 0.7,
+                'napoleon': 0.6, 'cleopatra': 0.5,
+            },
+            'brutus': {'classified': 0.9, 'caesar': 0.4},
+            'secret': {'caesar': 0.9, 'classified': 0.8},
+        }
+        for from_record, rec_sims in sims.iteritems():
+            for to_record, sim in rec_sims.iteritems():
+                services.import_record_similarity(
+                    from_record, is_internal[from_record],
+                    to_record, is_internal[to_record], sim)
+
+        sut = InMemoryRecordSimilarity(
+            include_internal_records=True, max_sims_per_record=2,
+            record_filter=InternalRecordFilter())
+        external_sim = InMemoryRecordSimilarity(
+            include_internal_records=False, max_sims_per_record=2)
+
+        external_records = [
+            record for record, internal in is_internal.iteritems()
+            if not internal]
+        for from_record in external_records:
+            for to_record in external_records:
+                sim = sut.get_similarity(from_record, to_record)
+                external = external_sim.get_similarity(from_record, to_record)
+                assert sim == external or\
+                    math.isnan(sim) and math.isnan(external)
+        assert sut.get_similarity('caesar', 'brutus') == 0.7
+        assert sut.get_similarity('caesar', 'secret') == 0.9
+        assert math.isnan(sut.get_similarity('caesar', 'cleopatra'))
+
     def test__in_mem_sim__refresh__similarities_are_reloaded(self):
         record_caesar = 'caesar'
         record_brutus = 'brutus'
@@ -247,6 +299,21 @@ class InMemorySimilarityTestCase(BaseTestCase):
         assert sut.get_similarity(record_caesar, record_brutus) == sim
         assert sut in refreshed_components
 
+    def test__in_mem_sim__state__similarities_are_packed(self):
+        services.import_record_similarity(
+            'caesar', False, 'brutus', False, 0.9)
+        sut = InMemoryRecordSimilarity(
+            include_internal_records=True, max_sims_per_record=10)
+
+        restored = InMemoryRecordSimilarity.__new__(InMemoryRecordSimilarity)
+        restored.__dict__.update(sut.__getstate__())
+
+        assert isinstance(sut.similarities, dict)
+        assert isinstance(restored.similarities, PackedRows)
+        assert restored.get_similarity('caesar', 'brutus') == 0.9
+        assert math.isnan(restored.get_similarity('caesar', 'napoleon'))
+        assert math.isnan(restored.get_similarity('brutus', 'caesar'))
+
 
 def test__jaccard__get_similarity():
     from_prefs = {
@@ -461,3 +528,260 @@ def test__time_decay__prefs_are_empty__return_nan():
     sim = sut.get_similarity(from_prefs, to_prefs)
 
     assert math.isnan(sim)
+
+
+batch_preferences = {
+    'caesar': {
+        1: Preference(1.0, datetime(2001, 12, 30)),
+        2: Preference(2.0, datetime(2001, 12, 25)),
+        3: Preference(2.0, datetime(2001, 12, 24)),
+        4: Preference(1.0, datetime(2001, 12, 18)),
+        5: Preference(1.0, datetime(2001, 12, 1)),
+    },
+    'brutus': {
+        1: Preference(1.0, datetime(2001, 12, 29)),
+        2: Preference(2.0, datetime(2001, 12, 26)),
+        4: Preference(1.0, datetime(2001, 12, 14)),
+        5: Preference(1.0, datetime(2001, 11, 1)),
+    },
+    'cleopatra': {
+        3: Preference(2.0, datetime(2001, 12, 24)),
+        6: Preference(1.0, datetime(2001, 12, 31)),
+    },
+    'napoleon': {
+        7: Preference(1.0, datetime(2001, 12, 30)),
+    },
+}
+
+
+def create_batch_data_model(preferences=batch_preferences):
+    fake_model = AbstractRecordDataModel()
+    fake_model.get_preferences_for_records = mock.Mock(
+        side_effect=lambda: preferences.iteritems())
+    fake_model.get_preferences_for_record = mock.Mock(
+        side_effect=lambda r: preferences.get(r, {}))
+    return fake_model
+
+
+def assert_matrix_matches_similarity(sut, record_ids):
+    sim_mat = sut.get_similarity_matrix(record_ids).toarray()
+    for i, from_record in enumerate(record_ids):
+        for j, to_record in enumerate(record_ids):
+            expected_sim = sut.get_similarity(from_record, to_record)
+            if math.isnan(expected_sim):
+                expected_sim = 0.0
+            assert abs(sim_mat[i, j] - expected_sim) < 1e-9
+
+
+def test__pref_matrix__from_data_model__unknown_records_are_empty():
+    pref_matrix = PreferenceMatrix.from_data_model(
+        create_batch_data_model(), ['caesar', 'unknown'])
+
+    assert pref_matrix.num_records == 2
+    assert pref_matrix.num_sessions == 5
+    assert set(pref_matrix.rows) == set([0])
+    assert pref_matrix.to_csr().shape == (2, 5)
+
+
+def test__record_similarity__get_similarity_matrix__cosine():
+    sut = RecordSimilarity(create_batch_data_model(), CosineSimilarity())
+
+    assert_matrix_matches_similarity(sut, batch_preferences.keys())
+
+
+def test__record_similarity__get_similarity_matrix__jaccard():
+    sut = RecordSimilarity(create_batch_data_model(), JaccardSimilarity())
+
+    assert_matrix_matches_similarity(sut, batch_preferences.keys())
+
+
+def test__record_similarity__get_similarity_matrix__significance():
+    sut = RecordSimilarity(
+        create_batch_data_model(),
+        SignificanceWeighting(CosineSimilarity(), min_overlap=3))
+
+    assert_matrix_matches_similarity(sut, batch_preferences.keys())
+
+
+def test__record_similarity__get_similarity_matrix__time_decay():
+    item_based_sim.utcnow = mock.Mock(
+        return_value=datetime(2001, 12, 31))
+
+    sut = RecordSimilarity(
+        create_batch_data_model(),
+        TimeDecaySimilarity(
+            CosineSimilarity(), time_interval=timedelta(7), half_life=2,
+            max_age=4))
+
+    assert_matrix_matches_similarity(sut, batch_preferences.keys())
+
+
+def test__combine_rec_similarity__get_similarity_matrix():
+    record_ids = batch_preferences.keys()
+    content_sims = {
+        'caesar': {'brutus': 0.5, 'napoleon': 0.25},
+        'napoleon': {'caesar': 0.75},
+    }
+    content_sim = InMemoryRecordSimilarity.__new__(InMemoryRecordSimilarity)
+    content_sim.similarities = content_sims
+
+    sut = CombinedRecordSimilarity(
+        RecordSimilarity(create_batch_data_model(), CosineSimilarity()),
+        content_sim, weight=0.75)
+
+    assert_matrix_matches_similarity(sut, record_ids)
+
+
+def test__record_similarity__get_similarity_blocks__same_as_matrix():
+    item_based_sim.utcnow = mock.Mock(
+        return_value=datetime(2001, 12, 31))
+    record_ids = batch_preferences.keys()
+    metrics = [
+        CosineSimilarity(), JaccardSimilarity(),
+        SignificanceWeighting(CosineSimilarity(), min_overlap=3),
+        TimeDecaySimilarity(
+            CosineSimilarity(), time_interval=timedelta(7), half_life=2,
+            max_age=4),
+    ]
+    for metric in metrics:
+        sut = RecordSimilarity(create_batch_data_model(), metric)
+        sim_mat = sut.get_similarity_matrix(record_ids).toarray()
+
+        blocks = list(sut.get_similarity_blocks(record_ids, 3))
+
+        assert [start for start, _ in blocks] == [0, 3]
+        assert [block.shape for _, block in blocks] ==\
+            [(3, len(record_ids)), (1, len(record_ids))]
+        for start, block in blocks:
+            end = start + block.shape[0]
+            assert np.allclose(block.toarray(), sim_mat[start:end])
+
+
+def test__abstract_similarity__get_similarity_matrix__not_implemented():
+    fake_sim = AbstractRecordSimilarity()
+    try:
+        fake_sim.get_similarity_matrix(['caesar'])
+        assert False
+    except NotImplementedError:
+        pass
+
+
+def create_random_preferences(rand, num_sessions, time_now):
+    preferences = {}
+    for session in rand.sample(xrange(30), num_sessions):
+        preferences[session] = Preference(
+            rand.choice([1.0, 2.0]),
+            time_now - timedelta(days=rand.randint(-3, 120)))
+    return preferences
+
+
+def test__time_decay_cosine__same_as_time_decay_over_cosine():
+    rand = random.Random(42)
+    time_now = datetime(2001, 12, 31)
+    item_based_sim.utcnow = mock.Mock(return_value=time_now)
+
+    time_decay_sim = TimeDecaySimilarity(
+        CosineSimilarity(), time_interval=timedelta(7), half_life=2,
+        max_age=12)
+    sut = TimeDecayCosineSimilarity(
+        TimePartitioning(time_interval=timedelta(7), max_age=12),
+        half_life=2)
+
+    for _ in xrange(200):
+        from_prefs = create_random_preferences(
+            rand, rand.randint(0, 20), time_now)
+        to_prefs = create_random_preferences(
+            rand, rand.randint(0, 20), time_now)
+
+        expected_sim = time_decay_sim.get_similarity(from_prefs, to_prefs)
+        sim = sut.get_similarity(from_prefs, to_prefs)
+        if math.isnan(expected_sim):
+            assert math.isnan(sim)
+        else:
+            assert sim == expected_sim
+
+
+def test__time_decay_cosine__assigned_partitions_are_used():
+    time_now = datetime(2001, 12, 31)
+    item_based_sim.utcnow = mock.Mock(return_value=time_now)
+    partitioning = TimePartitioning(time_interval=timedelta(7), max_age=4)
+
+    from_prefs = {
+        1: Preference(1.0, datetime(2001, 12, 30)),
+        2: Preference(2.0, datetime(2001, 12, 20)),
+    }
+    to_prefs = {
+        1: Preference(1.0, datetime(2001, 12, 29)),
+        2: Preference(2.0, datetime(2001, 12, 21)),
+    }
+
+    sut = TimeDecayCosineSimilarity(partitioning, half_life=2)
+    sim = sut.get_similarity(from_prefs, to_prefs)
+
+    # All preferences are regarded as older than max_age
+    partitioning.assign_partitions(from_prefs, datetime(2003, 1, 1))
+    partitioning.assign_partitions(to_prefs, datetime(2003, 1, 1))
+
+    assert sim > 0.0
+    assert sut.get_similarity(from_prefs, to_prefs) == 0.0
+
+
+def assert_record_similarity_matches(sut, data_model, record_ids):
+    for from_record in record_ids:
+        for to_record in record_ids:
+            expected_sim = sut.get_similarity(
+                data_model.get_preferences_for_record(from_record),
+                data_model.get_preferences_for_record(to_record))
+            sim = sut.get_record_similarity(data_model, from_record, to_record)
+            if math.isnan(expected_sim):
+                assert math.isnan(sim)
+            else:
+                assert abs(sim - expected_sim) < 1e-9
+
+
+def test__cosine__get_record_similarity__precomputed_norms_are_used():
+    data_model = InMemoryRecordDataModel(create_batch_data_model())
+    sut = CosineSimilarity()
+
+    assert_record_similarity_matches(
+        sut, data_model, batch_preferences.keys() + ['unknown'])
+
+
+def test__time_decay_cosine__get_record_similarity__squares_are_used():
+    time_now = datetime(2001, 12, 31)
+    item_based_sim.utcnow = mock.Mock(return_value=time_now)
+    item_based_dm.utcnow = mock.Mock(return_value=time_now)
+    partitioning = TimePartitioning(time_interval=timedelta(7), max_age=4)
+    data_model = InMemoryRecordDataModel(
+        create_batch_data_model(), time_partitioning=partitioning)
+    sut = TimeDecayCosineSimilarity(partitioning, half_life=2)
+
+    assert data_model.get_partition_squares('caesar', partitioning)\
+        is not None
+    assert_record_similarity_matches(sut, data_model, batch_preferences.keys())
+
+
+def test__time_decay_cosine__get_record_similarity__other_partitioning():
+    time_now = datetime(2001, 12, 31)
+    item_based_sim.utcnow = mock.Mock(return_value=time_now)
+    item_based_dm.utcnow = mock.Mock(return_value=time_now)
+    data_model = InMemoryRecordDataModel(
+        create_batch_data_model(),
+        time_partitioning=TimePartitioning(
+            time_interval=timedelta(7), max_age=4))
+    partitioning = TimePartitioning(time_interval=timedelta(7), max_age=4)
+    sut = TimeDecayCosineSimilarity(partitioning, half_life=2)
+
+    assert data_model.get_partition_squares('caesar', partitioning) is None
+    assert_record_similarity_matches(sut, data_model, batch_preferences.keys())
+
+
+def test__time_partitioning__get_partition():
+    sut = TimePartitioning(time_interval=timedelta(7), max_age=4)
+    time_now = datetime(2001, 12, 31)
+
+    assert sut.get_partition(datetime(2002, 1, 5), time_now) == 0
+    assert sut.get_partition(datetime(2001, 12, 30), time_now) == 0
+    assert sut.get_partition(datetime(2001, 12, 24), time_now) == 1
+    assert sut.get_partition(datetime(2001, 12, 20), time_now) == 1
+    assert sut.get_partition(datetime(2001, 1, 1), time_now) == 4
@@ -1,5 +1,7 @@
 from search_rex.recommendations.similarity.similarity_metrics import\
     jaccard_sim
+from search_rex.recommendations.similarity.similarity_metrics import\
+    set_jaccard_sim
 from search_rex.recommendations.similarity.similarity_metrics import\
     cosine_sim
 import math
@@ -26,6 +28,21 @@ def test__jaccard_sim__empty_sets():
     assert math.isnan(jaccard_sim(set1, set2)) is True
 
 
+def test__set_jaccard_sim():
+    set1 = frozenset([1, 2, 3, 4])
+    set2 = frozenset([1, 4, 5])
+
+    assert set_jaccard_sim(set1, set2) == 0.4
+
+
+def test__set_jaccard_sim__one_set_is_empty():
+    assert set_jaccard_sim(frozenset([1, 2]), frozenset()) == 0.0
+
+
+def test__set_jaccard_sim__empty_sets():
+    assert math.isnan(set_jaccard_sim(frozenset(), frozenset())) is True
+
+
 def test__cosine_sim():
     v1 = {'hello': 1.0, 'world': 2.0}
     v2 = {'world': 3.0, 'is': 4.0, 'hello': 1.0}
@@ -59,8 +59,8 @@ class GetHitsForQueryTestCase(BaseTestCase):
 
         assert query == query_rome
         assert len(q_actions) == 1
-        assert q_actions[0].record_id == record_caesar
-        assert q_actions[0].action_type == action_type
+        assert q_actions[0][0] == record_caesar
+        assert q_actions[0][2] == action_type
 
     def test__get_actions_for_queries__include_internal_records__two_hit_one_query(self):
         query_rome = 'rome'
@@ -80,8 +80,8 @@ class GetHitsForQueryTestCase(BaseTestCase):
 
         assert query == query_rome
         assert len(q_actions) == 2
-        assert any(filter(lambda a: a.record_id == record_caesar, q_actions))
-        assert any(filter(lambda a: a.record_id == record_brutus, q_actions))
+        assert any(filter(lambda a: a[0] == record_caesar, q_actions))
+        assert any(filter(lambda a: a[0] == record_brutus, q_actions))
 
     def test__get_actions_for_queries__include_internal_records__two_hit_two_query(self):
         query_rome = 'rome'
@@ -182,3 +182,93 @@ class GetHitsForQueryTestCase(BaseTestCase):
             max_age=timedelta(days=1)))
 
         assert len(actions) == 0
+
+    def test__get_actions_for_queries__actions_not_newer_than_min_time_created_ignored(self):
+        query_rome = 'rome'
+        record_caesar = 'caesar'
+        record_brutus = 'brutus'
+        action_type = ActionType.view
+        include_internal_records = True
+
+        insert_action(
+            query_rome, record_caesar, action_type, True,
+            datetime(1999, 1, 1))
+        insert_action(
+            query_rome, record_brutus, action_type, True,
+            datetime(1999, 1, 2))
+
+        actions = list(queries.get_actions_for_queries(
+            include_internal_records=include_internal_records,
+            min_time_created=datetime(1999, 1, 1)))
+
+        assert len(actions) == 1
+        query, q_actions = actions[0]
+
+        assert query == query_rome
+        assert len(q_actions) == 1
+        assert q_actions[0][0] == record_brutus
+
+    def test__get_actions_for_queries__actions_newer_than_max_time_created_ignored(self):
+        query_rome = 'rome'
+        record_caesar = 'caesar'
+        record_brutus = 'brutus'
+        action_type = ActionType.view
+
+        insert_action(
+            query_rome, record_caesar, action_type, True,
+            datetime(1999, 1, 1))
+        insert_action(
+            query_rome, record_brutus, action_type, True,
+            datetime(1999, 1, 2))
+
+        actions = list(queries.get_actions_for_queries(
+            include_internal_records=True,
+            max_time_created=datetime(1999, 1, 1)))
+
+        assert len(actions) == 1
+        query, q_actions = actions[0]
+
+        assert query == query_rome
+        assert len(q_actions) == 1
+        assert q_actions[0][0] == record_caesar
+
+    def test__get_hit_cells_for_queries__actions_grouped_by_age(self):
+        query_rome = 'rome'
+        record_caesar = 'caesar'
+        record_brutus = 'brutus'
+        reference_time = datetime(1999, 1, 10)
+
+        for session_id, action_type, timestamp in [
+                ('alice', ActionType.view, datetime(1999, 1, 9, 12)),
+                ('bob', ActionType.view, datetime(1999, 1, 9, 6)),
+                ('bob', ActionType.copy, datetime(1999, 1, 9, 7)),
+                ('carol', ActionType.view, datetime(1999, 1, 7, 12))]:
+            report_action(
+                record_id=record_caesar, timestamp=timestamp,
+                session_id=session_id, is_internal_record=False,
+                action_type=action_type, query_string=query_rome)
+        insert_action(
+            query_rome, record_brutus, ActionType.view, True,
+            datetime(1999, 1, 9, 12))
+
+        cells = list(queries.get_hit_cells_for_queries(
+            include_internal_records=False, reference_time=reference_time,
+            time_interval=timedelta(days=1)))
+
+        assert len(cells) == 1
+        query, q_cells = cells[0]
+        assert query == query_rome
+        assert sorted(q_cells) == [
+            (record_caesar, 0, 2, 1, datetime(1999, 1, 9, 12)),
+            (record_caesar, 2, 1, 0, datetime(1999, 1, 7, 12)),
+        ]
+
+    def test__get_hit_cells_for_queries__pass_empty_query_list(self):
+        insert_external_view_action('rome', 'caesar')
+
+        cells = list(queries.get_hit_cells_for_queries(
+            include_internal_records=True,
+            reference_time=datetime(1999, 1, 10),
+            time_interval=timedelta(days=1), query_strings=[]))
+
+        assert cells == []
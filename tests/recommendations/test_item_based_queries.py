@@ -404,3 +404,34 @@ class GetSimilaritiesTestCase(BaseTestCase):
                 assert any(filter(
                     lambda (r, s): r == to_record and s == sim,
                     ret_sims[record].iteritems()))
+
+    def test__get_actions_on_records__actions_not_newer_than_min_time_created_ignored(self):
+        record_caesar = 'caesar'
+        session_alice = 'alice'
+        session_bob = 'bob'
+        insert_action(
+            session_alice, record_caesar, timestamp=datetime(1999, 1, 1))
+        insert_action(
+            session_bob, record_caesar, timestamp=datetime(1999, 1, 3))
+
+        actions = list(get_actions_on_records(
+            True, min_time_created=datetime(1999, 1, 1)))
+        assert len(actions) == 1
+
+        record, rec_actions = actions[0]
+        assert len(rec_actions) == 1
+        assert rec_actions[0].session_id == session_bob
+
+    def test__get_actions_on_records__fetched_in_chunks(self):
+        self.app.config['QUERY_CHUNK_SIZE'] = 1
+        for session in ['alice', 'bob', 'carol']:
+            insert_action(session, 'caesar')
+        insert_action('alice', 'brutus')
+
+        actions = dict(get_actions_on_records(True))
+        self.app.config['QUERY_CHUNK_SIZE'] = 10000
+
+        assert sorted(actions.keys()) == ['brutus', 'caesar']
+        assert sorted(a.session_id for a in actions['caesar']) ==\
+            ['alice', 'bob', 'carol']
+        assert actions['brutus'][0].session_id == 'alice'
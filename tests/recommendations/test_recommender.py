@@ -3,6 +3,12 @@ from search_rex.recommendations.recommenders.item_based import\
 from search_rex.recommendations.recommenders.case_based import\
     AbstractQueryBasedRecommender
 from search_rex.recommendations import Recommender
+from search_rex.recommendations import create_recommender_system
+from search_rex.recommendations import refresh_recommenders
+from search_rex.recommendations import get_recommender
+from search_rex.recommendations import get_model_version
+from flask import Flask
+from datetime import timedelta
 import mock
 
 
@@ -22,3 +28,167 @@ def test__recommender__refresh__underlying_components_are_refreshed():
     assert sut in refreshed_components
     assert fake_q_rec.refresh.call_count == 1
     assert fake_r_rec.refresh.call_count == 1
+
+
+def create_fake_recommender_system():
+    def q_based_recsys_factory(include_internal_records):
+        return AbstractQueryBasedRecommender()
+
+    def r_based_recsys_factory(include_internal_records):
+        return AbstractRecordBasedRecommender()
+
+    create_recommender_system(
+        Flask(__name__),
+        record_based_recsys_factory=r_based_recsys_factory,
+        query_based_recsys_factory=q_based_recsys_factory)
+
+
+def test__refresh_recommenders__new_instances_are_swapped_in():
+    create_fake_recommender_system()
+    version = get_model_version()
+    old_internal = get_recommender(True)
+    old_external = get_recommender(False)
+    old_components = old_internal.query_based_recsys
+
+    refresh_recommenders()
+
+    assert get_model_version() == version + 1
+    assert get_recommender(True) is not old_internal
+    assert get_recommender(False) is not old_external
+    assert get_recommender(True).version == version + 1
+    assert get_recommender(False).version == version + 1
+    # Requests in progress still see the complete old instance
+    assert old_internal.version == version
+    assert old_internal.query_based_recsys is old_components
+
+
+def test__create_recommender_system__version_increases():
+    create_fake_recommender_system()
+    version = get_model_version()
+
+    create_fake_recommender_system()
+
+    assert get_model_version() == version + 1
+
+
+def test__refresh_recommenders__no_rebuild__instances_refreshed_in_place():
+    create_fake_recommender_system()
+    version = get_model_version()
+    old_internal = get_recommender(True)
+    for recommender in [old_internal, get_recommender(False)]:
+        recommender.query_based_recsys.refresh = mock.Mock()
+        recommender.record_based_recsys.refresh = mock.Mock()
+
+    refresh_recommenders(rebuild=False)
+
+    assert get_recommender(True) is old_internal
+    assert get_model_version() == version + 1
+    assert old_internal.version == version + 1
+    assert old_internal.query_based_recsys.refresh.call_count == 1
+
+
+def test__refresh_recommenders__no_rebuild__version_increased_when_done():
+    create_fake_recommender_system()
+    version = get_model_version()
+    versions_during_refresh = []
+
+    def refresh(refreshed_components):
+        versions_during_refresh.append((
+            get_model_version(), get_recommender(True).version,
+            get_recommender(False).version))
+
+    for recommender in [get_recommender(True), get_recommender(False)]:
+        recommender.query_based_recsys.refresh = mock.Mock(
+            side_effect=refresh)
+        recommender.record_based_recsys.refresh = mock.Mock()
+
+    refresh_recommenders(rebuild=False)
+
+    assert versions_during_refresh == [(version, version, version)] * 2
+    assert get_model_version() == version + 1
+    assert get_recommender(False).version == version + 1
+
+
+def test__create_recommender_system__refresh_interval__started_by_request():
+    app = Flask(__name__)
+    app.config['RECOMMENDER_REFRESH_INTERVAL'] = 60
+    app.config['RECOMMENDER_REBUILD_INTERVAL'] = 3600
+
+    r_based_recsys_factory = mock.Mock(
+        side_effect=lambda _: AbstractRecordBasedRecommender())
+    q_based_recsys_factory = mock.Mock(
+        side_effect=lambda _: AbstractQueryBasedRecommender())
+
+    with mock.patch(
+            'search_rex.recommendations.start_background_refresh') as start:
+        create_recommender_system(
+            app,
+            record_based_recsys_factory=r_based_recsys_factory,
+            query_based_recsys_factory=q_based_recsys_factory)
+        assert not start.called
+
+        app.test_client().get('/')
+        app.test_client().get('/')
+
+    start.assert_called_once_with(timedelta(seconds=60), timedelta(hours=1))
+
+
+def test__create_recommender_system__snapshot__loaded_instead_of_built(
+        tmpdir):
+    app = Flask(__name__)
+    app.config['RECOMMENDER_SNAPSHOT_PATH'] = str(
+        tmpdir.join('recommenders.snapshot'))
+    q_based_recsys_factory = mock.Mock(
+        side_effect=lambda _: AbstractQueryBasedRecommender())
+    r_based_recsys_factory = mock.Mock(
+        side_effect=lambda _: AbstractRecordBasedRecommender())
+
+    create_recommender_system(
+        app,
+        record_based_recsys_factory=r_based_recsys_factory,
+        query_based_recsys_factory=q_based_recsys_factory)
+    assert q_based_recsys_factory.call_count == 2
+
+    create_recommender_system(
+        app,
+        record_based_recsys_factory=r_based_recsys_factory,
+        query_based_recsys_factory=q_based_recsys_factory)
+    assert q_based_recsys_factory.call_count == 2
+    assert get_recommender(True).version == get_model_version()
+
+    # The snapshot was created by this process, so it is rebuilt
+    refresh_recommenders()
+    assert q_based_recsys_factory.call_count == 4
+
+
+def test__create_recommender_system__filtering_recsys__shared_by_instances():
+    q_based_recsys = AbstractQueryBasedRecommender()
+    q_based_recsys.record_filter = mock.Mock()
+    q_based_recsys.refresh = mock.Mock()
+    q_based_recsys.recommend_search_results = mock.Mock(return_value=[])
+    q_based_recsys_factory = mock.Mock(return_value=q_based_recsys)
+    r_based_recsys_factory = mock.Mock(
+        side_effect=lambda _: AbstractRecordBasedRecommender())
+
+    create_recommender_system(
+        Flask(__name__),
+        record_based_recsys_factory=r_based_recsys_factory,
+        query_based_recsys_factory=q_based_recsys_factory)
+
+    q_based_recsys_factory.assert_called_once_with(True)
+    assert r_based_recsys_factory.call_count == 2
+    assert get_recommender(True).query_based_recsys is q_based_recsys
+    assert get_recommender(False).query_based_recsys is q_based_recsys
+    assert get_recommender(True).record_based_recsys is not\
+        get_recommender(False).record_based_recsys
+
+    get_recommender(True).recommend_search_results('rome')
+    q_based_recsys.recommend_search_results.assert_called_with('rome', 10)
+    get_recommender(False).recommend_search_results('rome')
+    q_based_recsys.recommend_search_results.assert_called_with(
+        'rome', 10, include_internal_records=False)
+
+    for recommender in [get_recommender(True), get_recommender(False)]:
+        recommender.record_based_recsys.refresh = mock.Mock()
+    refresh_recommenders(rebuild=False)
+    assert q_based_recsys.refresh.call_count == 1
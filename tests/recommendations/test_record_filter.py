@@ -0,0 +1,52 @@
+from test_base import BaseTestCase
+from search_rex.models import ActionType
+from search_rex.services import report_action
+from search_rex.services import set_record_active
+from search_rex.recommendations.record_filter import InternalRecordFilter
+from datetime import datetime
+
+
+def insert_view_action(record, is_internal):
+    report_action(
+        record_id=record,
+        timestamp=datetime(1999, 1, 1),
+        session_id='alice',
+        is_internal_record=is_internal,
+        action_type=ActionType.view,
+        query_string='rome')
+
+
+class InternalRecordFilterTestCase(BaseTestCase):
+
+    def test__is_visible(self):
+        insert_view_action('caesar', False)
+        insert_view_action('brutus', True)
+
+        sut = InternalRecordFilter()
+
+        assert sut.is_visible('caesar', False)
+        assert not sut.is_visible('brutus', False)
+        assert sut.is_visible('brutus', True)
+
+    def test__is_visible__unknown_record_treated_as_internal(self):
+        sut = InternalRecordFilter()
+        insert_view_action('caesar', False)
+
+        assert not sut.is_visible('caesar', False)
+
+        sut.refresh(set())
+
+        assert sut.is_visible('caesar', False)
+
+    def test__filter_records(self):
+        insert_view_action('caesar', False)
+        insert_view_action('brutus', True)
+        insert_view_action('cleopatra', False)
+        set_record_active('cleopatra', False)
+
+        sut = InternalRecordFilter()
+
+        assert sut.filter_records(['caesar', 'brutus', 'cleopatra'], False) ==\
+            ['caesar']
+        assert sut.filter_records(['caesar', 'brutus'], True) ==\
+            ['caesar', 'brutus']
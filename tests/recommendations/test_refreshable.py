@@ -1,4 +1,5 @@
 import mock
+import cPickle
 from search_rex.recommendations.refreshable import RefreshHelper
 from search_rex.recommendations.refreshable import Refreshable
 
@@ -53,3 +54,27 @@ def test__refresh__refreshed_dependencies_are_added_to_refreshed_components():
     sut.refresh(refreshed_components)
 
     assert refreshed_components == set([refreshable1, refreshable2])
+
+
+class RefreshCounter(Refreshable):
+
+    def __init__(self):
+        self.num_refreshes = 0
+        self.refresh_helper = RefreshHelper(
+            target_refresh_function=self.count_refresh)
+
+    def count_refresh(self):
+        self.num_refreshes += 1
+
+    def refresh(self, refreshed_components):
+        self.refresh_helper.refresh(refreshed_components)
+
+
+def test__refresh_helper__pickled__target_function_is_bound_to_copy():
+    component = RefreshCounter()
+
+    copy = cPickle.loads(cPickle.dumps(component, cPickle.HIGHEST_PROTOCOL))
+    copy.refresh(set())
+
+    assert copy.num_refreshes == 1
+    assert component.num_refreshes == 0
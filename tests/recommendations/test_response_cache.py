@@ -0,0 +1,126 @@
+from search_rex.recommendations.response_cache import LRUCache
+from search_rex.recommendations.response_cache import ResponseCache
+from search_rex.recommendations.response_cache import enable_response_cache
+from search_rex.recommendations.response_cache import disable_response_cache
+from search_rex.recommendations.response_cache import clear_response_cache
+from search_rex.recommendations.response_cache import get_cached_result
+from search_rex.recommendations.response_cache import\
+    get_response_cache_metrics
+import mock
+
+
+def test__lru_cache__least_recently_used_entry_is_evicted():
+    sut = LRUCache(max_size=2)
+    sut.put('caesar', 1)
+    sut.put('brutus', 2)
+
+    assert sut.get('caesar') == (True, 1)
+    sut.put('rome', 3)
+
+    assert sut.get('brutus') == (False, None)
+    assert sut.get('caesar') == (True, 1)
+    assert sut.get('rome') == (True, 3)
+    assert sut.get_metrics()['num_evictions'] == 1
+
+
+def test__lru_cache__entries_expire():
+    clock = mock.Mock(return_value=100.0)
+    sut = LRUCache(max_size=2, ttl=10, clock=clock)
+    sut.put('caesar', 1)
+
+    clock.return_value = 109.0
+    assert sut.get('caesar') == (True, 1)
+    clock.return_value = 110.0
+    assert sut.get('caesar') == (False, None)
+    assert sut.get_metrics()['num_expirations'] == 1
+    assert sut.get_metrics()['size'] == 0
+
+
+def test__lru_cache__metrics():
+    sut = LRUCache(max_size=2)
+    assert sut.get_metrics()['hit_rate'] == 0.0
+
+    sut.put('caesar', 1)
+    sut.get('caesar')
+    sut.get('caesar')
+    sut.get('caesar')
+    sut.get('brutus')
+
+    metrics = sut.get_metrics()
+    assert metrics['num_hits'] == 3
+    assert metrics['num_misses'] == 1
+    assert metrics['hit_rate'] == 0.75
+    assert metrics['size'] == 1
+    assert metrics['max_size'] == 2
+
+
+def test__response_cache__result_is_computed_once():
+    sut = ResponseCache()
+    compute = mock.Mock(return_value=['caesar'])
+
+    assert sut.get_or_compute('similar', ('caesar',), True, 1, compute) ==\
+        ['caesar']
+    assert sut.get_or_compute('similar', ('caesar',), True, 1, compute) ==\
+        ['caesar']
+
+    assert compute.call_count == 1
+
+
+def test__response_cache__key_includes_flag_and_version():
+    sut = ResponseCache()
+    compute = mock.Mock(return_value=['caesar'])
+
+    sut.get_or_compute('similar', ('caesar',), True, 1, compute)
+    sut.get_or_compute('similar', ('caesar',), False, 1, compute)
+    sut.get_or_compute('similar', ('caesar',), True, 2, compute)
+    sut.get_or_compute('similar', ('brutus',), True, 1, compute)
+    sut.get_or_compute('other', ('caesar',), True, 1, compute)
+
+    assert compute.call_count == 5
+
+
+def test__response_cache__max_size_per_endpoint():
+    sut = ResponseCache(max_size=10, max_sizes={'similar': 1})
+
+    assert sut.get_cache('similar').max_size == 1
+    assert sut.get_cache('other').max_size == 10
+
+
+def test__response_cache__clear():
+    sut = ResponseCache()
+    compute = mock.Mock(return_value=['caesar'])
+    sut.get_or_compute('similar', ('caesar',), True, 1, compute)
+
+    sut.clear()
+    sut.get_or_compute('similar', ('caesar',), True, 1, compute)
+
+    assert compute.call_count == 2
+    assert sut.get_metrics()['similar']['num_misses'] == 2
+
+
+def test__get_cached_result__disabled__result_is_computed():
+    disable_response_cache()
+    compute = mock.Mock(return_value=['caesar'])
+
+    get_cached_result('similar', ('caesar',), True, 1, compute)
+    get_cached_result('similar', ('caesar',), True, 1, compute)
+
+    assert compute.call_count == 2
+    assert get_response_cache_metrics() is None
+
+
+def test__get_cached_result__enabled__result_is_cached():
+    enable_response_cache(max_size=10)
+    try:
+        compute = mock.Mock(return_value=['caesar'])
+
+        get_cached_result('similar', ('caesar',), True, 1, compute)
+        get_cached_result('similar', ('caesar',), True, 1, compute)
+        assert compute.call_count == 1
+
+        clear_response_cache()
+        get_cached_result('similar', ('caesar',), True, 1, compute)
+        assert compute.call_count == 2
+        assert get_response_cache_metrics()['similar']['num_hits'] == 1
+    finally:
+        disable_response_cache()
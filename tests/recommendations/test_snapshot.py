@@ -0,0 +1,162 @@
+from search_rex.recommendations import snapshot
+from search_rex.util import date_util
+from search_rex.util.packed_dict import PackedRows
+from datetime import datetime
+from datetime import timedelta
+from threading import Thread
+import fcntl
+import mock
+import numpy as np
+import os
+
+
+def save_snapshot(tmpdir, instances={}, model_version=1):
+    path = str(tmpdir.join('recommenders.snapshot'))
+    date_util._utcnow = mock.Mock(return_value=datetime(1999, 1, 1))
+    snapshot.save_snapshot(path, instances, model_version)
+    return path
+
+
+def test__load_snapshot__saved_instances_are_returned(tmpdir):
+    instances = {True: ['internal'], False: ['external']}
+    path = save_snapshot(tmpdir, instances, 3)
+
+    header, loaded_instances = snapshot.load_snapshot(path)
+
+    assert loaded_instances == instances
+    assert header.model_version == 3
+    assert header.time_created == datetime(1999, 1, 1)
+    assert sorted(tmpdir.listdir()) == sorted([
+        tmpdir.join('recommenders.snapshot'),
+        tmpdir.join(header.array_file),
+        tmpdir.join('recommenders.snapshot.save.lock'),
+        tmpdir.join('recommenders.snapshot.load.lock'),
+    ])
+
+
+def test__load_snapshot__no_snapshot__none_returned(tmpdir):
+    path = str(tmpdir.join('recommenders.snapshot'))
+
+    assert snapshot.load_snapshot(path) is None
+
+
+def test__load_snapshot__corrupt_snapshot__none_returned(tmpdir):
+    snapshot_file = tmpdir.join('recommenders.snapshot')
+    snapshot_file.write('not a snapshot')
+
+    assert snapshot.load_snapshot(str(snapshot_file)) is None
+
+
+def test__load_snapshot__stale_snapshot__none_returned(tmpdir):
+    path = save_snapshot(tmpdir)
+    date_util._utcnow = mock.Mock(return_value=datetime(1999, 1, 3))
+
+    assert snapshot.load_snapshot(path, max_age=timedelta(days=1)) is None
+    assert snapshot.load_snapshot(path, max_age=timedelta(days=2)) is not None
+
+
+def test__load_snapshot__not_newer_than_min_time_created__none_returned(
+        tmpdir):
+    path = save_snapshot(tmpdir)
+
+    assert snapshot.load_snapshot(
+        path, min_time_created=datetime(1999, 1, 1)) is None
+    assert snapshot.load_snapshot(
+        path, min_time_created=datetime(1998, 12, 31)) is not None
+
+
+def test__load_snapshot__other_format_version__none_returned(tmpdir):
+    path = save_snapshot(tmpdir)
+
+    with mock.patch.object(
+            snapshot, 'SNAPSHOT_FORMAT_VERSION',
+            snapshot.SNAPSHOT_FORMAT_VERSION + 1):
+        assert snapshot.load_snapshot(path) is None
+
+
+def test__load_snapshot__large_arrays_are_mapped_read_only(tmpdir):
+    large_array = np.arange(10000, dtype=np.int64)
+    small_array = np.arange(10, dtype=np.int64)
+    times = large_array.view('datetime64[us]')[::2]
+    path = save_snapshot(tmpdir, {
+        'large': large_array, 'small': small_array, 'times': times})
+
+    _, instances = snapshot.load_snapshot(path)
+
+    assert np.array_equal(instances['large'], large_array)
+    assert np.array_equal(instances['small'], small_array)
+    assert np.array_equal(instances['times'], times)
+    assert instances['times'].dtype == times.dtype
+    assert isinstance(instances['large'].base, np.memmap)
+    assert not instances['large'].flags.writeable
+    assert instances['small'].flags.writeable
+
+
+def test__save_snapshot__older_array_files_removed(tmpdir):
+    path = save_snapshot(tmpdir, {'array': np.ones(10000)})
+    _, old_instances = snapshot.load_snapshot(path)
+
+    header = snapshot.save_snapshot(path, {'array': np.zeros(10000)}, 2)
+    _, instances = snapshot.load_snapshot(path)
+
+    assert snapshot.get_array_files(path) == [
+        str(tmpdir.join(header.array_file))]
+    assert instances['array'].sum() == 0.0
+    # The arrays of the older snapshot stay accessible
+    assert old_instances['array'].sum() == 10000.0
+
+
+def test__load_snapshot__packed_rows_are_mapped(tmpdir):
+    rows = {
+        'query{}'.format(i): {
+            'record{}'.format(j): float(j) for j in xrange(5)}
+        for i in xrange(1000)
+    }
+    path = save_snapshot(tmpdir, {'rows': PackedRows(rows.iteritems())})
+
+    _, instances = snapshot.load_snapshot(path)
+
+    assert dict(instances['rows']) == rows
+    assert isinstance(instances['rows'].fields[0].base, np.memmap)
+    assert isinstance(instances['rows'].key_table.data.base, np.memmap)
+
+
+def start_saving_snapshot(path):
+    saver = Thread(
+        target=snapshot.save_snapshot,
+        args=(path, {'array': np.zeros(10000)}, 2))
+    saver.start()
+    # Gives the saver the time it would need if it did not wait for a lock
+    saver.join(0.5)
+    return saver
+
+
+def test__save_snapshot__waits_for_loaders_before_removing_array_files(
+        tmpdir):
+    path = save_snapshot(tmpdir, {'array': np.ones(10000)})
+    old_array_file, = snapshot.get_array_files(path)
+
+    with snapshot.lock_file(path + snapshot.LOAD_LOCK_SUFFIX, fcntl.LOCK_SH):
+        saver = start_saving_snapshot(path)
+        assert saver.is_alive()
+        assert os.path.exists(old_array_file)
+        assert snapshot.load_snapshot(path)[0].model_version == 1
+    saver.join()
+
+    assert not os.path.exists(old_array_file)
+    assert snapshot.load_snapshot(path)[0].model_version == 2
+
+
+def test__save_snapshot__saves_are_serialised(tmpdir):
+    path = save_snapshot(tmpdir, {'array': np.ones(10000)})
+
+    with snapshot.lock_file(path + snapshot.SAVE_LOCK_SUFFIX, fcntl.LOCK_EX):
+        saver = start_saving_snapshot(path)
+        assert saver.is_alive()
+        assert len(snapshot.get_array_files(path)) == 1
+    saver.join()
+
+    header, instances = snapshot.load_snapshot(path)
+    assert header.model_version == 2
+    assert snapshot.get_array_files(path) == [
+        str(tmpdir.join(header.array_file))]
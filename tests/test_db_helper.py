@@ -0,0 +1,74 @@
+from test_base import BaseTestCase
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects import sqlite
+from search_rex.core import db
+from search_rex.db_helper import InsertOrIgnore
+from search_rex.db_helper import insert_or_ignore
+from search_rex import db_helper
+from search_rex.models import Record
+import mock
+
+
+def test__insert_or_ignore__rows_in_one_multi_row_statement():
+    session = mock.Mock()
+    rows = [
+        {'record_id': 'caesar', 'is_internal': False},
+        {'record_id': 'brutus', 'is_internal': True},
+        {'record_id': 'cleopatra', 'is_internal': False},
+    ]
+
+    insert_or_ignore(session, Record.__table__, rows)
+
+    assert session.execute.call_count == 1
+    statement, = session.execute.call_args[0]
+    assert isinstance(statement, InsertOrIgnore)
+    sql = str(statement.compile(dialect=sqlite.dialect()))
+    assert sql.startswith('INSERT OR IGNORE INTO')
+    assert sql.count('(?, ?, ?)') == 3
+    sql = str(statement.compile(dialect=postgresql.dialect()))
+    assert sql.endswith('ON CONFLICT DO NOTHING')
+    assert sql.count('), (') == 2
+
+
+def test__insert_or_ignore__rows_split_by_max_statement_parameters():
+    session = mock.Mock()
+    rows = [
+        {'record_id': str(i), 'is_internal': False} for i in xrange(5)]
+
+    with mock.patch.object(db_helper, 'MAX_STATEMENT_PARAMETERS', 6):
+        insert_or_ignore(session, Record.__table__, rows)
+
+    num_rows = [
+        str(call[0][0].compile(dialect=sqlite.dialect())).count('(?, ?, ?)')
+        for call in session.execute.call_args_list
+    ]
+    assert num_rows == [2, 2, 1]
+
+
+def test__insert_or_ignore__no_rows__nothing_executed():
+    session = mock.Mock()
+
+    insert_or_ignore(session, Record.__table__, [])
+
+    assert not session.execute.called
+
+
+class InsertOrIgnoreTestCase(BaseTestCase):
+
+    def test__insert_or_ignore__present_rows_skipped(self):
+        db.session.add(Record(record_id='caesar', is_internal=True))
+        db.session.commit()
+
+        with mock.patch.object(db_helper, 'MAX_STATEMENT_PARAMETERS', 6):
+            insert_or_ignore(db.session, Record.__table__, [
+                {'record_id': record_id, 'is_internal': False}
+                for record_id in ['caesar', 'brutus', 'cleopatra']
+            ])
+        db.session.commit()
+
+        records = {
+            record.record_id: record.is_internal
+            for record in Record.query.all()
+        }
+        assert records == {
+            'caesar': True, 'brutus': False, 'cleopatra': False}
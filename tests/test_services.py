@@ -1,11 +1,23 @@
 from test_base import BaseTestCase
 from datetime import datetime
+import mock
+import os
+import time
+from search_rex import services
 from search_rex.core import db
 from search_rex.services import report_view_action
 from search_rex.services import report_copy_action
+from search_rex.services import report_actions_bulk
+from search_rex.services import ActionBuffer
+from search_rex.services import start_write_behind
+from search_rex.services import stop_write_behind
+from search_rex.services import get_write_behind_metrics
 from search_rex.services import set_record_active
 from search_rex.services import import_record_similarity
 from search_rex.services import RecordNotPresentException
+from search_rex.services import MalformedSimilarityException
+from search_rex.services import parse_similarities
+from search_rex.services import import_record_similarities_bulk
 from search_rex.models import Action
 from search_rex.models import Record
 from search_rex.models import ActionType
@@ -304,6 +316,236 @@ class ReportDifferentActionsTestCase(BaseTestCase):
             ).one()
 
 
+def create_bulk_action(
+        record_id, session_id, action_type=ActionType.view,
+        timestamp=datetime(1999, 11, 11), query_string=None,
+        is_internal_record=True):
+    return {
+        'record_id': record_id,
+        'is_internal_record': is_internal_record,
+        'session_id': session_id,
+        'timestamp': timestamp,
+        'action_type': action_type,
+        'query_string': query_string,
+    }
+
+
+class ReportActionsBulkTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(ReportActionsBulkTestCase, self).setUp()
+
+    def test__actions_records_queries_and_sessions_created(self):
+        num_actions = report_actions_bulk([
+            create_bulk_action(
+                'treehugging', 'alice', query_string='trees',
+                is_internal_record=False),
+            create_bulk_action(
+                'treehugging', 'alice', action_type=ActionType.copy),
+            create_bulk_action(
+                'forest', 'bob', timestamp=datetime(1999, 11, 12)),
+        ])
+
+        assert num_actions == 3
+        assert Action.query.count() == 3
+        assert Action.query.filter_by(
+            session_id='alice', record_id='treehugging',
+            action_type=ActionType.view, query_string='trees').one()
+        assert Record.query.filter_by(
+            record_id='treehugging', is_internal=False, active=True).one()
+        assert Record.query.filter_by(
+            record_id='forest', is_internal=True, active=True).one()
+        assert SearchQuery.query.filter_by(query_string='trees').one()
+        assert SearchQuery.query.count() == 1
+        assert SearchSession.query.filter_by(
+            session_id='bob', time_created=datetime(1999, 11, 12)).one()
+
+    def test__duplicates_in_batch__first_action_stored(self):
+        num_actions = report_actions_bulk([
+            create_bulk_action(
+                'treehugging', 'alice', timestamp=datetime(1999, 11, 12),
+                query_string='trees'),
+            create_bulk_action(
+                'treehugging', 'alice', timestamp=datetime(1999, 11, 11),
+                query_string='forest'),
+        ])
+
+        assert num_actions == 1
+        assert Action.query.filter_by(
+            session_id='alice', record_id='treehugging',
+            time_created=datetime(1999, 11, 12), query_string='trees').one()
+        assert SearchSession.query.filter_by(
+            session_id='alice', time_created=datetime(1999, 11, 12)).one()
+
+    def test__actions_already_present__not_overwritten(self):
+        report_view_action(
+            record_id='treehugging', is_internal_record=True,
+            session_id='alice', timestamp=datetime(1999, 11, 11))
+
+        report_actions_bulk([
+            create_bulk_action(
+                'treehugging', 'alice', timestamp=datetime(1999, 11, 12),
+                is_internal_record=False),
+            create_bulk_action('forest', 'alice'),
+        ])
+
+        assert Action.query.count() == 2
+        assert Action.query.filter_by(
+            session_id='alice', record_id='treehugging',
+            time_created=datetime(1999, 11, 11)).one()
+        assert Record.query.filter_by(
+            record_id='treehugging', is_internal=True).one()
+
+    def test__empty_batch__nothing_stored(self):
+        assert report_actions_bulk([]) == 0
+        assert Action.query.count() == 0
+
+
+class ActionBufferTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(ActionBufferTestCase, self).setUp()
+
+    def tearDown(self):
+        stop_write_behind()
+        super(ActionBufferTestCase, self).tearDown()
+
+    def test__put__action_written_on_flush(self):
+        sut = ActionBuffer(self.app, max_size=10, batch_size=2)
+
+        for record_id in ['treehugging', 'forest', 'moor']:
+            assert sut.put(
+                record_id, True, 'alice', datetime(1999, 11, 11),
+                ActionType.view)
+        assert Action.query.count() == 0
+
+        sut.flush()
+
+        assert Action.query.count() == 3
+        metrics = sut.get_metrics()
+        assert metrics['queue_size'] == 0
+        assert metrics['num_enqueued'] == 3
+        assert metrics['num_written'] == 3
+        assert metrics['num_overflows'] == 0
+
+    def test__put__queue_full__action_written_directly(self):
+        sut = ActionBuffer(self.app, max_size=1)
+
+        sut.put(
+            'treehugging', True, 'alice', datetime(1999, 11, 11),
+            ActionType.view)
+        sut.put(
+            'forest', True, 'alice', datetime(1999, 11, 11),
+            ActionType.copy, 'trees')
+
+        assert Action.query.filter_by(
+            record_id='forest', action_type=ActionType.copy,
+            query_string='trees').one()
+        assert sut.get_metrics()['num_overflows'] == 1
+        assert sut.get_metrics()['queue_size'] == 1
+
+    def test__write_behind__actions_written_on_stop(self):
+        start_write_behind(self.app, batch_size=10, flush_interval=0.1)
+
+        report_view_action(
+            record_id='treehugging', is_internal_record=True,
+            session_id='alice', timestamp=datetime(1999, 11, 11))
+        report_copy_action(
+            record_id='treehugging', is_internal_record=True,
+            session_id='alice', timestamp=datetime(1999, 11, 11))
+        assert get_write_behind_metrics()['num_enqueued'] == 2
+
+        stop_write_behind()
+
+        assert Action.query.count() == 2
+        assert get_write_behind_metrics() is None
+
+    def test__write_behind__actions_written_in_background(self):
+        buffer = start_write_behind(self.app, flush_interval=0.01)
+
+        report_view_action(
+            record_id='treehugging', is_internal_record=True,
+            session_id='alice', timestamp=datetime(1999, 11, 11))
+        for _ in range(500):
+            if buffer.get_metrics()['num_written'] == 1:
+                break
+            time.sleep(0.01)
+
+        assert buffer.get_metrics()['num_written'] == 1
+        assert Action.query.count() == 1
+
+
+    def test__write_behind__thread_started_by_first_action(self):
+        buffer = start_write_behind(self.app, flush_interval=0.01)
+        assert buffer.thread is None
+
+        report_view_action(
+            record_id='treehugging', is_internal_record=True,
+            session_id='alice', timestamp=datetime(1999, 11, 11))
+
+        assert buffer.thread.is_alive()
+        assert buffer.pid == os.getpid()
+
+    def test__ensure_started__forked_process__own_thread_and_queue(self):
+        sut = ActionBuffer(self.app, flush_interval=0.01)
+        sut.put(
+            'treehugging', True, 'alice', datetime(1999, 11, 11),
+            ActionType.view)
+        # Pretends that the buffer was started by the parent process
+        sut.pid = -1
+
+        sut.ensure_started()
+
+        assert sut.pid == os.getpid()
+        assert sut.thread.is_alive()
+        assert sut.get_metrics()['queue_size'] == 0
+        sut.stop()
+
+    def test__flush__failed_batch__retried(self):
+        sut = ActionBuffer(self.app, batch_size=2, max_retries=1)
+        for record_id in ['treehugging', 'forest']:
+            sut.put(
+                record_id, True, 'alice', datetime(1999, 11, 11),
+                ActionType.view)
+
+        attempts = []
+
+        def fail_first_attempt(batch):
+            attempts.append(batch)
+            if len(attempts) == 1:
+                raise Exception()
+            return report_actions_bulk(batch)
+
+        with mock.patch.object(
+                services, 'report_actions_bulk',
+                side_effect=fail_first_attempt):
+            sut.flush()
+
+        assert len(attempts) == 2
+        assert Action.query.count() == 2
+        metrics = sut.get_metrics()
+        assert metrics['num_retried'] == 2
+        assert metrics['num_written'] == 2
+        assert metrics['num_failed'] == 0
+
+    def test__flush__batch_fails_again__dropped_after_max_retries(self):
+        sut = ActionBuffer(self.app, max_retries=2)
+        sut.put(
+            'treehugging', True, 'alice', datetime(1999, 11, 11),
+            ActionType.view)
+
+        with mock.patch.object(
+                services, 'report_actions_bulk',
+                side_effect=Exception()) as write:
+            sut.flush()
+
+        assert write.call_count == 3
+        metrics = sut.get_metrics()
+        assert metrics['num_retried'] == 2
+        assert metrics['num_failed'] == 1
+        assert len(sut.retry_batches) == 0
+
+
 class SetRecordActiveTestCase(BaseTestCase):
 
     def setUp(self):
@@ -575,3 +817,148 @@ class ImportRecordSimilarityTestCase(BaseTestCase):
             from_record_id=record_caesar,
             to_record_id=record_brutus,
             similarity_value=sims[record_brutus]).one()
+
+
+def create_similarity(
+        from_record_id, to_record_id, similarity_value,
+        from_record_is_internal=True, to_record_is_internal=True):
+    return {
+        'from_record_id': from_record_id,
+        'from_record_is_internal': from_record_is_internal,
+        'to_record_id': to_record_id,
+        'to_record_is_internal': to_record_is_internal,
+        'similarity_value': similarity_value,
+    }
+
+
+def test__parse_similarities__csv():
+    lines = [
+        'from_record_id,from_record_is_internal,to_record_id,'
+        'to_record_is_internal,similarity_value\n',
+        'tree,true,forest,False,0.5\n',
+    ]
+
+    sims = list(parse_similarities(lines, 'csv'))
+
+    assert sims == [
+        create_similarity('tree', 'forest', 0.5, to_record_is_internal=False)]
+
+
+def test__parse_similarities__ndjson():
+    lines = [
+        '{"from_record_id": "tree", "from_record_is_internal": true, '
+        '"to_record_id": "forest", "to_record_is_internal": "false", '
+        '"similarity_value": 0.5}\n',
+        '\n',
+    ]
+
+    sims = list(parse_similarities(lines, 'ndjson'))
+
+    assert sims == [
+        create_similarity('tree', 'forest', 0.5, to_record_is_internal=False)]
+
+
+def test__parse_similarities__malformed_value__exception_thrown():
+    lines = [
+        'from_record_id,from_record_is_internal,to_record_id,'
+        'to_record_is_internal,similarity_value\n',
+        'tree,true,forest,false,0.5\n',
+        'tree,true,moor,false,high\n',
+    ]
+
+    try:
+        list(parse_similarities(lines, 'csv'))
+        assert False
+    except MalformedSimilarityException as e:
+        assert e.line_number == 3
+
+
+class ImportRecordSimilaritiesBulkTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(ImportRecordSimilaritiesBulkTestCase, self).setUp()
+
+    def get_similarities(self):
+        return {
+            (sim.from_record_id, sim.to_record_id): sim.similarity_value
+            for sim in ImportedRecordSimilarity.query.all()
+        }
+
+    def test__similarities_stored_and_records_created(self):
+        num_records, num_sims = import_record_similarities_bulk([
+            create_similarity(
+                'tree', 'forest', 0.5, to_record_is_internal=False),
+            create_similarity('tree', 'moor', 0.7),
+            create_similarity('moor', 'tree', 0.2),
+        ], chunk_size=1)
+
+        assert (num_records, num_sims) == (2, 3)
+        assert self.get_similarities() == {
+            ('tree', 'forest'): 0.5,
+            ('tree', 'moor'): 0.7,
+            ('moor', 'tree'): 0.2,
+        }
+        assert Record.query.filter_by(
+            record_id='forest', is_internal=False).one()
+        assert Record.query.count() == 3
+
+    def test__more_sims_than_max_sims__top_sims_kept(self):
+        sims = [
+            create_similarity('tree', 'r{}'.format(i), i / 10.0)
+            for i in range(10)
+        ]
+        sims.append(create_similarity('tree', 'r0', 0.95))
+
+        import_record_similarities_bulk(sims, max_sims_per_record=2)
+
+        assert self.get_similarities() == {
+            ('tree', 'r0'): 0.95,
+            ('tree', 'r9'): 0.9,
+        }
+
+    def test__similarities_of_imported_records_replaced(self):
+        import_record_similarity('tree', True, 'forest', True, 0.5)
+        import_record_similarity('tree', True, 'moor', True, 0.5)
+        import_record_similarity('moor', True, 'tree', True, 0.5)
+
+        import_record_similarities_bulk([
+            create_similarity('tree', 'moor', 0.7),
+        ])
+
+        assert self.get_similarities() == {
+            ('tree', 'moor'): 0.7,
+            ('moor', 'tree'): 0.5,
+        }
+
+    def test__grouped_input__chunks_written_while_reading(self):
+        num_stored = []
+
+        def iter_similarities():
+            for from_record_id in ['tree', 'moor', 'forest']:
+                num_stored.append(ImportedRecordSimilarity.query.count())
+                yield create_similarity(from_record_id, 'r1', 0.5)
+                yield create_similarity(from_record_id, 'r2', 0.4)
+
+        num_records, num_sims = import_record_similarities_bulk(
+            iter_similarities(), chunk_size=1)
+
+        assert (num_records, num_sims) == (3, 6)
+        # The group of a from record is written once the next group starts
+        assert num_stored == [0, 0, 2]
+        assert ImportedRecordSimilarity.query.count() == 6
+
+    def test__interleaved_input__groups_of_written_records_merged(self):
+        num_records, num_sims = import_record_similarities_bulk([
+            create_similarity('tree', 'forest', 0.5),
+            create_similarity('tree', 'moor', 0.7),
+            create_similarity('moor', 'tree', 0.2),
+            create_similarity('tree', 'forest', 0.6),
+            create_similarity('tree', 'field', 0.1),
+        ], max_sims_per_record=2, chunk_size=1)
+
+        assert (num_records, num_sims) == (2, 3)
+        assert self.get_similarities() == {
+            ('tree', 'forest'): 0.6,
+            ('tree', 'moor'): 0.7,
+            ('moor', 'tree'): 0.2,
+        }
@@ -13,6 +13,11 @@ from search_rex.recommendations.recommenders.case_based import\
     WeightedSumScorer, Frequency
 from search_rex.recommendations import create_recommender_system
 from search_rex.recommendations import refresh_recommenders
+from search_rex.recommendations.response_cache import enable_response_cache
+from search_rex.recommendations.response_cache import\
+    disable_response_cache
+from search_rex.recommendations.response_cache import\
+    get_response_cache_metrics
 import os
 from tests.resource.case_based_data import *
 from collections import namedtuple
@@ -184,3 +189,66 @@ class QueryBasedRecommenderTestCase(BaseTestCase):
         recs = recommend_search_results(query_caesar, max_num_recs=2)
         records = [rec.record_id for rec in recs]
         assert records == [record_caesar_secrets, record_caesar]
+
+    def test__recommend_search_results__model_version_is_reported(self):
+        client, app = self.client, self.app
+
+        def get_model_version():
+            request = create_request(
+                base_url + '/recommended_search_results', dict(
+                    query_string=query_caesar,
+                    include_internal_records=True,
+                    api_key=app.config['API_KEY']))
+            return client.get(request).json['model_version']
+
+        version = get_model_version()
+        refresh_recommenders()
+
+        assert get_model_version() == version + 1
+
+    def test__similar_queries__max_num_recs(self):
+        client, app = self.client, self.app
+        import_test_data(views=view_matrix, copies=copy_matrix)
+        refresh_recommenders()
+
+        def get_similar_queries(**parameters):
+            request = create_request(
+                base_url + '/similar_queries', dict(
+                    query_string=query_caesar,
+                    api_key=app.config['API_KEY'], **parameters))
+            return client.get(request).json['results']
+
+        assert get_similar_queries() == [
+            query_caesar, query_caesar_secrets, query_julius,
+            query_brutus_caesar]
+        assert get_similar_queries(max_num_recs=2) == [
+            query_caesar, query_caesar_secrets]
+
+    def test__recommend_search_results__cached_until_refresh(self):
+        client, app = self.client, self.app
+        import_test_data(views=view_matrix, copies=copy_matrix)
+        refresh_recommenders()
+        enable_response_cache()
+
+        def recommend_search_results():
+            request = create_request(
+                base_url + '/recommended_search_results', dict(
+                    query_string=query_caesar,
+                    include_internal_records=True,
+                    api_key=app.config['API_KEY']))
+            return client.get(request).json
+
+        try:
+            first = recommend_search_results()
+            assert recommend_search_results() == first
+            metrics = get_response_cache_metrics()
+            assert metrics['recommended_search_results']['num_hits'] == 1
+
+            refresh_recommenders()
+
+            assert recommend_search_results()['model_version'] ==\
+                first['model_version'] + 1
+            metrics = get_response_cache_metrics()
+            assert metrics['recommended_search_results']['num_misses'] == 2
+        finally:
+            disable_response_cache()
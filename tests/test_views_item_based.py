@@ -13,6 +13,7 @@ from search_rex.recommendations.similarity.item_based import\
 from search_rex.recommendations.recommenders.item_based import\
     RecordBasedRecommender
 from search_rex.recommendations import refresh_recommenders
+from search_rex.recommendations import get_recommender
 import os
 from datetime import datetime
 from tests.resource.item_based_data import *
@@ -258,3 +259,17 @@ class RecordBasedRecommenderTestCase(BaseTestCase):
         recs = self.other_users_also_used(
             record_isolated, include_internal_records)
         assert list(recs) == []
+
+    def test__default_query_recsys__shingles_are_not_cached(self):
+        query_based_recsys = get_recommender(True).query_based_recsys
+
+        assert query_based_recsys.query_sim.data_model is None
+        assert query_based_recsys.query_sim.shingle_cache == {}
+
+    def test__default_recsys__record_filter_is_shared(self):
+        recommender = get_recommender(True)
+
+        assert recommender.query_based_recsys.record_filter is\
+            recommender.record_based_recsys.record_filter
+        assert get_recommender(False).query_based_recsys.record_filter is\
+            recommender.record_based_recsys.record_filter
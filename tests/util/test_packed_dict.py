@@ -0,0 +1,128 @@
+from search_rex.util.packed_dict import StringTable
+from search_rex.util.packed_dict import PackedDict
+from search_rex.util.packed_dict import PackedRows
+from search_rex.util.packed_dict import OverlayDict
+from search_rex.util.packed_dict import copy_for_update
+from search_rex.util.packed_dict import get_row_value
+from search_rex.util import packed_dict
+import cPickle
+import mock
+
+
+def test__string_table__strings_by_position():
+    sut = StringTable(['rome', u'z\xfcrich', ''])
+
+    assert len(sut) == 3
+    assert list(sut) == ['rome', u'z\xfcrich', '']
+    assert sut[1] == u'z\xfcrich'
+
+
+def test__string_table__get_index():
+    sut = StringTable(['rome', u'z\xfcrich', ''])
+
+    assert sut.get_index('rome') == 0
+    assert sut.get_index(u'z\xfcrich') == 1
+    assert sut.get_index(u'z\xfcrich'.encode('utf-8')) == 1
+    assert sut.get_index('') == 2
+    assert sut.get_index('gaul') is None
+    assert 'rome' in sut
+    assert 'gaul' not in sut
+
+
+def test__string_table__get_index__same_hashes():
+    with mock.patch.object(
+            packed_dict, 'hash_string', return_value=42):
+        sut = StringTable(['rome', 'gaul', 'egypt'])
+
+        assert [sut.get_index(s) for s in ['egypt', 'rome', 'gaul']] ==\
+            [2, 0, 1]
+        assert sut.get_index('carthage') is None
+
+
+def test__packed_dict():
+    sut = PackedDict([('rome', 1.5), ('gaul', 2.0)])
+
+    assert dict(sut) == {'rome': 1.5, 'gaul': 2.0}
+    assert sut['gaul'] == 2.0
+    assert sut.get('egypt') is None
+    assert len(sut) == 2
+
+
+def test__packed_rows():
+    rows = {
+        'rome': {'caesar': 1.0, 'brutus': 0.5},
+        'gaul': {'caesar': 0.25},
+        'egypt': {},
+    }
+
+    sut = PackedRows(rows.iteritems())
+
+    assert dict(sut) == rows
+    assert sut['rome'] == rows['rome']
+    assert sut.get('carthage') is None
+    assert 'egypt' in sut
+    assert sut.get_value('rome', 'brutus') == 0.5
+    assert sut.get_value('gaul', 'brutus', -1.0) == -1.0
+    assert sut.get_value('rome', 'cleopatra') is None
+    assert sut.get_value('carthage', 'caesar') is None
+
+
+def test__packed_rows__pickled():
+    rows = {'rome': {'caesar': 1.0, 'brutus': 0.5}, 'gaul': {}}
+
+    sut = cPickle.loads(cPickle.dumps(
+        PackedRows(rows.iteritems()), cPickle.HIGHEST_PROTOCOL))
+
+    assert dict(sut) == rows
+
+
+def test__packed_dict__lists_of_numbers():
+    sut = PackedDict([('rome', [1.0, 2.0]), ('gaul', [0.0, 0.5])])
+
+    assert sut['rome'] == [1.0, 2.0]
+    assert dict(sut) == {'rome': [1.0, 2.0], 'gaul': [0.0, 0.5]}
+
+
+def test__overlay_dict():
+    base = PackedRows([('rome', {'caesar': 1.0}), ('gaul', {'brutus': 0.5})])
+
+    sut = copy_for_update(base)
+    sut['gaul'] = {'caesar': 0.25}
+    sut['egypt'] = {}
+    copy = copy_for_update(sut)
+    copy['rome'] = {}
+
+    assert isinstance(sut, OverlayDict)
+    assert sut.base is base
+    assert dict(sut) == {
+        'rome': {'caesar': 1.0}, 'gaul': {'caesar': 0.25}, 'egypt': {}}
+    assert len(sut) == 3
+    assert 'egypt' in sut
+    assert 'carthage' not in sut
+    assert copy['rome'] == {}
+    assert sut['rome'] == {'caesar': 1.0}
+
+
+def test__copy_for_update__dict_is_copied():
+    rows = {'rome': {'caesar': 1.0}}
+
+    sut = copy_for_update(rows)
+    sut['gaul'] = {}
+
+    assert rows == {'rome': {'caesar': 1.0}}
+
+
+def test__get_row_value():
+    rows = {'rome': {'caesar': 1.0}, 'gaul': {'brutus': 0.5}}
+    packed = PackedRows(rows.iteritems())
+    overlay = copy_for_update(packed)
+    overlay['gaul'] = {'caesar': 0.25}
+
+    for sut in [rows, packed]:
+        assert get_row_value(sut, 'rome', 'caesar') == 1.0
+        assert get_row_value(sut, 'gaul', 'brutus') == 0.5
+        assert get_row_value(sut, 'rome', 'brutus', -1.0) == -1.0
+        assert get_row_value(sut, 'egypt', 'caesar') is None
+    assert get_row_value(overlay, 'rome', 'caesar') == 1.0
+    assert get_row_value(overlay, 'gaul', 'caesar') == 0.25
+    assert get_row_value(overlay, 'gaul', 'brutus') is None
@@ -0,0 +1,26 @@
+from search_rex.util.sort_util import top_k
+
+
+def test__top_k():
+    items = [('a', 1), ('b', 5), ('c', 3), ('d', 4)]
+    assert top_k(items, 2, key=lambda (_, v): v) == [('b', 5), ('d', 4)]
+
+
+def test__top_k__ties_keep_original_order():
+    items = [('a', 1), ('b', 2), ('c', 2), ('d', 2), ('e', 3)]
+    assert top_k(items, 3, key=lambda (_, v): v) ==\
+        sorted(items, key=lambda (_, v): v, reverse=True)[:3]
+    assert top_k(items, 3, key=lambda (_, v): v) ==\
+        [('e', 3), ('b', 2), ('c', 2)]
+
+
+def test__top_k__k_larger_than_number_of_items():
+    assert top_k([1, 3, 2], 10) == [3, 2, 1]
+
+
+def test__top_k__k_is_none__all_items_sorted():
+    assert top_k(iter([1, 3, 2]), None) == [3, 2, 1]
+
+
+def test__top_k__k_is_zero():
+    assert top_k([1, 3, 2], 0) == []